@@ -0,0 +1,138 @@
+import numpy as np
+from raw.src.profiling import timed
+
+
+# Aggregated metrics of agg_study, in the same column order, with their aggregation over the anchors and (th, k).
+AGG_FUNCS = {
+    'msssim_sim': 'mean',
+    'orb_matches_sim': 'max',
+    'scc_sim': 'mean',
+    'ssim_sim': 'mean',
+    'uqi_sim': 'mean',
+    'vifp_sim': 'mean',
+    'ergas_dist': 'mean',
+    'orb_mean_dist': 'mean',
+    'rmse_dist': 'mean',
+    'sam_dist': 'mean',
+}
+AGG_COLUMNS = tuple(AGG_FUNCS)
+
+
+def is_metric(col):
+    return ('sim' in col) or ('dist' in col)
+
+
+def study_matrix(study, columns=AGG_COLUMNS):
+    """
+    Converts a study (list of row dicts) to a float matrix and a name index.
+    @param study: (list) study rows, as returned by create_study or process_rows
+    @param columns: (tuple) metric columns of the matrix
+    @return: (np.array, np.array) float64 matrix (n_rows, n_columns), names of the rows
+    """
+    matrix = np.array([[row.get(col, np.nan) for col in columns] for row in study], dtype=np.float64)
+    names = np.array([row['name'] for row in study], dtype=object)
+    return matrix.reshape(len(study), len(columns)), names
+
+
+def normalize(matrix, columns):
+    """
+    Same normalization as process_study, over the columns of a matrix: each metric is divided by its max and the
+    distances are turned into similarities (1 - d / max(d)).
+    @param matrix: (np.array) float matrix (n_rows, n_columns)
+    @param columns: (iterable) column names of the matrix
+    @return: (np.array) normalized matrix
+    """
+    matrix = np.array(matrix, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for jj, col in enumerate(columns):
+            if not is_metric(col):
+                continue
+            column = matrix[:, jj]
+            col_max = np.nanmax(column) if not np.isnan(column).all() else np.nan
+            matrix[:, jj] = column / col_max
+            if 'dist' in col:
+                matrix[:, jj] = 1 - matrix[:, jj]
+    return matrix
+
+
+@timed('agg.process_rows')
+def process_rows(study):
+    """
+    Same as process_study(study, 'list'), without building a DataFrame.
+    @param study: (list) study rows as returned by create_study
+    @return: (list) normalized study rows
+    """
+    if not study:
+        return []
+    columns = [col for col in study[0] if is_metric(col)]
+    normalized = normalize(study_matrix(study, columns)[0], columns)
+    return [row | dict(zip(columns, values)) for row, values in zip(study, normalized.tolist())]
+
+
+def aggregate(matrix, names, columns=AGG_COLUMNS):
+    """
+    Same aggregation as agg_study: for each name, the max or mean (ignoring NaN) of each metric over its rows.
+    @param matrix: (np.array) normalized float matrix (n_rows, n_columns)
+    @param names: (np.array) name of each row
+    @param columns: (tuple) column names of the matrix, keys of AGG_FUNCS
+    @return: (np.array, np.array) sorted unique names, aggregated matrix (n_names, n_columns)
+    """
+    unique_names, codes = np.unique(names.astype(str), return_inverse=True)
+    n_names = len(unique_names)
+    valid = ~np.isnan(matrix)
+    counts = np.zeros((n_names, matrix.shape[1]))
+    np.add.at(counts, codes, valid)
+    sums = np.zeros((n_names, matrix.shape[1]))
+    np.add.at(sums, codes, np.where(valid, matrix, 0.0))
+    maxs = np.full((n_names, matrix.shape[1]), -np.inf)
+    np.fmax.at(maxs, codes, matrix)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        agg = sums / counts
+    is_max = np.array([AGG_FUNCS[col] == 'max' for col in columns])
+    agg[:, is_max] = maxs[:, is_max]
+    agg[counts == 0] = np.nan
+    return unique_names, agg
+
+
+def collapse(agg):
+    """
+    Same as collapse_agg: the score of each name is the mean (ignoring NaN) of its aggregated metrics.
+    @param agg: (np.array) aggregated matrix (n_names, n_columns)
+    @return: (np.array) score of each name
+    """
+    valid = ~np.isnan(agg)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(valid, agg, 0.0).sum(axis=1) / valid.sum(axis=1)
+
+
+@timed('agg.score_study')
+def score_study(study, processed=True, keys=None):
+    """
+    Scores the query images of a study.
+    @param study: (list) study rows
+    @param processed: (bool) True if the study was already normalized (process_study / process_rows). The
+    normalization uses all the rows of the study, so a study of several query images must be normalized by query.
+    @param keys: (list) query image of each row (str), the rows are grouped by them instead of by their name. Use it
+    when several query images of the study can have the same name.
+    @return: (dict) name (or key) -> {'score': float, 'metrics': dict of aggregated metrics}
+    """
+    matrix, names = study_matrix(study)
+    if keys is not None:
+        names = np.array(keys, dtype=object)
+    if not processed:
+        matrix = normalize(matrix, AGG_COLUMNS)
+    unique_names, agg = aggregate(matrix, names)
+    scores = collapse(agg)
+    return {name: {'score': float(score), 'metrics': dict(zip(AGG_COLUMNS, values))}
+            for name, score, values in zip(unique_names.tolist(), scores.tolist(), agg.tolist())}
+
+
+def to_frame(scored):
+    """
+    Reporting boundary: the result of score_study as the DataFrame returned by agg_study, with the score column.
+    @param scored: (dict) result of score_study
+    @return: (pd.DataFrame) one row per name
+    """
+    import pandas as pd
+    return pd.DataFrame([{'name': name} | item['metrics'] | {'score': item['score']} for name, item in scored.items()])
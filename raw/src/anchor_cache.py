@@ -0,0 +1,148 @@
+import os
+import hashlib
+import pathlib
+import numpy as np
+from raw.src.image_processor_modules import THRESHOLDS, KERNELS, param_grid
+from raw.src.image_processor_modules import load_img, process_img_grid, process_color_grid
+from raw.src.image_processor_modules import orb_descriptors, color_hist
+from raw.src.tensor_store import save_tensors, load_tensors
+
+
+CACHE_VERSION = 2
+
+
+def file_sha1(path):
+    """
+    Computes the sha1 hash of the content of a file.
+    @param path: (str) path of the file
+    @return: (str) hex digest of the file content
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 16), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class AnchorCache:
+
+    def __init__(self, anchors_path, cache_dir=None, thresholds=THRESHOLDS, kernels=KERNELS, mmap=False):
+        """
+        On disk cache of the preprocessed anchors of a client. For each anchor all the (th, k) variants used in
+        'create_study' are computed once (processed images, ORB descriptors and color histograms) and stored as a
+        compressed npz file at '{anchors_path}/.cache/'. A cached anchor is rebuilt when the anchor file changes.
+        @param anchors_path: (str) Path of the client anchors.
+        @param cache_dir: (str) Path of the cache dir. Default is '{anchors_path}/.cache'
+        @param thresholds: (iterable) thresholds used to process the anchors.
+        @param kernels: (iterable) blur kernel sizes used to process the anchors.
+        @param mmap: (bool) If True the anchors are stored uncompressed (a dir of npy files per anchor, see tensor_store)
+        and loaded memory mapped, so the worker processes of a run share one copy of them instead of decompressing
+        their own.
+        """
+        self.anchors_path = anchors_path
+        self.cache_dir = cache_dir if cache_dir is not None else f'{anchors_path}/.cache'
+        self.thresholds = tuple(thresholds)
+        self.kernels = tuple(kernels)
+        self.mmap = mmap
+
+    def anchor_names(self):
+        adir = self.anchors_path
+        anchor_names = sorted([ai for ai in os.listdir(adir) if ai.endswith('.png')])
+        if len(anchor_names) == 0:
+            raise FileNotFoundError(f'Theres not anchors in the directory: {adir}')
+        return anchor_names
+
+    def load(self):
+        """
+        Loads the preprocessed features of all the anchors, computing and caching the ones that are missing or stale.
+        @return: (list) One dictionary per anchor with keys: 'name', 'path', 'sha1', 'gray' (np.array with one processed
+        image per param_grid item), 'des' (list of ORB descriptors per param_grid item, None when there are no key
+        points), 'color' (np.array with one color image per kernel) and 'hist' (np.array with one histogram per kernel).
+        """
+        return [self.load_anchor(aimname) for aimname in self.anchor_names()]
+
+    def load_anchor(self, aimname):
+        aimpath = f'{self.anchors_path}/{aimname}'
+        cache_path = f'{self.cache_dir}/{aimname}.tensors' if self.mmap else f'{self.cache_dir}/{aimname}.npz'
+        stat = os.stat(aimpath)
+
+        cached = self._read(cache_path)
+        if cached is not None and int(cached.get('version', -1)) == CACHE_VERSION:
+            same_grid = (tuple(cached['thresholds']) == self.thresholds and tuple(cached['kernels']) == self.kernels)
+            same_stat = (int(cached['mtime_ns']) == stat.st_mtime_ns and int(cached['size']) == stat.st_size)
+            if same_grid:
+                if same_stat:
+                    return self._unpack(aimname, aimpath, cached)
+                sha1 = file_sha1(aimpath)
+                if str(cached['sha1']) == sha1:
+                    cached['mtime_ns'] = np.int64(stat.st_mtime_ns)
+                    cached['size'] = np.int64(stat.st_size)
+                    self._write(cache_path, cached)
+                    if self.mmap:
+                        cached = self._read(cache_path)
+                    return self._unpack(aimname, aimpath, cached)
+
+        arrays = self._build(aimpath)
+        arrays['sha1'] = np.array(file_sha1(aimpath))
+        arrays['mtime_ns'] = np.int64(stat.st_mtime_ns)
+        arrays['size'] = np.int64(stat.st_size)
+        self._write(cache_path, arrays)
+        if self.mmap:
+            arrays = self._read(cache_path)
+        return self._unpack(aimname, aimpath, arrays)
+
+    def _build(self, aimpath):
+        anchor_img = load_img(aimpath)
+        gray = process_img_grid(anchor_img, self.thresholds, self.kernels)
+        color = process_color_grid(anchor_img, self.kernels)
+        des = []
+        for aimg in gray:
+            ades = orb_descriptors(aimg)
+            des.append(ades if ades is not None else np.zeros((0, 32), np.uint8))
+
+        return {
+            'version': np.int64(CACHE_VERSION),
+            'thresholds': np.array(self.thresholds),
+            'kernels': np.array(self.kernels),
+            'gray': gray,
+            'color': color,
+            'hist': np.stack([color_hist(acimg) for acimg in color]),
+            'des': np.concatenate(des),
+            'des_offsets': np.cumsum([0] + [len(d) for d in des]),
+        }
+
+    def _unpack(self, aimname, aimpath, arrays):
+        offsets = arrays['des_offsets']
+        des = []
+        for ii in range(len(param_grid(self.thresholds, self.kernels))):
+            ades = arrays['des'][offsets[ii]:offsets[ii + 1]]
+            des.append(ades if len(ades) else None)
+
+        return {
+            'name': aimname,
+            'path': aimpath,
+            'sha1': str(arrays['sha1']),
+            'gray': arrays['gray'],
+            'des': des,
+            'color': arrays['color'],
+            'hist': arrays['hist'],
+        }
+
+    def _read(self, cache_path):
+        if self.mmap:
+            return load_tensors(cache_path)
+        try:
+            with np.load(cache_path) as npz:
+                return {key: npz[key] for key in npz.files}
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write(self, cache_path, arrays):
+        pathlib.Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        if self.mmap:
+            save_tensors(cache_path, arrays)
+            return
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as handle:
+            np.savez_compressed(handle, **arrays)
+        os.replace(tmp_path, cache_path)
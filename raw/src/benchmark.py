@@ -0,0 +1,277 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import cv2
+import numpy as np
+from raw.src.image_processor_modules import THRESHOLDS, KERNELS, param_grid
+from raw.src.image_processor_modules import load_and_process_img, descriptor_matches
+from raw.src.image_processor_modules import other_similarities, other_distances
+from raw.src.image_processor_modules import color_similarities, color_distances
+from raw.src.study_processors_modules import create_study, process_study, agg_study, collapse_agg
+from raw.src.agg_engine import process_rows, score_study
+from raw.src.comparisson_client import ComparisonClient
+
+
+LOGO_SIZE = 256
+# name -> (number of anchors, number of query images)
+SCALES = {
+    'small': (1, 4),
+    'medium': (2, 8),
+    'large': (4, 16),
+}
+REPEAT = 3
+THRESHOLD = 0.2  # relative slowdown flagged as regression
+BASELINE_PATH = 'files/benchmark_baseline.json'
+# entry point -> code run by startup_times
+STARTUP_COMMANDS = {
+    'python': 'pass',
+    'cli': 'import raw.src.cli',
+    'scrape': 'import raw.src.scrap_stores',
+    'score': 'import raw.src.comparisson_client, raw.src.report_writer',
+    'report': 'import raw.src.study_store, raw.src.agg_engine, raw.src.report_writer',
+}
+
+
+def synthetic_logo(rng, size=LOGO_SIZE):
+    """
+    App logo like image: a colored background with color blocks, shapes and a short text, inside the 18px
+    border of the store logos.
+    @param rng: (np.random.Generator) random generator
+    @param size: (int) side of the logo in pixels
+    @return: (np.array) BGR uint8 image (size, size, 3)
+    """
+    def color():
+        return tuple(int(c) for c in rng.integers(0, 256, 3))
+
+    img = np.full((size, size, 3), 255, np.uint8)
+    inner = (18, 18, size - 18, size - 18)
+    cv2.rectangle(img, inner[:2], inner[2:], color(), -1)
+    for _ in range(rng.integers(1, 4)):
+        x0, y0 = rng.integers(18, size // 2, 2)
+        x1, y1 = rng.integers(size // 2, size - 18, 2)
+        cv2.rectangle(img, (int(x0), int(y0)), (int(x1), int(y1)), color(), -1)
+    for _ in range(rng.integers(1, 4)):
+        center = tuple(int(c) for c in rng.integers(40, size - 40, 2))
+        cv2.circle(img, center, int(rng.integers(10, size // 4)), color(), int(rng.choice([-1, 3, 6])))
+    points = rng.integers(30, size - 30, (int(rng.integers(3, 6)), 2)).astype(np.int32)
+    cv2.fillPoly(img, [points], color())
+    letters = ''.join(chr(c) for c in rng.integers(65, 91, int(rng.integers(1, 4))))
+    cv2.putText(img, letters, (40, size // 2 + 30), cv2.FONT_HERSHEY_SIMPLEX, float(rng.uniform(1.5, 3.0)), color(),
+                int(rng.integers(3, 9)))
+    return img
+
+
+def perturb(img, rng):
+    """
+    Near duplicate of a logo: small shift, rotation and scale, brightness change, noise and jpeg artifacts.
+    @param img: (np.array) BGR logo
+    @param rng: (np.random.Generator) random generator
+    @return: (np.array) perturbed logo
+    """
+    size = img.shape[0]
+    matrix = cv2.getRotationMatrix2D((size / 2, size / 2), float(rng.uniform(-4, 4)), float(rng.uniform(0.95, 1.05)))
+    matrix[:, 2] += rng.uniform(-4, 4, 2)
+    out = cv2.warpAffine(img, matrix, (size, size), borderValue=(255, 255, 255))
+    out = np.clip(out.astype(np.float32) * rng.uniform(0.9, 1.1) + rng.normal(0, 4, out.shape), 0, 255).astype(np.uint8)
+    quality = int(rng.integers(60, 95))
+    return cv2.imdecode(cv2.imencode('.jpg', out, [cv2.IMWRITE_JPEG_QUALITY, quality])[1], cv2.IMREAD_COLOR)
+
+
+def make_workload(workdir, n_anchors, n_queries, seed=0):
+    """
+    Writes a synthetic client: anchors at '{workdir}/anchors', query images at '{workdir}/queries' (half of them near
+    duplicates of the anchors, the rest unrelated logos) and the client info at '{workdir}/clients.json'.
+    @return: (dict) with keys 'anchors_path', 'query_paths' and 'clients_info_path'
+    """
+    rng = np.random.default_rng(seed)
+    anchors_path = f'{workdir}/anchors'
+    queries_path = f'{workdir}/queries'
+    os.makedirs(anchors_path, exist_ok=True)
+    os.makedirs(queries_path, exist_ok=True)
+    anchors = [synthetic_logo(rng) for _ in range(n_anchors)]
+    for ii, anchor in enumerate(anchors):
+        cv2.imwrite(f'{anchors_path}/bench_anchor_{ii}.png', anchor)
+    query_paths = []
+    for ii in range(n_queries):
+        query = perturb(anchors[ii % n_anchors], rng) if ii % 2 == 0 else synthetic_logo(rng)
+        query_paths.append(f'{queries_path}/query_{ii}.png')
+        cv2.imwrite(query_paths[-1], query)
+    clients_info_path = f'{workdir}/clients.json'
+    with open(clients_info_path, 'w') as handle:
+        json.dump({'bench': {'developer': {'bench': ['Bench Inc']}}}, handle)
+    return {'anchors_path': anchors_path, 'query_paths': query_paths, 'clients_info_path': clients_info_path}
+
+
+def time_stage(func, calls, repeat=REPEAT):
+    """
+    Times a stage: all the calls are run repeat times.
+    @param func: (callable) stage, called with each item of calls as arguments
+    @param calls: (list) argument tuples
+    @param repeat: (int) repetitions
+    @return: (dict) 'calls' per repetition, 'median' and 'min' seconds per repetition
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for args in calls:
+            func(*args)
+        times.append(time.perf_counter() - start)
+    return {'calls': len(calls), 'median': float(np.median(times)), 'min': float(np.min(times))}
+
+
+def run_scale(workdir, n_anchors, n_queries, repeat=REPEAT, seed=0):
+    """
+    Times every stage of the scoring on a synthetic workload.
+    @return: (dict) stage -> timings (see time_stage)
+    """
+    workload = make_workload(workdir, n_anchors, n_queries, seed)
+    anchor_paths = sorted(f"{workload['anchors_path']}/{name}" for name in os.listdir(workload['anchors_path'])
+                          if name.endswith('.png'))
+    query_paths = workload['query_paths']
+    grid = param_grid(THRESHOLDS, KERNELS)
+    th, k = grid[len(grid) // 2]
+    pairs = [(load_and_process_img(a, 'anchor', th, k), load_and_process_img(q, 'query', th, k))
+             for a in anchor_paths for q in query_paths]
+    color_pairs = [(load_and_process_img(a, 'anchor', th, k, keep_color=True),
+                    load_and_process_img(q, 'query', th, k, keep_color=True))
+                   for a in anchor_paths for q in query_paths]
+    studies = [create_study(workload['anchors_path'], q, q.split('/')[-1]) for q in query_paths]
+    processed = [process_study(study, 'list') for study in studies]
+
+    client = ComparisonClient('bench', 'bench', save_study=False, memoize=False)
+    client.set_anchors_path(workload['anchors_path'])
+    client.set_clients_info_path(workload['clients_info_path'])
+    query_infos = [{'img_path': q, 'developer': 'Bench Inc'} for q in query_paths]
+
+    stages = {
+        'load_and_process_img': (load_and_process_img, [(q, 'query', th_, k_) for q in query_paths for th_, k_ in grid]),
+        'descriptor_matches': (descriptor_matches, pairs),
+        'other_similarities': (other_similarities, pairs),
+        'other_distances': (other_distances, pairs),
+        'color_similarities': (color_similarities, color_pairs),
+        'color_distances': (color_distances, color_pairs),
+        'create_study': (create_study, [(workload['anchors_path'], q, q.split('/')[-1]) for q in query_paths]),
+        'process_study': (process_study, [(study, 'list') for study in studies]),
+        'agg_study': (agg_study, [(study,) for study in processed]),
+        'collapse_agg': (collapse_agg, [(agg_study(study),) for study in processed]),
+        'agg_engine': (lambda study: score_study(process_rows(study)), [(study,) for study in studies]),
+        'compare_anchors_with_query': (client.compare_anchors_with_query, [(qi,) for qi in query_infos]),
+    }
+    return {name: time_stage(func, calls, repeat) for name, (func, calls) in stages.items()}
+
+
+def run(scales=tuple(SCALES), repeat=REPEAT, workdir=None, seed=0):
+    """
+    Runs the benchmark on the given scales.
+    @return: (dict) 'meta' (versions and machine) and 'results': '{stage}@{scale}' -> timings
+    """
+    results = {}
+    tmp_dir = workdir if workdir is not None else tempfile.mkdtemp(prefix='logo_bench_')
+    try:
+        for scale in scales:
+            n_anchors, n_queries = SCALES[scale]
+            timings = run_scale(f'{tmp_dir}/{scale}', n_anchors, n_queries, repeat, seed)
+            for stage, timing in timings.items():
+                results[f'{stage}@{scale}'] = timing
+                print(f"{stage}@{scale}: {timing['median'] * 1e3:.1f} ms ({timing['calls']} calls)")
+    finally:
+        if workdir is None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    meta = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'repeat': repeat,
+        'seed': seed,
+    }
+    return {'meta': meta, 'results': results}
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Compares benchmark results with a baseline.
+    @param results: (dict) result of run
+    @param baseline: (dict) result of run stored as baseline
+    @param threshold: (float) relative slowdown of the median time flagged as regression
+    @return: (list) one dict per stage in both, with keys 'stage', 'baseline', 'current', 'ratio' and 'regression'
+    """
+    rows = []
+    for stage, timing in results['results'].items():
+        if stage not in baseline['results']:
+            continue
+        base = baseline['results'][stage]['median']
+        ratio = timing['median'] / base if base > 0 else np.inf
+        rows.append({'stage': stage, 'baseline': base, 'current': timing['median'], 'ratio': ratio,
+                     'regression': ratio > 1 + threshold})
+    return rows
+
+
+def startup_times(commands=None, repeat=REPEAT):
+    """
+    Times the start of a fresh python process that imports what each entry point needs, i.e. what a cron job or a
+    health check pays before doing any work.
+    @param commands: (dict) name -> python code run with 'python -c'. Default is STARTUP_COMMANDS
+    @param repeat: (int) repetitions
+    @return: (dict) 'startup.{name}' -> timings (see time_stage)
+    """
+    commands = STARTUP_COMMANDS if commands is None else commands
+    results = {}
+    for name, code in commands.items():
+        run_command = [sys.executable, '-c', code]
+        timing = time_stage(lambda: subprocess.run(run_command, check=True, capture_output=True), [()], repeat)
+        results[f'startup.{name}'] = timing
+        print(f"startup.{name}: {timing['median'] * 1e3:.1f} ms")
+    return results
+
+
+def main(scales=tuple(SCALES), repeat=REPEAT, baseline_path=BASELINE_PATH, save_baseline=False, threshold=THRESHOLD,
+         workdir=None, startup=False):
+    """
+    Runs the benchmark and stores it as baseline or compares it with the baseline.
+    @param startup: (bool) also time the startup of the entry points (see startup_times)
+    @return: (int) exit code, 1 if a stage regressed
+    """
+    results = run(scales, repeat, workdir)
+    if startup:
+        results['results'].update(startup_times(repeat=repeat))
+    if save_baseline:
+        os.makedirs(os.path.dirname(baseline_path) or '.', exist_ok=True)
+        with open(baseline_path, 'w') as handle:
+            json.dump(results, handle, indent=2)
+        print(f'baseline stored at {baseline_path}')
+    elif os.path.exists(baseline_path):
+        with open(baseline_path, 'r') as handle:
+            baseline = json.load(handle)
+        rows = compare(results, baseline, threshold)
+        for row in rows:
+            flag = 'REGRESSION' if row['regression'] else ''
+            print(f"{row['stage']:40s} {row['baseline'] * 1e3:10.1f} ms {row['current'] * 1e3:10.1f} ms "
+                  f"x{row['ratio']:.2f} {flag}")
+        if any(row['regression'] for row in rows):
+            return 1
+    else:
+        print(f'no baseline at {baseline_path}, run with --save-baseline to store one')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the scoring stages on synthetic logos.')
+    parser.add_argument('--scales', nargs='*', default=list(SCALES), choices=list(SCALES))
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline json to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--workdir', default=None, help='dir of the synthetic workload, a temporary one by default')
+    parser.add_argument('--startup', action='store_true', help='also time the startup of the entry points')
+    args = parser.parse_args()
+
+    sys.exit(main(args.scales, args.repeat, args.baseline, args.save_baseline, args.threshold, args.workdir,
+                  args.startup))
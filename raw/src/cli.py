@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import argparse
+import datetime
+
+
+# The heavy modules (opencv, pandas, the scrapers) are imported by each command when it runs, so the startup of a
+# command only pays for what it uses. The defaults of the options live in the modules of each command.
+SERVICE_URL = 'http://127.0.0.1:8470'  # scoring_service HOST and PORT, not imported to keep the health check light
+BENCH_SCALES = ('small', 'medium', 'large')  # keys of benchmark.SCALES, not imported for the same reason
+
+
+def scrape(args):
+    """
+    Scrapes the store for the client, the logos and results are stored at the paths of the run of args.date.
+    """
+    from raw.src import scrap_stores
+    from raw.src.scrap_all_clients import job_paths
+    paths = job_paths(args.client, args.store, args.date)
+    scrap_stores.main(CLIENT=args.client,
+                      STORE=args.store,
+                      download_images_dir=paths['images_dir'],
+                      download_results_file=paths['results_file'],
+                      clean=not args.keep_previous)
+    return 0
+
+
+def score(args):
+    """
+    Scores the logos scraped for the client in the run of args.date and writes the report.
+    """
+    from raw.src.comparisson_client import ComparisonClient
+    from raw.src.report_writer import ReportWriter
+    from raw.src.profiling import profiled
+    from raw.src.scrap_all_clients import job_paths
+    from raw.src.incremental import score_incremental, save_index
+    paths = job_paths(args.client, args.store, args.date)
+    meta = {'client': args.client, 'store': args.store, 'date': args.date, 'n_workers': args.workers}
+    with profiled(args.profile, args.cprofile, meta):
+        compare_obj = ComparisonClient(client=args.client, store=args.store, n_workers=args.workers,
+                                       **_scoring_options(args))
+        query_infos = compare_obj.load_scrap_info_from_client(paths['results_file'])
+        with ReportWriter(paths['report_file'], run_id=args.date, source=paths['results_file']) as writer:
+            n_carried = 0
+            if args.incremental:
+                n_scored, n_carried = score_incremental(compare_obj, query_infos, writer, paths['results_file'])
+                save_index(compare_obj, query_infos, writer, paths['results_file'])
+            else:
+                n_scored = compare_obj.compare_stream(query_infos, writer)
+            writer.compact()
+    print(f"{n_scored} images scored, {n_carried} carried forward, report at {paths['report_file']}")
+    return 0
+
+
+def run(args):
+    """
+    Scrapes and scores several clients and stores (see scrap_all_clients.main).
+    """
+    from raw.src import scrap_all_clients
+    kwargs = _given(args, 'clients', 'stores', 'max_workers', 'max_attempts')
+    states = scrap_all_clients.main(date=args.date, options=_scoring_options(args), profile_dir=args.profile,
+                                    cprofile=args.cprofile, incremental=args.incremental, **kwargs)
+    return 0 if all(state['status'] == 'done' for state in states) else 1
+
+
+def report(args):
+    """
+    Aggregates again the stored study of a comparison run, without computing any image metric.
+    """
+    import glob
+    import re
+    from raw.src.study_store import load_run_study, run_study_path
+    from raw.src.agg_engine import score_study, to_frame
+    from raw.src.report_writer import write_report
+    run_id = args.run_id
+    if run_id is None:
+        # The run of the latest study file, the parts written by the workers end with -{pid}, and the parts not
+        # compacted yet with .part{n}.
+        pattern = run_study_path(args.client, args.store, '*')
+        paths = sorted(glob.glob(pattern), key=os.path.getmtime)
+        if not paths:
+            print(f'there is no study at {pattern}')
+            return 1
+        run_id = re.sub(r'(-\d+)?(\.part\d+)?$', '', paths[-1][len(pattern) - len('*.npz'):-len('.npz')])
+    study = load_run_study(args.client, args.store, run_id)
+    # The stored studies are already normalized by query image.
+    results = to_frame(score_study(study.to_dict('records')))
+    report_path = args.out or f'reports/{args.client}/study_report_{args.store}_{run_id}.csv'
+    write_report(results, report_path)
+    print(f'{len(results)} images of run {run_id}, report at {report_path}')
+    return 0
+
+
+def calibrate(args):
+    """
+    Score agreement and speed of the reduced fidelities w.r.t full resolution on the report of the run of args.date
+    (see study_processors_modules.fidelity_report).
+    """
+    from raw.src.study_processors_modules import fidelity_report
+    from raw.src.scrap_all_clients import job_paths
+    paths = job_paths(args.client, args.store, args.date)
+    kwargs = _given(args, 'fidelities', 'sweep')
+    if args.sweep_tol is not None:
+        kwargs['tol'] = args.sweep_tol
+    results, summary = fidelity_report(f'data/anchors/{args.client}/{args.store}', paths['report_file'],
+                                       paths['images_dir'], **kwargs)
+    print(results.to_string())
+    print(summary.to_string())
+    if args.out:
+        results.to_csv(args.out, index=False)
+    return 0
+
+
+def metrics(args):
+    """
+    Cost / benefit of the study metrics on the labeled dataset of the client, writes its metric profile (see
+    metric_profile.analyze).
+    """
+    from raw.src import metric_profile
+    return metric_profile.main(args.client, args.store, dry_run=args.dry_run,
+                               **_given(args, 'images_dir', 'tol', 'repeat'))
+
+
+def prefilter(args):
+    """
+    Calibrates the prefilter bounds with the labeled dataset of the client, writes them where the prefilter of the
+    scoring loads them (see prefilter.main).
+    """
+    from raw.src import prefilter
+    return prefilter.main(args.client, args.store, dry_run=args.dry_run, **_given(args, 'images_dir', 'margin'))
+
+
+def bench(args):
+    """
+    Runs the benchmark of the scoring stages (see benchmark.main).
+    """
+    from raw.src import benchmark
+    kwargs = _given(args, 'scales', 'repeat', 'baseline_path', 'threshold', 'workdir')
+    return benchmark.main(save_baseline=args.save_baseline, startup=args.startup, **kwargs)
+
+
+def serve(args):
+    """
+    Runs the local scoring service (see scoring_service).
+    """
+    from raw.src import scoring_service
+    service = scoring_service.ScoringService(options=_scoring_options(args),
+                                             warm=[pair.split(':', 1) for pair in args.warm],
+                                             **_given(args, 'max_workers', 'batch_size', 'batch_wait'))
+    scoring_service.serve(service=service, **_given(args, 'host', 'port'))
+    return 0
+
+
+def health(args):
+    """
+    Health check of the scoring service: exit code 0 if it answers ok, 1 if it is degraded or does not answer.
+    """
+    import urllib.error
+    import urllib.request
+    try:
+        with urllib.request.urlopen(f'{args.url}/health', timeout=args.timeout) as response:
+            print(json.dumps(json.load(response)))
+        return 0
+    except urllib.error.HTTPError as E:
+        print(E.read().decode(errors='replace'))
+        return 1
+    except (OSError, ValueError) as E:
+        print(f'scoring service not available at {args.url}: {E}')
+        return 1
+
+
+def _given(args, *names):
+    # options not set in the command line keep the defaults of the called function
+    return {name: getattr(args, name) for name in names if getattr(args, name) is not None}
+
+
+def _scoring_options(args):
+    options = _given(args, 'prefilter', 'sweep', 'sweep_tol', 'fidelity', 'metric_profile')
+    if args.no_memoize:
+        options['memoize'] = False
+    return options
+
+
+def build_parser():
+    today = str(datetime.datetime.now().date())
+    scoring = argparse.ArgumentParser(add_help=False)
+    scoring.add_argument('--no-memoize', action='store_true', help='score again the logos already in the memo')
+    scoring.add_argument('--prefilter', action='store_true', default=None, help='reject far logos with the prefilter')
+    scoring.add_argument('--sweep', default=None, choices=['exhaustive', 'adaptive'])
+    scoring.add_argument('--sweep-tol', type=float, default=None)
+    scoring.add_argument('--fidelity', default=None, choices=['full', 'half', 'quarter', 'pyramid'],
+                         help='resolution of the image metrics')
+    scoring.add_argument('--metric-profile', action='store_true', default=None,
+                         help='compute only the metrics of the client metric profile')
+
+    parser = argparse.ArgumentParser(prog='python -m raw.src.cli', description='Apk logos scraping and scoring.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('scrape', help='scrape the logos of a client in a store')
+    command.add_argument('client')
+    command.add_argument('store', choices=['appstore', 'googlePlay'])
+    command.add_argument('--date', default=today, help='run date, YYYY-MM-DD. Default is today')
+    command.add_argument('--keep-previous', action='store_true',
+                         help='keep the images and results of the previous runs, for an incremental score')
+    command.set_defaults(func=scrape)
+
+    command = commands.add_parser('score', parents=[scoring], help='score the logos scraped for a client')
+    command.add_argument('client')
+    command.add_argument('store', choices=['appstore', 'googlePlay'])
+    command.add_argument('--date', default=today, help='run date of the scrape, YYYY-MM-DD. Default is today')
+    command.add_argument('--workers', type=int, default=1)
+    command.add_argument('--profile', default=None, metavar='PATH', help='write a timing trace (json or csv)')
+    command.add_argument('--cprofile', default=None, metavar='PATH', help='dump the cProfile stats')
+    command.add_argument('--incremental', action='store_true',
+                         help='score only the results new or changed since the previous run')
+    command.set_defaults(func=score)
+
+    command = commands.add_parser('run', parents=[scoring], help='scrape and score several clients and stores')
+    command.add_argument('--clients', nargs='*', default=None, help='client names, default all')
+    command.add_argument('--stores', nargs='*', default=None)
+    command.add_argument('--date', default=today, help='run date to resume, YYYY-MM-DD. Default is today')
+    command.add_argument('--workers', type=int, default=None, dest='max_workers')
+    command.add_argument('--max-attempts', type=int, default=None)
+    command.add_argument('--profile', default=None, metavar='DIR', help='write a timing trace per job in DIR')
+    command.add_argument('--cprofile', action='store_true', help='with --profile, also dump the cProfile stats')
+    command.add_argument('--incremental', action='store_true',
+                         help='keep the previous runs and score only the new or changed results')
+    command.set_defaults(func=run)
+
+    command = commands.add_parser('report', help='aggregate again the stored study of a run')
+    command.add_argument('client')
+    command.add_argument('store', choices=['appstore', 'googlePlay'])
+    command.add_argument('run_id', nargs='?', default=None, help='run id of the study, default the latest one')
+    command.add_argument('--out', default=None, help='report path (csv or parquet)')
+    command.set_defaults(func=report)
+
+    command = commands.add_parser('calibrate', help='compare the fidelities with full resolution on a report')
+    command.add_argument('client')
+    command.add_argument('store', choices=['appstore', 'googlePlay'])
+    command.add_argument('--date', default=today, help='run date of the report images, YYYY-MM-DD. Default is today')
+    command.add_argument('--fidelities', nargs='*', default=None, choices=['half', 'quarter', 'pyramid'])
+    command.add_argument('--sweep', default=None, choices=['exhaustive', 'adaptive'])
+    command.add_argument('--sweep-tol', type=float, default=None)
+    command.add_argument('--out', default=None, help='csv with the scores and times of each image')
+    command.set_defaults(func=calibrate)
+
+    command = commands.add_parser('metrics', help='cost / benefit of the metrics on the labeled dataset of a client')
+    command.add_argument('client')
+    command.add_argument('store', choices=['appstore', 'googlePlay'])
+    command.add_argument('--images-dir', default=None, help='dir of the labeled images')
+    command.add_argument('--tol', type=float, default=None, help='max loss of AUC of the score')
+    command.add_argument('--repeat', type=int, default=None)
+    command.add_argument('--dry-run', action='store_true', help='do not write the metric profile')
+    command.set_defaults(func=metrics)
+
+    command = commands.add_parser('prefilter', help='calibrate the prefilter bounds on the labeled dataset of a client')
+    command.add_argument('client')
+    command.add_argument('store', choices=['appstore', 'googlePlay'])
+    command.add_argument('--images-dir', default=None, help='dir of the labeled images')
+    command.add_argument('--margin', type=float, default=None, help='added to the largest distance of a client logo')
+    command.add_argument('--dry-run', action='store_true', help='do not write the bounds')
+    command.set_defaults(func=prefilter)
+
+    command = commands.add_parser('bench', help='benchmark the scoring stages')
+    command.add_argument('--scales', nargs='*', default=None, choices=BENCH_SCALES)
+    command.add_argument('--repeat', type=int, default=None)
+    command.add_argument('--baseline', default=None, dest='baseline_path', help='baseline json to compare with')
+    command.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    command.add_argument('--threshold', type=float, default=None)
+    command.add_argument('--workdir', default=None)
+    command.add_argument('--startup', action='store_true', help='also time the startup of the commands')
+    command.set_defaults(func=bench)
+
+    command = commands.add_parser('serve', parents=[scoring], help='run the local scoring service')
+    command.add_argument('--host', default=None)
+    command.add_argument('--port', type=int, default=None)
+    command.add_argument('--workers', type=int, default=None, dest='max_workers')
+    command.add_argument('--batch-size', type=int, default=None)
+    command.add_argument('--batch-wait', type=float, default=None)
+    command.add_argument('--warm', nargs='*', default=[], metavar='CLIENT:STORE', help='clients loaded at start')
+    command.set_defaults(func=serve)
+
+    command = commands.add_parser('health', help='check that the scoring service answers')
+    command.add_argument('--url', default=SERVICE_URL)
+    command.add_argument('--timeout', type=float, default=5)
+    command.set_defaults(func=health)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,30 +1,82 @@
+import os
 import json
+import hashlib
 import datetime
+import argparse
 import pathlib
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-from raw.src import scrap_stores
-from raw.src.study_processors_modules import create_study, process_study
-from raw.src.study_processors_modules import agg_study, collapse_agg
+from raw.src.anchor_cache import AnchorCache, file_sha1
+from raw.src.orb_index import OrbIndex
+from raw.src.score_memo import ScoreMemo, PIPELINE_VERSION
+from raw.src.prefilter import Prefilter, PREFILTER_SCORE, prefilter_bounds_path
+from raw.src.metric_profile import load_metric_profile, metric_profile_path
+from raw.src.image_processor_modules import init_worker, load_img
+from raw.src.tensor_store import share_query_img, attach_query_img, create_run_dir, remove_run_dir
+from raw.src.report_writer import ReportWriter
+from raw.src.study_store import StudyStore, run_study_path, compact_run_study
+from raw.src.study_processors_modules import create_study, SWEEP, SWEEP_TOL, FIDELITY
+from raw.src.agg_engine import process_rows, score_study
+from raw.src.profiling import profiled, timed
 
 
 class ComparisonClient:
 
-    def __init__(self, client, store, save_study=True):
+    def __init__(self, client, store, save_study=True, n_workers=1, memoize=True, prefilter=False,
+                 sweep=SWEEP, sweep_tol=SWEEP_TOL, run_id=None, mmap=None, fidelity=FIDELITY, metric_profile=False):
         """
         Constructor for ComparisonClient class. Must be specified the client name, the web mobile application store.
-        Optional parameter is save_study to specify if all metrics are stored in 'data/misc/{client}/' dir
-        as a json file.
+        Optional parameter is save_study to specify if all metrics are stored in 'data/misc/{client}/studies/' dir
+        as a npz file per run.
         @param client: (str) Name of the client. A list of possible clients is at: files/clients.csv
         @param store: (str) Name of the store to perform the images comparison w.r.t the client anchor(s).
             possible values: 'googlePlay' or 'appstore'.
-        @param save_study: (bool) If True (default) all the metrics are stored in a json file located at
-        'data/misc/{client}/' where {client} is the name of client specified at param:client.
+        @param save_study: (bool) If True (default) all the metrics are stored in a npz file located at
+        'data/misc/{client}/studies/{store}_{run_id}.npz' where {client} is the name of client specified at
+        param:client. See study_store.load_run_study to read it.
+        @param n_workers: (int) Number of processes used by compare_queries to score the query images in parallel.
+        @param memoize: (bool) If True (default) the scores are memoized by query image content and anchor set (see
+        ScoreMemo), so a logo already scored against the same anchors is not processed again.
+        @param prefilter: (bool) If True the query images far from all the anchors according to their perceptual hashes
+        and color histogram (see Prefilter) get score PREFILTER_SCORE and 'prefiltered' True without computing their
+        study. The bounds are read from 'data/misc/{client}/{store}_prefilter.json' if it exists.
+        @param sweep: (str) sweep of the (th, k) grid used by create_study: 'exhaustive' (default) or 'adaptive'.
+        @param sweep_tol: (float) tolerance of the adaptive sweep.
+        @param run_id: (str) identifier of the run, used to name the study file. Default is the creation time.
+        @param mmap: (bool) If True the anchors and the decoded query images are kept in memory mapped files (see
+        tensor_store) that all the worker processes share, instead of one copy per worker. Default is n_workers > 1.
+        @param fidelity: (str) resolution of the image metrics used by create_study: 'full' (default), 'half', 'quarter'
+        or 'pyramid' (quarter resolution, and full resolution again only for the borderline scores).
+        @param metric_profile: (bool) If True the study computes only the metrics of the client metric profile at
+        'data/misc/{client}/{store}_metric_profile.json' (see metric_profile.analyze), all of them if it does not exist.
         """
         self.client = client
         self.store = store
         self.anchors_path = f'data/anchors/{client}/{store}'
         self.clients_info_path = 'files/clients.json'
         self.save_study = save_study
+        self.n_workers = n_workers
+        self.memoize = memoize
+        self.prefilter = prefilter
+        self.sweep = sweep
+        self.sweep_tol = sweep_tol
+        self.mmap = mmap if mmap is not None else n_workers > 1
+        # Dir where the worker processes of a run share the decoded query images, only while the run lasts.
+        self.query_tensors_dir = None
+        self.fidelity = fidelity
+        self.metric_profile = metric_profile
+        self.metrics = None
+        self.run_id = run_id if run_id is not None else datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+        self.study_store = None
+        # Worker processes write their part of the run study to their own file.
+        self.study_part = ''
+        self.anchors = None
+        self.orb_index = None
+        self.memo = None
+        self.prefilter_stage = None
+        self.developers = None
         self.qi_dict = {'name': None,
                         'developer': 'Unknown',
                         }
@@ -36,9 +88,131 @@ class ComparisonClient:
         """
 
         self.anchors_path = anchors_path
+        self.anchors = None
+        self.orb_index = None
+        self.memo = None
+        self.prefilter_stage = None
+
+    def load_anchors(self):
+        """
+        Loads the preprocessed client anchors from the anchors cache (see AnchorCache). The anchors are loaded only
+        once per ComparisonClient and reused for every query image.
+        @return: (list) preprocessed anchors
+        """
+        if self.anchors is None:
+            self.anchors = AnchorCache(self.anchors_path, mmap=self.mmap).load()
+        return self.anchors
+
+    def load_orb_index(self):
+        """
+        @return: (OrbIndex) ORB descriptors of the client anchors stacked per (th, k), built once per ComparisonClient.
+        """
+        if self.orb_index is None:
+            self.orb_index = OrbIndex(self.load_anchors())
+        return self.orb_index
+
+    def load_memo(self):
+        """
+        @return: (ScoreMemo) score memo of the client anchors, None if memoize is False.
+        """
+        if self.memoize and self.memo is None:
+            self.memo = ScoreMemo(self.load_anchors(), pipeline=self.pipeline_key())
+        return self.memo
+
+    def pipeline_key(self):
+        """
+        @return: (str) identifier of the scoring pipeline options that change the scores, used to key the score memo.
+        """
+        key = f'v{PIPELINE_VERSION}'
+        if self.sweep != 'exhaustive':
+            key += f'-{self.sweep}-{self.sweep_tol:g}'
+        if self.fidelity != 'full':
+            key += f'-{self.fidelity}'
+        if self.load_metrics() is not None:
+            key += '-metrics-' + hashlib.sha1(','.join(self.load_metrics()).encode()).hexdigest()[:8]
+        return key
+
+    def options(self):
+        """
+        @return: (dict) keyword arguments to build a ComparisonClient with the same scoring options.
+        """
+        return {'client': self.client,
+                'store': self.store,
+                'save_study': self.save_study,
+                'memoize': self.memoize,
+                'prefilter': self.prefilter,
+                'sweep': self.sweep,
+                'sweep_tol': self.sweep_tol,
+                'run_id': self.run_id,
+                'mmap': self.mmap,
+                'fidelity': self.fidelity,
+                'metric_profile': self.metric_profile,
+                }
+
+    def load_metrics(self):
+        """
+        @return: (tuple) metrics of the client metric profile, None if metric_profile is False or there is no profile.
+        """
+        if self.metric_profile and self.metrics is None:
+            self.metrics = load_metric_profile(metric_profile_path(self.client, self.store))
+        return self.metrics
+
+    def load_prefilter(self):
+        """
+        @return: (Prefilter) prefilter of the client anchors.
+        """
+        if self.prefilter_stage is None:
+            bounds_path = prefilter_bounds_path(self.client, self.store)
+            self.prefilter_stage = Prefilter.from_anchors(self.load_anchors(), bounds_path)
+        return self.prefilter_stage
+
+    def is_prefiltered(self, query_info):
+        """
+        @param query_info: (dict) query info as stored in the scrap results file.
+        @return: (bool) True if prefilter is enabled and the query image is rejected by it.
+        """
+        if not self.prefilter or not query_info.get('img_path'):
+            return False
+        query_img = self.load_query_img(query_info)
+        return query_img is not None and self.load_prefilter().rejects(query_img)
+
+    def load_query_img(self, query_info):
+        """
+        Decodes a query image. With mmap, while the query images are scored by a pool of workers (see
+        shared_query_imgs), the decoded image is shared by content in the dir of the run (see
+        tensor_store.share_query_img), so the processes of the run that need the same image (i.e. the prefilter and the
+        study) decode it only once.
+        @param query_info: (dict) query info as stored in the scrap results file.
+        @return: (np.array) BGR image, None if it could not be read
+        """
+        if not self.mmap or self.query_tensors_dir is None:
+            return load_img(query_info['img_path'])
+        try:
+            sha1 = file_sha1(query_info['img_path'])
+        except OSError:
+            return None
+        query_img = attach_query_img(sha1, self.query_tensors_dir)
+        if query_img is None:
+            query_img = load_img(query_info['img_path'])
+            if query_img is not None:
+                query_img = share_query_img(sha1, query_img, self.query_tensors_dir)
+        return query_img
+
+    def query_sha1(self, query_info):
+        """
+        @param query_info: (dict) query info as stored in the scrap results file.
+        @return: (str) sha1 of the query image, None if memoize is False or the image can not be read.
+        """
+        if not self.memoize or not query_info.get('img_path'):
+            return None
+        try:
+            return file_sha1(query_info['img_path'])
+        except OSError:
+            return None
 
     def set_clients_info_path(self, clients_info_path):
         self.clients_info_path = clients_info_path
+        self.developers = None
 
     def set_query_image_developer(self, developer):
         self.qi_dict["developer"] = developer
@@ -53,6 +227,8 @@ class ComparisonClient:
         @param store: (str) name of the app store to search in: 'googlePlay' or 'appstore'
         @param download_images_dir: (str) path where logo images are going to be stored.
         """
+        # Imported here, the scrapers (requests, BeautifulSoup) are not needed to score.
+        from raw.src import scrap_stores
         scrap_stores.main(CLIENT=client,
                           STORE=store,
                           download_images_dir=download_images_dir,
@@ -64,19 +240,39 @@ class ComparisonClient:
             scrap_info_json = json.load(h)
         return scrap_info_json
 
-    def compare_anchors_with_query(self, query_info):
+    def load_client_developers(self):
         """
-        This method computes the comparisson between a user defined image (query_img_path) pretending to be from a given
-        client and all anchors from that client located in anchors dir.
-        @param query_img_path: (str) image_path of the image intended to compare with all anchors
-        @return: (Dict) Dictionary containing all the metrics computed for the comparison between query_img and anchors
+        Loads the legitimate developers of the client for the store from the clients info file. The file is read only
+        once per ComparisonClient.
+        @return: (list) developer names
         """
+        if self.developers is None:
+            with open(self.clients_info_path, 'r') as handle:
+                client_info = json.load(handle)
+            self.developers = client_info[self.client]['developer'][self.store]
+        return self.developers
 
+    def is_valid_developer(self, developer):
+        return self.load_client_developers()[0] in developer
+
+    def query_study(self, query_info):
+        """
+        Computes and normalizes (process_rows, same as process_study) the study of a query image w.r.t all the client
+        anchors.
+        @param query_info: (dict) query info as stored in the scrap results file.
+        @return: (list) processed study rows, None if the study is empty.
+        """
         query_img_path = query_info['img_path']
-        self.qi_dict['name'] = query_img_path.split("/")[-1]
         study = create_study(anchors_path=self.anchors_path,
                              query_img_path=query_img_path,
-                             query_img_name=self.qi_dict['name'])
+                             query_img_name=query_img_path.split("/")[-1],
+                             anchors=self.load_anchors(),
+                             query_img=self.load_query_img(query_info),
+                             sweep=self.sweep,
+                             tol=self.sweep_tol,
+                             orb_index=self.load_orb_index(),
+                             fidelity=self.fidelity,
+                             metrics=self.load_metrics())
         if isinstance(study, list):
             if not study:
                 return None
@@ -84,34 +280,294 @@ class ComparisonClient:
             if study.empty:
                 return None
 
-        study = process_study(study, 'list')
+        return process_rows(study)
+
+    def write_study(self, study):
+        """
+        Appends a study to the study file of the run.
+        @param study: (list) processed study rows
+        """
+        if self.study_store is None:
+            study_path = run_study_path(self.client, self.store, self.run_id)
+            self.study_store = StudyStore(study_path.replace('.npz', f'{self.study_part}.npz'))
+        self.study_store.append(study)
+
+    def compact_study(self):
+        """
+        Merges the files written for the study of the run, by this process and by the workers, into its npz file (see
+        study_store.compact_run_study). Called once the query images of a run are scored.
+        """
         if self.save_study:
-            save_dir = f'data/misc/{self.client}'
-            pathlib.Path(save_dir).mkdir(parents=True, exist_ok=True)
-            with open(f'{save_dir}/{self.store}_study.json', 'w') as handle:
-                json.dump(study, handle)
+            compact_run_study(self.client, self.store, self.run_id)
 
-        with open(self.clients_info_path, 'r') as handle:
-            client_info = json.load(handle)
+    @timed('client.compare_anchors_with_query')
+    def compare_anchors_with_query(self, query_info):
+        """
+        This method computes the comparisson between a user defined image (query_img_path) pretending to be from a given
+        client and all anchors from that client located in anchors dir.
+        @param query_img_path: (str) image_path of the image intended to compare with all anchors
+        @return: (Dict) Dictionary containing all the metrics computed for the comparison between query_img and anchors
+        """
 
-        agg = agg_study(study)
-        collapsed_agg = collapse_agg(agg)
+        query_img_path = query_info['img_path']
+        self.qi_dict['name'] = query_img_path.split("/")[-1]
+        image_sha1 = self.query_sha1(query_info)
+        memoized = self.load_memo().get(image_sha1) if image_sha1 is not None else None
+        if memoized is not None:
+            self.qi_dict['developer'] = query_info['developer']
+            self.qi_dict['valid'] = self.is_valid_developer(self.qi_dict['developer'])
+            self.qi_dict['score'] = memoized['score']
+            if self.prefilter:
+                self.qi_dict['prefiltered'] = False
+            return self.qi_dict
+
+        if self.prefilter:
+            self.qi_dict['prefiltered'] = self.is_prefiltered(query_info)
+            if self.qi_dict['prefiltered']:
+                self.qi_dict['developer'] = query_info['developer']
+                self.qi_dict['valid'] = self.is_valid_developer(self.qi_dict['developer'])
+                self.qi_dict['score'] = PREFILTER_SCORE
+                return self.qi_dict
+
+        study = self.query_study(query_info)
+        if study is None:
+            return None
+
+        if self.save_study:
+            self.write_study(study)
+
+        scored = score_study(study).get(self.qi_dict['name'])
 
         self.qi_dict['developer'] = query_info['developer']
-        if client_info[self.client]['developer'][self.store][0] in self.qi_dict['developer']:
-            self.qi_dict['valid'] = True
-        else:
-            self.qi_dict['valid'] = False
+        self.qi_dict['valid'] = self.is_valid_developer(self.qi_dict['developer'])
 
-        score_item = collapsed_agg[collapsed_agg['name'] == self.qi_dict['name']].score
-        if score_item.empty:
+        if scored is None:
             print("There's no score found")
         else:
-            score = float(score_item)
-            self.qi_dict['score'] = score
+            self.qi_dict['score'] = scored['score']
+            if image_sha1 is not None:
+                self.load_memo().put(image_sha1, scored['score'], scored['metrics'])
 
         return self.qi_dict
 
+    def compare_query(self, query_info):
+        """
+        Same as compare_anchors_with_query, but a query image that can not be scored does not raise: a result with
+        score NaN and the reason in 'error' is returned instead.
+        @param query_info: (dict) query info as stored in the scrap results file.
+        @return: (Dict) copy of the results of compare_anchors_with_query.
+        """
+        try:
+            results = self.compare_anchors_with_query(query_info=query_info)
+            if results is None:
+                raise ValueError('empty study')
+            return dict(results)
+        except Exception as E:
+            print(f"Couldn't score {query_info.get('img_path')}: {E}")
+            return self._failed_result(query_info, E)
+
+    def compare_queries(self, query_infos):
+        """
+        Scores a list of query images. With n_workers > 1 the images are spread across a pool of processes, each one
+        loading the client anchors once. The results are returned in the same order as query_infos, and an image that
+        fails gets a result with score NaN instead of stopping the batch.
+        @param query_infos: (list) query infos as stored in the scrap results file.
+        @return: (list) One results dictionary per query info.
+        """
+        results = []
+        for query_info, result in zip(query_infos, self._map_queries('compare_query', query_infos)):
+            if isinstance(result, Exception):
+                print(f"Couldn't score {query_info.get('img_path')}: {result}")
+                result = self._failed_result(query_info, result)
+            results.append(result)
+        self.compact_study()
+        return results
+
+    def compare_many(self, query_infos):
+        """
+        Scores all the query images of a run together. The client info and anchors are loaded once, the study of the
+        whole run is stored once (if save_study) and aggregated in a single pass. With memoize, the images already scored
+        against the same anchors take their results from the memo and only the new ones are processed (and stored in
+        the run study). With prefilter, the images rejected by the prefilter are not processed either.
+        @param query_infos: (list) query infos as stored in the scrap results file.
+        @return: (pd.DataFrame) One row per query info, in the same order, with columns name, developer, valid, score
+        and the aggregated metrics (and prefiltered, with prefilter). Images that could not be scored get score NaN and
+        the reason in column 'error'.
+        """
+        self.load_client_developers()
+        image_sha1s = [self.query_sha1(query_info) for query_info in query_infos]
+        memo = self.load_memo() if any(image_sha1s) else None
+        memoized = [memo.get(image_sha1) if image_sha1 is not None else None for image_sha1 in image_sha1s]
+        # The query images decoded by the prefilter are shared with the workers that compute their study.
+        with self.shared_query_imgs():
+            prefiltered = [item is None and self.is_prefiltered(query_info)
+                           for query_info, item in zip(query_infos, memoized)]
+            pending = [query_info for query_info, item, rejected in zip(query_infos, memoized, prefiltered)
+                       if item is None and not rejected]
+            pending_studies = iter(self._map_queries('query_study', pending))
+        studies = [item if item is not None or rejected else next(pending_studies)
+                   for item, rejected in zip(memoized, prefiltered)]
+
+        run_study = []
+        for study in studies:
+            if isinstance(study, list):
+                run_study.extend(study)
+        if self.save_study and run_study:
+            self.write_study(run_study)
+            self.compact_study()
+
+        # The rows are grouped by query, two query images with the same name (from different dirs) are scored apart.
+        scored = score_study(run_study, keys=[str(ii) for ii, study in enumerate(studies) if isinstance(study, list)
+                                              for _ in study])
+
+        rows = []
+        for ii, (query_info, study, item, image_sha1, rejected) in enumerate(zip(query_infos, studies, memoized,
+                                                                                 image_sha1s, prefiltered)):
+            if study is None and not rejected:
+                study = ValueError('empty study')
+            if rejected:
+                row = {'name': query_info['img_path'].split("/")[-1],
+                       'developer': query_info['developer'],
+                       'score': PREFILTER_SCORE,
+                       }
+            elif isinstance(study, Exception):
+                print(f"Couldn't score {query_info.get('img_path')}: {study}")
+                row = self._failed_result(query_info, study)
+            elif item is not None:
+                row = {'name': query_info['img_path'].split("/")[-1],
+                       'developer': query_info['developer'],
+                       'score': item['score'],
+                       } | item['metrics']
+            else:
+                row = {'name': query_info['img_path'].split("/")[-1],
+                       'developer': query_info['developer'],
+                       'score': scored[str(ii)]['score'],
+                       } | scored[str(ii)]['metrics']
+                if image_sha1 is not None:
+                    memo.put(image_sha1, scored[str(ii)]['score'], scored[str(ii)]['metrics'])
+            if self.prefilter:
+                row['prefiltered'] = rejected
+            row['valid'] = self.is_valid_developer(row['developer'])
+            rows.append(row)
+
+        results = pd.DataFrame(rows)
+        first_columns = ['name', 'developer', 'valid', 'score']
+        return results[first_columns + [col for col in results.columns if col not in first_columns]]
+
+    @timed('client.score_query')
+    def score_query(self, query_info):
+        """
+        Scores a query image on its own.
+        @param query_info: (dict) query info as stored in the scrap results file.
+        @return: (dict) The row of compare_many for the query image.
+        """
+        name = query_info['img_path'].split("/")[-1]
+        image_sha1 = self.query_sha1(query_info)
+        memoized = self.load_memo().get(image_sha1) if image_sha1 is not None else None
+        rejected = memoized is None and self.is_prefiltered(query_info)
+        if memoized is not None:
+            score, metrics = memoized['score'], memoized['metrics']
+        elif rejected:
+            score, metrics = PREFILTER_SCORE, {}
+        else:
+            study = self.query_study(query_info)
+            if study is None:
+                raise ValueError('empty study')
+            if self.save_study:
+                self.write_study(study)
+            name_scored = score_study(study).get(name)
+            if name_scored is None:
+                raise ValueError('no score found')
+            score, metrics = name_scored['score'], name_scored['metrics']
+            if image_sha1 is not None:
+                self.load_memo().put(image_sha1, score, metrics)
+
+        row = {'name': name,
+               'developer': query_info['developer'],
+               'valid': self.is_valid_developer(query_info['developer']),
+               'score': score,
+               } | metrics
+        if self.prefilter:
+            row['prefiltered'] = rejected
+        return row
+
+    def compare_stream(self, query_infos, writer):
+        """
+        Scores a list of query images writing each result to writer as soon as it is available, instead of keeping
+        them in memory. The query images already in the stream of writer (written by an interrupted run) are skipped.
+        @param query_infos: (list) query infos as stored in the scrap results file.
+        @param writer: (ReportWriter) sink of the results.
+        @return: (int) number of query images scored.
+        """
+        written = writer.written_names()
+        pending = [query_info for query_info in query_infos
+                   if (query_info.get('img_path') or '').split("/")[-1] not in written]
+        for query_info, row in zip(pending, self._imap_queries('score_query', pending)):
+            if isinstance(row, Exception):
+                print(f"Couldn't score {query_info.get('img_path')}: {row}")
+                row = self._failed_result(query_info, row)
+                row['valid'] = self.is_valid_developer(row['developer'])
+            writer.write(row)
+        self.compact_study()
+        return len(pending)
+
+    def _map_queries(self, method, query_infos):
+        """
+        Calls the method named 'method' for each query info, in a pool of n_workers processes if n_workers > 1.
+        @return: (list) The result of each call in the same order as query_infos, or the exception it raised.
+        """
+        return list(self._imap_queries(method, query_infos))
+
+    def _imap_queries(self, method, query_infos):
+        """
+        Same as _map_queries, but the results are yielded one by one, as soon as they are available in order.
+        """
+        if self.n_workers <= 1 or len(query_infos) <= 1:
+            for query_info in query_infos:
+                try:
+                    yield getattr(self, method)(query_info)
+                except Exception as E:
+                    yield E
+            return
+
+        # Build the anchors cache before starting the workers, so they only read it.
+        self.load_anchors()
+        with self.shared_query_imgs():
+            initargs = (self.options(), self.anchors_path, self.clients_info_path, self.query_tensors_dir)
+            with ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker,
+                                     initargs=initargs) as executor:
+                futures = [executor.submit(_call_in_worker, method, query_info) for query_info in query_infos]
+                for future in futures:
+                    try:
+                        yield future.result()
+                    except Exception as E:
+                        yield E
+
+    @contextmanager
+    def shared_query_imgs(self):
+        """
+        With mmap and n_workers > 1, the query images decoded while the block runs, by this process or by the workers
+        started in it, are shared in a dir of the run (see tensor_store.create_run_dir) that is removed at the end.
+        """
+        if not self.mmap or self.n_workers <= 1 or self.query_tensors_dir is not None:
+            yield
+            return
+        self.query_tensors_dir = create_run_dir(self.run_id)
+        try:
+            yield
+        finally:
+            remove_run_dir(self.query_tensors_dir)
+            self.query_tensors_dir = None
+
+    @staticmethod
+    def _failed_result(query_info, error):
+        img_path = query_info.get('img_path') or ''
+        return {'name': img_path.split("/")[-1],
+                'developer': query_info.get('developer', 'Unknown'),
+                'score': np.nan,
+                'error': repr(error),
+                }
+
     def save_matches_results(self, qi_dict, save_dir=None):
         """
         Use this method to store the dictionary containing the metrics obtained for the comparison of each image in the
@@ -131,34 +587,55 @@ class ComparisonClient:
         results_df.to_csv(f'{save_dir}/{matches_filename}.csv', index=False)
 
 
+_WORKER_CLIENT = None
+
+
+def _init_worker(options, anchors_path, clients_info_path, query_tensors_dir):
+    global _WORKER_CLIENT
+    init_worker()
+    _WORKER_CLIENT = ComparisonClient(**options)
+    _WORKER_CLIENT.study_part = f'-{os.getpid()}'
+    _WORKER_CLIENT.set_anchors_path(anchors_path)
+    _WORKER_CLIENT.set_clients_info_path(clients_info_path)
+    _WORKER_CLIENT.query_tensors_dir = query_tensors_dir
+    _WORKER_CLIENT.load_anchors()
+
+
+def _call_in_worker(method, query_info):
+    return getattr(_WORKER_CLIENT, method)(query_info)
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scrape and score the client of client_query.json.')
+    parser.add_argument('--profile', default=None, metavar='PATH',
+                        help='write a timing trace of the run, csv if PATH ends with .csv and json otherwise')
+    parser.add_argument('--cprofile', default=None, metavar='PATH', help='dump the cProfile stats of the run at PATH')
+    args = parser.parse_args()
+
     print("*"*50 + "\n" + "Start")
     with open("client_query.json", "r") as file_h:
         client_query = json.load(file_h)
 
     CLIENT = client_query["client"]
     STORE = client_query["store"]
+    N_WORKERS = client_query.get("n_workers", 1)
 
     DATE = str(datetime.datetime.now().date())
     DIR_OF_QUERIES_IMGS = f'data/scrap/{STORE}/{CLIENT}/images/{DATE}'
     PATH_SCRAP_INFO_JSON = f'data/scrap/{STORE}/{CLIENT}/query_results/{DATE}.json'
 
-    compare_obj = ComparisonClient(client=CLIENT, store=STORE)
-    compare_obj.save_scrap_info_from_client(client=CLIENT,
-                                            store=STORE,
-                                            download_images_dir=DIR_OF_QUERIES_IMGS,
-                                            download_results_file=PATH_SCRAP_INFO_JSON)
-    all_results = []
-    full_results = []
-    # open json with query info and load the corresponding image using it
-    scrap_info_json = compare_obj.load_scrap_info_from_client(PATH_SCRAP_INFO_JSON)
-    for query_info in scrap_info_json:
-        results = compare_obj.compare_anchors_with_query(query_info=query_info)
-        new_results = dict(results)
-        all_results.append(new_results)
-
-
-    save_dir = f'reports/{CLIENT}'
-    pathlib.Path(save_dir).mkdir(parents=True, exist_ok=True)
-    pd.DataFrame(all_results).to_csv(f'{save_dir}/scrapped_images_vs_anchors_{STORE}.csv', index=False)
+    # Only the spans of this process are recorded, profile with n_workers 1 to see the scoring stages.
+    with profiled(args.profile, args.cprofile, {'client': CLIENT, 'store': STORE, 'n_workers': N_WORKERS}):
+        compare_obj = ComparisonClient(client=CLIENT, store=STORE, n_workers=N_WORKERS)
+        compare_obj.save_scrap_info_from_client(client=CLIENT,
+                                                store=STORE,
+                                                download_images_dir=DIR_OF_QUERIES_IMGS,
+                                                download_results_file=PATH_SCRAP_INFO_JSON)
+        # open json with query info and load the corresponding image using it
+        scrap_info_json = compare_obj.load_scrap_info_from_client(PATH_SCRAP_INFO_JSON)
+        # Each result is streamed to disk as soon as it is scored, the report is compacted from the stream at the end.
+        with ReportWriter(f'reports/{CLIENT}/scrapped_images_vs_anchors_{STORE}.csv', run_id=DATE,
+                          source=PATH_SCRAP_INFO_JSON) as writer:
+            compare_obj.compare_stream(scrap_info_json, writer)
+            writer.compact()
     print("*" * 50 + "\n" + "END")
\ No newline at end of file
@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import pathlib
+import threading
+
+
+CACHE_DIR = 'data/http_cache'
+MAX_SIZE = 512 * 1024 ** 2  # bytes
+# Seconds a cached response is used without asking the server. After that it is revalidated with a conditional GET.
+TTL = {
+    'search': 0,
+    'page': 24 * 3600,
+    'image': 7 * 24 * 3600,
+}
+
+
+class HttpCache:
+
+    def __init__(self, cache_dir=CACHE_DIR, max_size=MAX_SIZE, ttl=None):
+        """
+        On disk cache of http responses. Bodies are stored with their ETag / Last-Modified headers, and once their time
+        to live (per resource type) expires they are revalidated with a conditional GET, so an unchanged resource costs
+        a 304 response instead of the whole body. When the cache grows over max_size the least recently used responses
+        are evicted. The size is measured on the body files on disk, so the files of other processes sharing the
+        cache_dir (and the ones left by an interrupted scrap) are counted too.
+        @param cache_dir: (str) dir where the responses are stored.
+        @param max_size: (int) max size in bytes of the stored bodies.
+        @param ttl: (dict) resource type -> seconds. Updates the defaults in TTL.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.ttl = TTL | (ttl or {})
+        self.index_path = f'{cache_dir}/index.json'
+        self.lock = threading.Lock()
+        self.stats = {'fresh': 0, 'revalidated': 0, 'downloaded': 0}
+        self.index = self._read_index()
+        self.size = None  # bytes of the body files, measured on disk by the first evict
+
+    def fetch(self, session, url, resource_type='page', timeout=None):
+        """
+        GETs an url through the cache.
+        @param session: (requests.Session) session used for the requests to the server.
+        @param url: (str) url to get.
+        @param resource_type: (str) one of the keys of ttl, defines how long the response is used without revalidation.
+        @param timeout: (float) seconds to wait for the server.
+        @return: (bytes) body of the response.
+        """
+        key = hashlib.sha1(url.encode()).hexdigest()
+        with self.lock:
+            entry = self.index.get(key)
+        body = self._read_body(key) if entry is not None else None
+        if body is None:
+            entry = None
+
+        now = time.time()
+        if entry is not None and now - entry['stored_at'] < self.ttl.get(resource_type, 0):
+            with self.lock:
+                entry['last_access'] = now
+                self.stats['fresh'] += 1
+            return body
+
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        response = session.get(url, headers=headers, timeout=timeout)
+
+        if response.status_code == 304 and entry is not None:
+            with self.lock:
+                entry['stored_at'] = now
+                entry['last_access'] = now
+                self.stats['revalidated'] += 1
+            return body
+
+        response.raise_for_status()
+        body = response.content
+        replaced = self._write_body(key, body)
+        with self.lock:
+            if self.size is not None:
+                self.size += len(body) - replaced
+            self.index[key] = {
+                'url': url,
+                'resource_type': resource_type,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'stored_at': now,
+                'last_access': now,
+                'size': len(body),
+            }
+            self.stats['downloaded'] += 1
+        self.evict()
+        return body
+
+    def evict(self):
+        """
+        Removes the least recently used responses until the cache size is under max_size. The size is kept up to date
+        with the bodies written by this process and measured again on disk when it goes over max_size, the body files
+        not in the index (written by another process or by an interrupted one) are ordered by their mtime.
+        """
+        with self.lock:
+            if self.size is not None and self.size <= self.max_size:
+                return
+            files = self._scan_bodies()
+            self.size = sum(size for size, _ in files.values())
+            if self.size <= self.max_size:
+                return
+            last_access = {key: self.index[key]['last_access'] if key in self.index else mtime
+                           for key, (_, mtime) in files.items()}
+            for key in sorted(files, key=last_access.get):
+                self.index.pop(key, None)
+                try:
+                    os.unlink(self._body_path(key))
+                except FileNotFoundError:
+                    pass
+                self.size -= files[key][0]
+                if self.size <= self.max_size:
+                    break
+
+    def save(self):
+        """
+        Writes the cache index to disk. Call it once the scrap is done. The index on disk is read again under a file
+        lock and merged with the one of this process (the latest stored / accessed entry of each url wins), so
+        processes sharing the cache_dir do not drop the entries of each other. The entries whose body file was evicted
+        are left out.
+        """
+        pathlib.Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        with self.lock, open(f'{self.index_path}.lock', 'w') as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_EX)
+            index = self._read_index()
+            for key, entry in self.index.items():
+                other = index.get(key)
+                if other is None or other['stored_at'] <= entry['stored_at']:
+                    index[key] = entry | {'last_access': max(entry['last_access'], (other or entry)['last_access'])}
+                else:
+                    other['last_access'] = max(entry['last_access'], other['last_access'])
+            self.index = {key: entry for key, entry in index.items() if os.path.exists(self._body_path(key))}
+            tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as handle:
+                json.dump(self.index, handle)
+            os.replace(tmp_path, self.index_path)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, 'r') as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return {}
+
+    def _scan_bodies(self):
+        """
+        @return: (dict) key -> (size, mtime) of the body files on disk.
+        """
+        files = {}
+        for sub_dir in pathlib.Path(self.cache_dir).glob('??'):
+            for path in sub_dir.iterdir():
+                if path.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                files[path.name] = (stat.st_size, stat.st_mtime)
+        return files
+
+    def _body_path(self, key):
+        return f'{self.cache_dir}/{key[:2]}/{key}'
+
+    def _read_body(self, key):
+        try:
+            with open(self._body_path(key), 'rb') as handle:
+                return handle.read()
+        except OSError:
+            return None
+
+    def _write_body(self, key, body):
+        """
+        @return: (int) size of the body replaced, 0 if there was none.
+        """
+        body_path = self._body_path(key)
+        try:
+            replaced = os.path.getsize(body_path)
+        except OSError:
+            replaced = 0
+        pathlib.Path(body_path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f'{body_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as handle:
+            handle.write(body)
+        os.replace(tmp_path, body_path)
+        return replaced
@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+TIMEOUT = 10  # seconds
+RETRIES = 3
+BACKOFF = 0.5  # seconds, doubled on each retry
+MAX_WORKERS = 8
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def create_session(retries=RETRIES, backoff=BACKOFF, pool_size=MAX_WORKERS):
+    """
+    Creates a requests session with a connection pool shared by all its requests, retrying failed GETs with
+    exponential backoff.
+    :param retries: (int) max number of retries of a request
+    :param backoff: (float) backoff factor in seconds between retries
+    :param pool_size: (int) max number of connections kept open per host
+    :return session: (requests.Session)
+    """
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUS)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch(url, session=None, timeout=TIMEOUT, cache=None, resource_type='page'):
+    """
+    GETs an url.
+    :param url: (str) url to get
+    :param session: (requests.Session) session to use, a new one is created if None
+    :param timeout: (float) seconds to wait for the server
+    :param cache: (HttpCache) if given the response is served from / stored in this cache
+    :param resource_type: (str) resource type of the url for the cache time to live: 'search', 'page' or 'image'
+    :return content: (bytes) body of the response
+    """
+    session = session if session is not None else create_session()
+    if cache is not None:
+        return cache.fetch(session, url, resource_type, timeout)
+    response = session.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+
+def fetch_all(urls, session=None, timeout=TIMEOUT, max_workers=MAX_WORKERS, cache=None, resource_type='page'):
+    """
+    GETs a list of urls concurrently, at most max_workers at the same time, sharing the connections of session.
+    :param urls: (list) urls to get
+    :param session: (requests.Session) session to use, a new one is created if None
+    :param timeout: (float) seconds to wait for the server
+    :param max_workers: (int) max number of concurrent requests
+    :param cache: (HttpCache) if given the responses are served from / stored in this cache
+    :param resource_type: (str) resource type of the urls for the cache time to live
+    :return contents: (list) body of each response in the same order as urls, None for the ones that failed
+    """
+    session = session if session is not None else create_session(pool_size=max_workers)
+
+    def _fetch(url):
+        try:
+            return fetch(url, session, timeout, cache, resource_type)
+        except requests.RequestException as E:
+            print(f"Couldn't get {url}: {E}")
+            return None
+
+    if not urls:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_fetch, urls))
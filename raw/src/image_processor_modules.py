@@ -1,8 +1,48 @@
+import threading
 import cv2
 import numpy as np
-import sewar.full_ref
+from raw.src.metric_engine import compute_metrics
 
 
+SIMILARITY_METRICS = ('ssim_sim', 'uqi_sim', 'msssim_sim', 'scc_sim', 'vifp_sim')
+DISTANCE_METRICS = ('rmse_dist', 'ergas_dist', 'sam_dist')
+ORB_METRICS = ('orb_matches_sim', 'orb_mean_dist')
+COLOR_METRICS = ('color_corr_sim', 'color_int_sim', 'color_chi2_dist', 'color_helli_dist')
+
+
+THRESHOLDS = tuple(range(90, 230, 10))  # (90, 215, 5)
+KERNELS = tuple(range(3, 9, 2))  # (3, 13, 2)
+RATIO = 0.75  # ratio test of the ORB matches
+# Working resolution of the image metrics: downscale factor of the processed variants.
+FIDELITIES = {'full': 1, 'half': 2, 'quarter': 4}
+
+# ORB detector reused by each thread (see orb_detector)
+_orb_objects = threading.local()
+
+
+def param_grid(thresholds=THRESHOLDS, kernels=KERNELS):
+    """
+    (th, k) combinations in the order used by the study: thresholds in the outer loop and kernels in the inner one.
+    :param thresholds: (iterable) thresholds in [0, 255]
+    :param kernels: (iterable) odd kernel sizes
+    :return grid: (list) list of (th, k) tuples
+    """
+    return [(th, k) for th in thresholds for k in kernels]
+
+
+def crop_img(image):
+    """
+    Removes the 18px border of the store logos.
+    :param image: (np.array) image to crop
+    :return image: (np.array) cropped image. An empty black image if no image was loaded.
+    """
+    try:
+        image = image[18:-18, 18:-18]
+    except TypeError:
+        image = np.zeros((256, 256, 3), np.uint8)[18:-18, 18:-18]
+        print('no image loaded')
+    return image
+
 def process_img(image, img_role, th, k, IMSHOW, keep_color=False):
     """
     Processes an image using opencv methods.
@@ -14,11 +54,7 @@ def process_img(image, img_role, th, k, IMSHOW, keep_color=False):
     :param keep_color: (bool) to process images with color or not
     :return thresh: (np.array) processed image
     """
-    try:
-        image = image[18:-18, 18:-18]
-    except TypeError:
-        image = np.zeros((256, 256, 3), np.uint8)[18:-18, 18:-18]
-        print('no image loaded')
+    image = crop_img(image)
 
     if not keep_color:
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -38,124 +74,205 @@ def process_img(image, img_role, th, k, IMSHOW, keep_color=False):
     return thresh
 
 
-def load_and_process_img(img_path, img_role, th, k, keep_color=False):
+def threshold_sweep(blurred, thresholds=THRESHOLDS):
+    """
+    Binarizes a blurred gray image with all the thresholds at once. Equivalent to apply cv2.threshold with
+    cv2.THRESH_BINARY_INV for each threshold.
+    :param blurred: (np.array) uint8 gray image (H, W)
+    :param thresholds: (iterable) thresholds in [0, 255]
+    :return thresh: (np.array) uint8 tensor (n_th, H, W)
+    """
+    ths = np.asarray(thresholds, dtype=np.int16).reshape(-1, 1, 1)
+    return (blurred[np.newaxis] <= ths).astype(np.uint8) * np.uint8(255)
+
+
+def process_img_grid(image, thresholds=THRESHOLDS, kernels=KERNELS):
+    """
+    Processes an image for the whole (th, k) grid. The blur is computed once per kernel and all the thresholds are
+    applied to it in a single vectorized operation.
+    :param image: (np.array) BGR image to process
+    :param thresholds: (iterable) thresholds in [0, 255]
+    :param kernels: (iterable) odd kernel sizes
+    :return thresh: (np.array) uint8 tensor (n_th * n_k, H, W), one binarized variant per param_grid item
+    """
+    gray = cv2.cvtColor(crop_img(image), cv2.COLOR_BGR2GRAY)
+    sweeps = [threshold_sweep(cv2.GaussianBlur(gray, (k, k), 0), thresholds) for k in kernels]
+    thresh = np.stack(sweeps, axis=1)
+    return thresh.reshape((-1,) + gray.shape)
+
+
+def process_color_grid(image, kernels=KERNELS):
+    """
+    Color processing of an image for each kernel (the color variants do not depend on the threshold).
+    :param image: (np.array) BGR image to process
+    :param kernels: (iterable) odd kernel sizes
+    :return blurred: (np.array) uint8 tensor (n_k, H, W, 3)
+    """
+    rgb = cv2.cvtColor(crop_img(image), cv2.COLOR_BGR2RGB)
+    return np.stack([cv2.GaussianBlur(rgb, (k, k), 0) for k in kernels])
+
+
+def downscale_grid(imgs, factor):
+    """
+    Reduces the resolution of a batch of processed images, averaging each factor x factor block (cv2.INTER_AREA), so
+    the binarized variants become gray images that keep the position of their edges.
+    :param imgs: (np.array) uint8 tensor (n, H, W)
+    :param factor: (int) downscale factor, a value of FIDELITIES
+    :return scaled: (np.array) uint8 tensor (n, H // factor, W // factor), imgs itself if factor is 1
+    """
+    if factor == 1:
+        return imgs
+    size = (imgs.shape[2] // factor, imgs.shape[1] // factor)
+    return np.stack([cv2.resize(img, size, interpolation=cv2.INTER_AREA) for img in imgs])
+
+
+def init_worker():
+    """
+    Initializer of the worker processes that score images. The processes already run in parallel (one per core), so
+    opencv should not spawn its own threads.
+    """
+    cv2.setNumThreads(1)
+
+
+def load_img(img_path):
+    """
+    Loads (decodes) an image from disk.
+    :param img_path: (str) path of image to load
+    :return img: (np.array) BGR image, None if it could not be read
+    """
+    return cv2.imread(img_path)
+
+
+def load_and_process_img(img, img_role, th, k, keep_color=False):
     """
     Loads and processes an image.
-    :param img_path: (str) path of image to process
+    :param img: (str or np.array) path of image to process, or the image already decoded with load_img
     :param img_role: (str) anchor or query
     :param th: (int) in [0, 255]
     :param k: odd (int)
     :return processed_img: (np.array) processed image
     """
     IMSHOW = False
-    img = cv2.imread(img_path)
+    if isinstance(img, str):
+        img = load_img(img)
     processed_img = process_img(img, img_role, th, k, IMSHOW, keep_color)
     return processed_img
 
 
-def descriptor_matches(anchor_img, query_img):
+def orb_descriptors(img):
     """
-    Computes ORB descriptors and their statistics.
-    :param anchor_img: (np.array) image to compare against
-    :param query_img: (np.array) image to compare
-    :return n_matches: (int) number of ORB matched key points between images
-    :return distance_mean: (float) mean distance of matched key points
+    Computes the ORB descriptors of an image.
+    :param img: (np.array) processed image
+    :return des: (np.array) ORB descriptors, None if no key point was found
     """
-    orb = cv2.ORB_create()
-    anchor_kp, anchor_des = orb.detectAndCompute(anchor_img, None)
-    query_kp, query_des = orb.detectAndCompute(query_img, None)
+    _, des = orb_detector().detectAndCompute(img, None)
+    return des
 
-    bf = cv2.BFMatcher(cv2.NORM_HAMMING)
 
-    try:
-        matches = bf.knnMatch(anchor_des, query_des, k=2)
-        good_to_continue = True
-    except Exception as E:
-        print(f"Couldn't get matches: {E}")
-        matches = [['not', 'good']]
-        good_to_continue = False
-
-    if not good_to_continue:
-        n_matches = 0
-        distance_mean = np.nan
-    else:
-        good_matches = []
-        for tup in matches:
-            if len(tup) != 2:
-                continue
-            m, n = tup
-            if m.distance < (0.75 * n.distance):
-                good_matches.append([m])
+def orb_detector():
+    """
+    ORB detector of the current thread, created once and reused by every call of orb_descriptors.
+    :return orb: (cv2.ORB) detector
+    """
+    if not hasattr(_orb_objects, 'detector'):
+        _orb_objects.detector = cv2.ORB_create()
+    return _orb_objects.detector
 
-        n_matches = len(good_matches)
-        distance_mean = np.mean([m[0].distance for m in good_matches])
 
-    return n_matches, distance_mean
+def knn_distances(anchor_des, query_des):
+    """
+    Distances of each anchor descriptor to its two nearest query descriptors, the ones of BFMatcher.knnMatch(anchor_des,
+    query_des, k=2), as arrays.
+    :param anchor_des: (np.array) ORB descriptors (n, 32)
+    :param query_des: (np.array) ORB descriptors (m, 32)
+    :return distances: (np.array) float hamming distances (n, 2), sorted by row. None if there are less than two query
+    descriptors (no descriptor passes the ratio test).
+    """
+    if anchor_des is None or query_des is None or len(query_des) < 2:
+        return None
+    if len(anchor_des) == 0:
+        return np.zeros((0, 2))
+    distances, _ = cv2.batchDistance(anchor_des, query_des, cv2.CV_32S, normType=cv2.NORM_HAMMING, K=2)
+    return distances.astype(np.float64)
 
 
-def other_similarities(anchor_img, query_img):
+def ratio_test(distances, ratio=RATIO):
+    """
+    Lowe's ratio test over knn_distances, vectorized.
+    :param distances: (np.array) distances (n, 2) to the nearest and second nearest descriptor
+    :param ratio: (float) max ratio between the nearest and the second nearest distance
+    :return good: (np.array) bool mask of the good matches
+    """
+    return distances[:, 0] < ratio * distances[:, 1]
 
-    try:
-        ssim_sim = np.mean(sewar.full_ref.ssim(anchor_img, query_img))
-    except:
-        ssim_sim = (np.nan, np.nan)
-    try:
-        uqi_sim = sewar.full_ref.uqi(anchor_img, query_img)
-    except:
-        uqi_sim = np.nan
-    try:
-        msssim_sim = sewar.full_ref.msssim(anchor_img, query_img)
-    except:
-        msssim_sim = np.nan
-    try:
-        scc_sim = sewar.full_ref.scc(anchor_img, query_img)
-    except:
-        scc_sim = np.nan
-    try:
-        vifp_sim = sewar.full_ref.vifp(anchor_img, query_img)
-    except:
-        vifp_sim = np.nan
 
-    similarities = {
-        'ssim_sim': np.mean(ssim_sim),
-        'uqi_sim': uqi_sim,
-        'msssim_sim': abs(msssim_sim),
-        'scc_sim': scc_sim,
-        'vifp_sim': vifp_sim,
-    }
+def match_descriptors(anchor_des, query_des):
+    """
+    Matches two sets of ORB descriptors and computes their statistics.
+    :param anchor_des: (np.array) ORB descriptors of the image to compare against
+    :param query_des: (np.array) ORB descriptors of the image to compare
+    :return n_matches: (int) number of ORB matched key points between images
+    :return distance_mean: (float) mean distance of matched key points
+    """
+    distances = knn_distances(anchor_des, query_des)
+    if distances is None:
+        return 0, np.nan
+    good = distances[ratio_test(distances), 0]
+    n_matches = len(good)
+    distance_mean = good.mean() if n_matches else np.nan
+    return n_matches, distance_mean
 
-    return similarities
+
+def descriptor_matches(anchor_img, query_img):
+    """
+    Computes ORB descriptors and their statistics.
+    :param anchor_img: (np.array) image to compare against
+    :param query_img: (np.array) image to compare
+    :return n_matches: (int) number of ORB matched key points between images
+    :return distance_mean: (float) mean distance of matched key points
+    """
+    return match_descriptors(orb_descriptors(anchor_img), orb_descriptors(query_img))
+
+
+def other_similarities(anchor_img, query_img):
+    """
+    Similarity metrics between two processed images (ssim, uqi, msssim, scc and vifp) computed with metric_engine.
+    :param anchor_img: (np.array) image to compare against
+    :param query_img: (np.array) image to compare
+    :return similarities: (dict) metric name -> value, NaN if the images can not be compared.
+    """
+    metrics = compute_metrics(anchor_img, query_img, metrics=SIMILARITY_METRICS)
+    return {metric: metrics[metric] for metric in SIMILARITY_METRICS}
 
 
 def other_distances(anchor_img, query_img):
-    try:
-        rmse_dist = sewar.full_ref.rmse(anchor_img, query_img)
-    except:
-        rmse_dist = np.nan
-    try:
-        ergas_dist = sewar.full_ref.ergas(anchor_img, query_img)
-    except:
-        ergas_dist = np.nan
-    try:
-        sam_dist = sewar.full_ref.sam(anchor_img, query_img)
-    except:
-        sam_dist = np.nan
+    """
+    Distance metrics between two processed images (rmse, ergas and sam) computed with metric_engine.
+    :param anchor_img: (np.array) image to compare against
+    :param query_img: (np.array) image to compare
+    :return distances: (dict) metric name -> value, NaN if the images can not be compared.
+    """
+    metrics = compute_metrics(anchor_img, query_img, metrics=DISTANCE_METRICS)
+    return {metric: metrics[metric] for metric in DISTANCE_METRICS}
 
-    distances = {
-        'rmse_dist': rmse_dist,
-        'ergas_dist': ergas_dist,
-        'sam_dist': sam_dist,
-    }
 
-    return distances
+def color_hist(img):
+    """
+    Computes the normalized 10x10x10 color histogram used by the color metrics.
+    :param img: (np.array) color processed image
+    :return hist: (np.array) flattened histogram
+    """
+    hist = cv2.calcHist([img], [0, 1, 2], None, [10, 10, 10], [0, 256, 0, 256, 0, 256])
+    return cv2.normalize(hist, hist).flatten()
 
 
 def color_compare(anchor_img, query_img, type):
-    anchor_hist = cv2.calcHist([anchor_img], [0, 1, 2], None, [10, 10, 10])
-    anchor_hist = cv2.normalize(anchor_hist, anchor_hist).flatten()
-
-    query_hist = cv2.calcHist([query_img], [0, 1, 2], None, [10, 10, 10])
-    query_hist = cv2.normalize(query_hist, query_hist).flatten()
+    """
+    Compares the color histograms of two images. Any of the images can be replaced by its histogram, as returned by
+    color_hist, to avoid computing it again.
+    """
+    anchor_hist = anchor_img if anchor_img.ndim == 1 else color_hist(anchor_img)
+    query_hist = query_img if query_img.ndim == 1 else color_hist(query_img)
 
     if type == 'sim':
         methods = {
@@ -0,0 +1,127 @@
+import os
+import re
+import glob
+import json
+import pathlib
+from raw.src.anchor_cache import file_sha1
+from raw.src.report_writer import read_stream
+from raw.src.score_memo import anchor_set_sha1
+
+
+def index_path(results_file):
+    """
+    @param results_file: (str) scrap results file of a run, 'data/scrap/{store}/{client}/query_results/{date}.json'
+    @return: (str) path of the run index, next to the results file
+    """
+    return re.sub(r'\.json$', '.index.json', results_file)
+
+
+def entry_key(query_info):
+    """
+    @param query_info: (dict) query info as stored in the scrap results file.
+    @return: (str) identifier of the app of a search result across runs, None if it has no url.
+    """
+    return query_info.get('app_url') or query_info.get('img_url')
+
+
+def image_sha1(query_info):
+    try:
+        return file_sha1(query_info['img_path'])
+    except (OSError, KeyError, TypeError):
+        return None
+
+
+def run_key(compare_obj):
+    """
+    @param compare_obj: (ComparisonClient) client that scores the run.
+    @return: (str) identifier of the anchors and scoring options of a run. The scores of a previous run are carried
+    forward only if it is the same.
+    """
+    key = f'{anchor_set_sha1(compare_obj.load_anchors())}-{compare_obj.pipeline_key()}'
+    return key + '-prefilter' if compare_obj.prefilter else key
+
+
+def load_previous_index(results_file, key):
+    """
+    Index of the latest run before the one of results_file, in the same query_results dir.
+    @param results_file: (str) scrap results file of the current run.
+    @param key: (str) run_key of the current run.
+    @return: (dict) entry_key -> {'developer', 'img_sha1', 'row'}, {} if there is no previous run with the same key.
+    """
+    current = os.path.basename(results_file)[:-len('.json')]
+    previous = sorted(path for path in glob.glob(index_path(f'{os.path.dirname(results_file)}/*.json'))
+                      if os.path.basename(path)[:-len('.index.json')] < current)
+    if not previous:
+        return {}
+    try:
+        with open(previous[-1], 'r') as handle:
+            index = json.load(handle)
+    except (OSError, ValueError):
+        return {}
+    return index['entries'] if index.get('key') == key else {}
+
+
+def diff_results(query_infos, previous):
+    """
+    Compares the search results of a run with the index of the previous one, by app url, developer and image hash.
+    @param query_infos: (list) query infos as stored in the scrap results file.
+    @param previous: (dict) result of load_previous_index.
+    @return: (list, list) query infos new or changed since the previous run, and (query info, previous row) of the
+    unchanged ones.
+    """
+    pending, carried = [], []
+    for query_info in query_infos:
+        entry = previous.get(entry_key(query_info))
+        sha1 = image_sha1(query_info) if entry is not None else None
+        if sha1 is not None and entry['img_sha1'] == sha1 and entry['developer'] == query_info.get('developer'):
+            carried.append((query_info, entry['row']))
+        else:
+            pending.append(query_info)
+    return pending, carried
+
+
+def score_incremental(compare_obj, query_infos, writer, results_file):
+    """
+    Scores only the search results new or changed since the previous run, the rows of the unchanged ones are carried
+    forward from the previous run (with name and valid of the current run). All of them are written to writer.
+    @param compare_obj: (ComparisonClient) client that scores the run.
+    @param query_infos: (list) query infos as stored in the scrap results file.
+    @param writer: (ReportWriter) sink of the results.
+    @param results_file: (str) scrap results file of the run.
+    @return: (int, int) number of query images scored and carried forward.
+    """
+    previous = load_previous_index(results_file, run_key(compare_obj))
+    pending, carried = diff_results(query_infos, previous)
+    written = writer.written_names()
+    for query_info, row in carried:
+        name = query_info['img_path'].split("/")[-1]
+        if name not in written:
+            writer.write(row | {'name': name, 'valid': compare_obj.is_valid_developer(row['developer'])})
+    n_scored = compare_obj.compare_stream(pending, writer)
+    return n_scored, len(carried)
+
+
+def save_index(compare_obj, query_infos, writer, results_file):
+    """
+    Writes the index of the run, read by the next incremental run. Call it before compacting writer, it is built
+    from the rows of its stream. The query images that could not be scored are left out, so they are scored again.
+    @param compare_obj: (ComparisonClient) client that scored the run.
+    @param query_infos: (list) query infos as stored in the scrap results file.
+    @param writer: (ReportWriter) sink of the results of the run.
+    @param results_file: (str) scrap results file of the run.
+    """
+    rows = {row.get('name'): row for row in read_stream(writer.stream_path)}
+    entries = {}
+    for query_info in query_infos:
+        key = entry_key(query_info)
+        row = rows.get((query_info.get('img_path') or '').split("/")[-1])
+        sha1 = image_sha1(query_info)
+        if key is None or row is None or row.get('error') is not None or sha1 is None:
+            continue
+        entries[key] = {'developer': query_info.get('developer'), 'img_sha1': sha1, 'row': row}
+
+    path = index_path(results_file)
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(f'{path}.{os.getpid()}.tmp', 'w') as handle:
+        json.dump({'key': run_key(compare_obj), 'entries': entries}, handle)
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
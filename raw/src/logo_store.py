@@ -0,0 +1,88 @@
+import os
+import hashlib
+import pathlib
+import shutil
+import tempfile
+import threading
+
+
+OBJECTS_DIR = 'data/logos'
+
+
+def content_sha1(content):
+    """
+    Computes the sha1 hash of some bytes.
+    @param content: (bytes) content to hash
+    @return: (str) hex digest of the content
+    """
+    return hashlib.sha1(content).hexdigest()
+
+
+def object_path(sha1, objects_dir=OBJECTS_DIR):
+    """
+    Path of the stored logo with the given content hash.
+    @param sha1: (str) hex digest of the logo content
+    @param objects_dir: (str) dir of the logo store
+    @return: (str) path of the logo in the store
+    """
+    return f'{objects_dir}/{sha1[:2]}/{sha1}.png'
+
+
+def store_image(content, image_path, objects_dir=OBJECTS_DIR):
+    """
+    Stores a logo by its content hash and makes image_path a hard link to it, so the same logo scrapped every day (or
+    by several apps) is kept only once on disk. If the file system does not support hard links image_path is a copy.
+    The files at image_path must be treated as read only, since they share the content with the store.
+    @param content: (bytes) logo content
+    @param image_path: (str) path where the logo is expected, i.e. 'data/scrap/{store}/{client}/images/{DATE}/{app}.png'
+    @param objects_dir: (str) dir of the logo store
+    @return: (str) sha1 hex digest of the logo
+    """
+    sha1 = store_object(content, objects_dir)
+    link_image(object_path(sha1, objects_dir), image_path)
+    return sha1
+
+
+def store_object(content, objects_dir=OBJECTS_DIR):
+    """
+    Stores a logo by its content hash, without any reference to it (see store_image).
+    @param content: (bytes) logo content
+    @param objects_dir: (str) dir of the logo store
+    @return: (str) sha1 hex digest of the logo, its path is object_path(sha1)
+    """
+    sha1 = content_sha1(content)
+    obj_path = object_path(sha1, objects_dir)
+    if not os.path.exists(obj_path):
+        _write_atomic(obj_path, content)
+    return sha1
+
+
+def link_image(obj_path, image_path):
+    """
+    Points image_path to a logo of the store, replacing whatever was at image_path.
+    @param obj_path: (str) path of the logo in the store
+    @param image_path: (str) path of the reference
+    @return: None
+    """
+    dir_name = os.path.dirname(image_path) or '.'
+    pathlib.Path(dir_name).mkdir(parents=True, exist_ok=True)
+    tmp_path = f'{image_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.link(obj_path, tmp_path)
+    except OSError:
+        shutil.copyfile(obj_path, tmp_path)
+    os.replace(tmp_path, image_path)
+
+
+def _write_atomic(path, content):
+    dir_name = os.path.dirname(path) or '.'
+    pathlib.Path(dir_name).mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            handle.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,353 @@
+import cv2
+import numpy as np
+from raw.src.profiling import span
+
+
+METRICS = ('ssim_sim', 'uqi_sim', 'msssim_sim', 'scc_sim', 'vifp_sim', 'rmse_dist', 'ergas_dist', 'sam_dist')
+
+MAX_VALUE = 255  # uint8 images
+SSIM_WS = 11
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+MSSSIM_WEIGHTS = np.array([0.0448, 0.2856, 0.3001, 0.2363, 0.1333])
+UQI_WS = 8
+SCC_WS = 8
+ERGAS_WS = 8
+ERGAS_R = 4
+VIFP_SIGMA_NSQ = 2
+VIFP_EPS = 1e-10
+
+
+def gaussian_taps(ws, sigma):
+    """
+    1-D taps of the normalized gaussian window used by sewar (fspecial). The 2-D window is their outer product.
+    :param ws: (int) odd window size
+    :param sigma: (float) standard deviation
+    :return taps: (np.array) normalized 1-D gaussian taps
+    """
+    x = np.arange(-(ws // 2), ws // 2 + 1, dtype=np.float64)
+    taps = np.exp(-(x ** 2) / (2.0 * sigma ** 2))
+    return taps / taps.sum()
+
+
+def integral(x):
+    """
+    Integral images of a batch of images.
+    :param x: (np.array) float64 batch (n, H, W)
+    :return ii: (np.array) integral images (n, H + 1, W + 1)
+    """
+    return np.stack([cv2.integral(im, sdepth=cv2.CV_64F) for im in x])
+
+
+def box_sums(ii, ws):
+    """
+    Sums over every ws x ws window fully inside the image ('valid' windows), computed from integral images. For
+    integer valued images the sums are exact.
+    :param ii: (np.array) integral images (n, H + 1, W + 1)
+    :param ws: (int) window size
+    :return sums: (np.array) window sums (n, H - ws + 1, W - ws + 1)
+    """
+    return ii[:, ws:, ws:] - ii[:, :-ws, ws:] - ii[:, ws:, :-ws] + ii[:, :-ws, :-ws]
+
+
+def correlate_valid(x, taps):
+    """
+    Separable 'valid' correlation of a batch of images with the outer product of taps. Images smaller than the window
+    follow scipy's convolve2d (used by sewar), which swaps the arguments: the window slides over the image.
+    :param x: (np.array) float64 batch (n, H, W)
+    :param taps: (np.array) 1-D symmetric taps of size k
+    :return out: (np.array) filtered batch (n, |H - k| + 1, |W - k| + 1)
+    """
+    k = len(taps)
+    if x.shape[1] < k and x.shape[2] < k:
+        windows = np.lib.stride_tricks.sliding_window_view(np.outer(taps, taps), x.shape[1:])
+        return np.einsum('nhw,ijhw->nij', x, windows)[:, ::-1, ::-1]
+    r = k // 2
+    return np.stack([cv2.sepFilter2D(im, cv2.CV_64F, taps, taps)[r:-r, r:-r] for im in x])
+
+
+def _ssim_maps(mu1, mu2, s11, s22, s12, c1, c2):
+    mu12 = mu1 * mu2
+    sigma1_sq = s11 - mu1 * mu1
+    sigma2_sq = s22 - mu2 * mu2
+    sigma12 = s12 - mu12
+    ssim_map = ((2 * mu12 + c1) * (2 * sigma12 + c2)) / ((mu1 * mu1 + mu2 * mu2 + c1) * (sigma1_sq + sigma2_sq + c2))
+    cs_map = (2 * sigma12 + c2) / (sigma1_sq + sigma2_sq + c2)
+    return ssim_map.mean(axis=(1, 2)), cs_map.mean(axis=(1, 2))
+
+
+def _gaussian_stats(x, y, taps, prods=None):
+    if prods is None:
+        prods = {'xx': x * x, 'yy': y * y, 'xy': x * y}
+    return (correlate_valid(x, taps), correlate_valid(y, taps), correlate_valid(prods['xx'], taps),
+            correlate_valid(prods['yy'], taps), correlate_valid(prods['xy'], taps))
+
+
+def _msssim(x, y, prods, c1, c2, weights=MSSSIM_WEIGHTS):
+    taps = gaussian_taps(SSIM_WS, 1.5)
+    mssim = []
+    mcs = []
+    for scale in range(len(weights)):
+        if scale > 0:
+            # sewar downsamples with a 2x2 mean filter (reflected border) and keeps the even pixels.
+            x, y = [_half(im) for im in (x, y)]
+            prods = None
+        _ssim, _cs = _ssim_maps(*_gaussian_stats(x, y, taps, prods), c1, c2)
+        mssim.append(_ssim)
+        mcs.append(_cs)
+
+    mcs = np.abs(np.stack(mcs[:-1], axis=1)) ** weights[:-1]
+    # sewar returns a complex power, its modulus is the product of the moduli.
+    return np.prod(mcs, axis=1) * np.abs(mssim[-1]) ** weights[-1]
+
+
+def _half(x):
+    padded = np.concatenate([x[:, :1], x], axis=1)
+    x = (padded[:, :-1] + padded[:, 1:]) / 2
+    padded = np.concatenate([x[:, :, :1], x], axis=2)
+    x = (padded[:, :, :-1] + padded[:, :, 1:]) / 2
+    return x[:, ::2, ::2]
+
+
+def _vifp(x, y, prods):
+    num = np.zeros(x.shape[0])
+    den = np.zeros(x.shape[0])
+    for scale in range(1, 5):
+        ws = 2 ** (4 - scale + 1) + 1
+        taps = gaussian_taps(ws, ws / 5)
+        if scale > 1:
+            x = correlate_valid(x, taps)[:, ::2, ::2]
+            y = correlate_valid(y, taps)[:, ::2, ::2]
+            prods = None
+
+        mu1, mu2, s11, s22, s12 = _gaussian_stats(x, y, taps, prods)
+        sigma1_sq = s11 - mu1 * mu1
+        sigma2_sq = s22 - mu2 * mu2
+        sigma12 = s12 - mu1 * mu2
+        sigma1_sq[sigma1_sq < 0] = 0
+        sigma2_sq[sigma2_sq < 0] = 0
+
+        g = sigma12 / (sigma1_sq + VIFP_EPS)
+        sv_sq = sigma2_sq - g * sigma12
+
+        idx = sigma1_sq < VIFP_EPS
+        g[idx] = 0
+        sv_sq[idx] = sigma2_sq[idx]
+        sigma1_sq[idx] = 0
+
+        idx = sigma2_sq < VIFP_EPS
+        g[idx] = 0
+        sv_sq[idx] = 0
+
+        idx = g < 0
+        sv_sq[idx] = sigma2_sq[idx]
+        g[idx] = 0
+        sv_sq[sv_sq <= VIFP_EPS] = VIFP_EPS
+
+        num += np.log10(1.0 + (g ** 2.) * sigma1_sq / (sv_sq + VIFP_SIGMA_NSQ)).sum(axis=(1, 2))
+        den += np.log10(1.0 + sigma1_sq / VIFP_SIGMA_NSQ).sum(axis=(1, 2))
+
+    return num / den
+
+
+def _scc_highpass(x):
+    # generic_laplace with the 3x3 [-1 .. 8 .. -1] window adds the same correlation for both axes.
+    padded = np.pad(x, ((0, 0), (1, 1), (1, 1)), mode='symmetric')
+    box3 = box_sums(integral(padded), 3)
+    return 2 * (9 * x - box3)
+
+
+def _scc(x, y):
+    x_hp = _scc_highpass(x)
+    y_hp = _scc_highpass(y)
+    # 'same' uniform filter with zero border: the window of pixel i spans [i - 4, i + 3].
+    pad = ((0, 0), (SCC_WS // 2, SCC_WS // 2 - 1), (SCC_WS // 2, SCC_WS // 2 - 1))
+    n = SCC_WS ** 2
+    mu1 = box_sums(integral(np.pad(x_hp, pad)), SCC_WS) / n
+    mu2 = box_sums(integral(np.pad(y_hp, pad)), SCC_WS) / n
+    sigma1_sq = box_sums(integral(np.pad(x_hp * x_hp, pad)), SCC_WS) / n - mu1 * mu1
+    sigma2_sq = box_sums(integral(np.pad(y_hp * y_hp, pad)), SCC_WS) / n - mu2 * mu2
+    sigma12 = box_sums(integral(np.pad(x_hp * y_hp, pad)), SCC_WS) / n - mu1 * mu2
+
+    sigma1_sq[sigma1_sq < 0] = 0
+    sigma2_sq[sigma2_sq < 0] = 0
+    den = np.sqrt(sigma1_sq) * np.sqrt(sigma2_sq)
+    idx = den == 0
+    den[idx] = 1
+    scc = sigma12 / den
+    scc[idx] = 0
+    return scc.mean(axis=(1, 2))
+
+
+def _uqi(sx, sy, sxx, syy, sxy):
+    # sewar's uqi mixes window means with N = ws ** 2, the formula is kept as is for parity.
+    n = UQI_WS ** 2
+    mu1, mu2, mu11, mu22, mu12 = [s[:, :-1, :-1] / n for s in (sx, sy, sxx, syy, sxy)]
+    mu1_mu2 = mu1 * mu2
+    mu_sq_sum = mu1 * mu1 + mu2 * mu2
+    numerator = 4 * (n * mu12 - mu1_mu2) * mu1_mu2
+    denominator1 = n * (mu11 + mu22) - mu_sq_sum
+    denominator = denominator1 * mu_sq_sum
+
+    q_map = np.ones(denominator.shape)
+    index = np.logical_and(denominator1 == 0, mu_sq_sum != 0)
+    q_map[index] = 2 * mu1_mu2[index] / mu_sq_sum[index]
+    index = denominator != 0
+    q_map[index] = numerator[index] / denominator[index]
+    return q_map.mean(axis=(1, 2))
+
+
+def _ergas(sx, sxx, syy, sxy):
+    n = ERGAS_WS ** 2
+    rmse_map = np.sqrt((sxx + syy - 2 * sxy)[:, :-1, :-1] / n)
+    means_map = sx[:, :-1, :-1] / n / n
+    idx = means_map == 0
+    means_map[idx] = 1
+    rmse_map[idx] = 0
+    ergas_map = 100 * ERGAS_R * np.sqrt((rmse_map ** 2) / (means_map ** 2))
+    return ergas_map.mean(axis=(1, 2))
+
+
+def _batch_metrics(x, y, metrics, msssim_skip=0):
+    results = {}
+    prods = {'xx': x * x, 'yy': y * y, 'xy': x * y}
+    n_pixels = x.shape[1] * x.shape[2]
+    c1 = (SSIM_K1 * MAX_VALUE) ** 2
+    c2 = (SSIM_K2 * MAX_VALUE) ** 2
+
+    if {'ssim_sim', 'uqi_sim', 'ergas_dist'} & set(metrics):
+        with span('metric.integral'):
+            ii = {'x': integral(x), 'y': integral(y)} | {key: integral(value) for key, value in prods.items()}
+        if 'ssim_sim' in metrics:
+            with span('metric.ssim'):
+                sums = [box_sums(ii[key], SSIM_WS) / SSIM_WS ** 2 for key in ('x', 'y', 'xx', 'yy', 'xy')]
+                _ssim, _cs = _ssim_maps(*sums, c1, c2)
+                results['ssim_sim'] = (_ssim + _cs) / 2
+        if 'uqi_sim' in metrics or 'ergas_dist' in metrics:
+            with span('metric.uqi_ergas'):
+                sx, sy, sxx, syy, sxy = [box_sums(ii[key], UQI_WS) for key in ('x', 'y', 'xx', 'yy', 'xy')]
+                if 'uqi_sim' in metrics:
+                    results['uqi_sim'] = _uqi(sx, sy, sxx, syy, sxy)
+                if 'ergas_dist' in metrics:
+                    results['ergas_dist'] = _ergas(sx, sxx, syy, sxy)
+    if 'msssim_sim' in metrics:
+        with span('metric.msssim'):
+            weights = MSSSIM_WEIGHTS
+            if msssim_skip:
+                weights = MSSSIM_WEIGHTS[msssim_skip:] / MSSSIM_WEIGHTS[msssim_skip:].sum()
+            results['msssim_sim'] = _msssim(x, y, prods, c1, c2, weights)
+    if 'scc_sim' in metrics:
+        with span('metric.scc'):
+            results['scc_sim'] = _scc(x, y)
+    if 'vifp_sim' in metrics:
+        with span('metric.vifp'):
+            results['vifp_sim'] = _vifp(x, y, prods)
+
+    if 'rmse_dist' in metrics or 'sam_dist' in metrics:
+        totals = {key: value.sum(axis=(1, 2)) for key, value in prods.items()}
+        if 'rmse_dist' in metrics:
+            results['rmse_dist'] = np.sqrt((totals['xx'] + totals['yy'] - 2 * totals['xy']) / n_pixels)
+        if 'sam_dist' in metrics:
+            val = totals['xy'] / (np.sqrt(totals['xx']) * np.sqrt(totals['yy']))
+            results['sam_dist'] = np.arccos(np.clip(val, -1, 1))
+
+    return results
+
+
+def compute_metrics(anchor_imgs, query_imgs, metrics=METRICS, chunk_size=8, msssim_skip=0):
+    """
+    Computes the sewar similarity and distance metrics (ssim, uqi, msssim, scc, vifp, rmse, ergas and sam) for one pair
+    or a batch of pairs of gray images. All the metrics share the same window statistics, computed once from integral
+    images (box windows) or separable gaussian filters. Values follow sewar 0.4.5 as used in other_similarities and
+    other_distances, ssim_sim being the mean of ssim and cs, and msssim_sim the modulus of msssim.
+    :param anchor_imgs: (np.array) gray image (H, W) or batch of gray images (n, H, W)
+    :param query_imgs: (np.array) gray image (H, W) or batch of gray images (n, H, W)
+    :param metrics: (iterable) metrics to compute, a subset of METRICS
+    :param chunk_size: (int) number of pairs processed at the same time, bounds the memory used.
+    :param msssim_skip: (int) finest msssim scales skipped, for images already downscaled by 2 ** msssim_skip. The
+    remaining scales keep their relative weights.
+    :return results: (dict) metric name -> float for a single pair, or np.array (n,) for a batch. NaN when the images
+    can not be compared: different shapes, or smaller than SSIM_WS (where sewar still returns values from partial
+    windows). The coarse msssim and vifp scales smaller than their window follow sewar.
+    """
+    anchor_imgs = np.asarray(anchor_imgs)
+    query_imgs = np.asarray(query_imgs)
+    single = anchor_imgs.ndim == 2
+    if single:
+        anchor_imgs = anchor_imgs[np.newaxis]
+        query_imgs = query_imgs[np.newaxis]
+    n = anchor_imgs.shape[0]
+
+    if anchor_imgs.shape != query_imgs.shape or anchor_imgs.ndim != 3 or min(anchor_imgs.shape[1:]) < SSIM_WS:
+        results = {metric: np.full(n, np.nan) for metric in metrics}
+    else:
+        chunks = []
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for start in range(0, n, chunk_size):
+                x = anchor_imgs[start:start + chunk_size].astype(np.float64)
+                y = query_imgs[start:start + chunk_size].astype(np.float64)
+                chunks.append(_batch_metrics(x, y, metrics, msssim_skip))
+        results = {metric: np.concatenate([chunk[metric] for chunk in chunks]) for metric in metrics}
+
+    if single:
+        return {metric: float(values[0]) for metric, values in results.items()}
+    return results
+
+
+def sewar_parity(anchor_imgs, query_imgs):
+    """
+    Compares compute_metrics with the sewar implementations used originally in other_similarities and
+    other_distances. Requires sewar to be installed.
+    :param anchor_imgs: (np.array) batch of gray images (n, H, W)
+    :param query_imgs: (np.array) batch of gray images (n, H, W)
+    :return max_abs_diff: (dict) metric name -> max absolute difference between both implementations over the batch
+    """
+    import sewar.full_ref
+
+    def msssim_abs(a, q):
+        return abs(sewar.full_ref.msssim(a, q))
+
+    reference = {
+        'ssim_sim': lambda a, q: np.mean(sewar.full_ref.ssim(a, q)),
+        'uqi_sim': sewar.full_ref.uqi,
+        'msssim_sim': msssim_abs,
+        'scc_sim': sewar.full_ref.scc,
+        'vifp_sim': sewar.full_ref.vifp,
+        'rmse_dist': sewar.full_ref.rmse,
+        'ergas_dist': sewar.full_ref.ergas,
+        'sam_dist': sewar.full_ref.sam,
+    }
+    engine = compute_metrics(anchor_imgs, query_imgs)
+    max_abs_diff = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for metric, func in reference.items():
+            expected = np.array([func(a, q) for a, q in zip(anchor_imgs, query_imgs)], dtype=np.float64)
+            diff = np.abs(engine[metric] - expected)
+            diff[np.isnan(engine[metric]) & np.isnan(expected)] = 0
+            diff[np.isinf(engine[metric]) & (engine[metric] == expected)] = 0
+            max_abs_diff[metric] = float(np.max(diff)) if len(diff) else 0.0
+    return max_abs_diff
+
+
+if __name__ == '__main__':
+    import os
+    import argparse
+    from raw.src.image_processor_modules import load_img, process_img_grid
+
+    parser = argparse.ArgumentParser(description='Parity of metric_engine against sewar on the anchor logos of a dir')
+    parser.add_argument('anchors_path', help='dir with the anchor logos, i.e. data/anchors/{client}/{store}')
+    parser.add_argument('--tol', type=float, default=1e-6, help='max absolute difference allowed')
+    args = parser.parse_args()
+
+    names = sorted([ai for ai in os.listdir(args.anchors_path) if ai.endswith('.png')])
+    grids = {name: process_img_grid(load_img(f'{args.anchors_path}/{name}')) for name in names}
+    failed = False
+    for aname in names:
+        for qname in names:
+            max_abs_diff = sewar_parity(grids[aname], grids[qname])
+            worst = max(max_abs_diff.values())
+            print(f'{aname} vs {qname}: max abs diff {worst:.3g}')
+            if worst > args.tol:
+                failed = True
+                print(max_abs_diff)
+    raise SystemExit(1 if failed else 0)
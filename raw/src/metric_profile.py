@@ -0,0 +1,235 @@
+import sys
+import json
+import time
+import pathlib
+import argparse
+import numpy as np
+import pandas as pd
+from raw.src.anchor_cache import AnchorCache
+from raw.src.orb_index import OrbIndex
+from raw.src.metric_engine import compute_metrics
+from raw.src.agg_engine import AGG_COLUMNS, process_rows, score_study
+from raw.src.image_processor_modules import THRESHOLDS, KERNELS, ORB_METRICS, COLOR_METRICS
+from raw.src.image_processor_modules import SIMILARITY_METRICS, DISTANCE_METRICS
+from raw.src.image_processor_modules import load_img, process_img_grid, process_color_grid
+from raw.src.image_processor_modules import orb_descriptors, color_hist, color_similarities, color_distances
+from raw.src.study_processors_modules import create_study, STUDY_METRICS
+
+
+AUC_TOL = 0.01  # max loss of AUC of the score allowed when a metric is left out
+MIN_METRICS = 3
+# Metrics computed together, they are kept or left out as a group.
+METRIC_GROUPS = [ORB_METRICS] + [(metric,) for metric in SIMILARITY_METRICS + DISTANCE_METRICS] + [COLOR_METRICS]
+
+
+def metric_profile_path(client, store):
+    return f'data/misc/{client}/{store}_metric_profile.json'
+
+
+def load_metric_profile(path):
+    """
+    @param path: (str) json file written by analyze.
+    @return: (tuple) metric columns of the profile, to pass to create_study. None if the file does not exist.
+    """
+    try:
+        with open(path, 'r') as handle:
+            return tuple(json.load(handle)['metrics'])
+    except FileNotFoundError:
+        return None
+
+
+def auc(values, labels):
+    """
+    Area under the ROC curve of values as a predictor of labels (Mann-Whitney U, ties count one half).
+    @param values: (iterable) float values, NaN are left out
+    @param labels: (iterable) bool labels
+    @return: (float) AUC, NaN if there are no values of one of the labels
+    """
+    values = np.asarray(values, dtype=np.float64)
+    labels = np.asarray(labels, dtype=bool)
+    known = ~np.isnan(values)
+    values, labels = values[known], labels[known]
+    n_pos = labels.sum()
+    n_neg = len(labels) - n_pos
+    if not n_pos or not n_neg:
+        return np.nan
+    ranks = pd.Series(values).rank().to_numpy()
+    return float((ranks[labels].sum() - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg))
+
+
+def labeled_metrics(anchors_path, images_dir, train_ds):
+    """
+    Computes the full study of each labeled image and aggregates it as the score does (process_rows, then mean or max
+    of each metric over the anchors and (th, k)).
+    @param anchors_path: (str) Path of the client anchors.
+    @param images_dir: (str) dir of the labeled images.
+    @param train_ds: (dict) image name -> owned (bool), as written by utils.create_train_ds.
+    @return: (pd.DataFrame) One row per image found with columns name, owned and one per metric of STUDY_METRICS.
+    """
+    anchors = AnchorCache(anchors_path).load()
+    orb_index = OrbIndex(anchors)
+    rows = []
+    for name, owned in train_ds.items():
+        query_img = load_img(f'{images_dir}/{name}') if name.endswith('.png') else None
+        if query_img is None:
+            continue
+        study = process_rows(create_study(anchors_path, f'{images_dir}/{name}', name, anchors=anchors,
+                                          query_img=query_img, orb_index=orb_index))
+        scored = score_study(study)
+        if not scored:
+            continue
+        row = {'name': name, 'owned': bool(owned)} | next(iter(scored.values()))['metrics']
+        # The color metrics are not aggregated by the score, their mean over the study is used instead.
+        row = row | {metric: np.nanmean([study_row[metric] for study_row in study]) for metric in COLOR_METRICS}
+        rows.append(row)
+    return pd.DataFrame(rows, columns=['name', 'owned'] + list(STUDY_METRICS))
+
+
+def metric_costs(anchors_path, query_img_paths, repeat=3):
+    """
+    Runtime of each metric per (anchor, query variant) pair, measured on its own over the whole (th, k) grid. The
+    metrics of a group of METRIC_GROUPS get the runtime of the group.
+    @param anchors_path: (str) Path of the client anchors.
+    @param query_img_paths: (list) Paths of the query images.
+    @param repeat: (int) the best of repeat runs is kept.
+    @return: (dict) metric -> seconds per pair
+    """
+    anchors = AnchorCache(anchors_path).load()
+    orb_index = OrbIndex(anchors)
+    queries = [load_img(path) for path in query_img_paths]
+    queries = [(process_img_grid(img, THRESHOLDS, KERNELS), process_color_grid(img, KERNELS))
+               for img in queries if img is not None]
+    n_pairs = len(anchors) * len(queries) * len(THRESHOLDS) * len(KERNELS)
+
+    def orb(qimgs, _):
+        for ii, qimg in enumerate(qimgs):
+            orb_index.match(ii, orb_descriptors(qimg))
+
+    def color(_, qcimgs):
+        qhists = [color_hist(qcimg) for qcimg in qcimgs]
+        for anchor in anchors:
+            for _ in THRESHOLDS:
+                for kk, qhist in enumerate(qhists):
+                    color_similarities(anchor['hist'][kk], qhist)
+                    color_distances(anchor['hist'][kk], qhist)
+
+    def image_metric(metric):
+        def run(qimgs, _):
+            for anchor in anchors:
+                compute_metrics(anchor['gray'], qimgs, metrics=(metric,))
+        return run
+
+    runs = {ORB_METRICS: orb, COLOR_METRICS: color}
+    costs = {}
+    for group in METRIC_GROUPS:
+        run = runs.get(group) or image_metric(group[0])
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for qimgs, qcimgs in queries:
+                run(qimgs, qcimgs)
+            best = min(best, time.perf_counter() - start)
+        costs = costs | {metric: best / n_pairs for metric in group}
+    return costs
+
+
+def select_metrics(metrics_df, costs, tol=AUC_TOL, min_metrics=MIN_METRICS):
+    """
+    Backward selection of the metrics of the score: the most expensive group whose removal keeps the AUC of the score
+    within tol of the AUC with all the metrics is left out, until no group can be. The color metrics are not part of
+    the score, so they are always left out.
+    @param metrics_df: (pd.DataFrame) result of labeled_metrics
+    @param costs: (dict) result of metric_costs
+    @param tol: (float) max loss of AUC
+    @param min_metrics: (int) min number of metrics kept
+    @return: (list, float, float) selected metrics, AUC of the score with the selected metrics and with all of them
+    """
+    def score_auc(metrics):
+        # The score is the mean of the aggregated metrics (see agg_engine.collapse).
+        return auc(metrics_df[list(metrics)].mean(axis=1), metrics_df['owned'])
+
+    groups = [group for group in METRIC_GROUPS if set(group) <= set(AGG_COLUMNS)]
+    full_auc = score_auc(AGG_COLUMNS)
+    removed = True
+    while removed:
+        removed = False
+        for group in sorted(groups, key=lambda group: -costs[group[0]]):
+            kept = [metric for other in groups if other != group for metric in other]
+            if len(kept) >= min_metrics and score_auc(kept) >= full_auc - tol:
+                groups.remove(group)
+                removed = True
+                break
+    selected = [metric for metric in STUDY_METRICS if any(metric in group for group in groups)]
+    return selected, score_auc(selected), full_auc
+
+
+def analyze(anchors_path, images_dir, train_ds, profile_path=None, tol=AUC_TOL, repeat=3):
+    """
+    Cost / benefit of each metric on a labeled dataset (see utils.create_train_ds): its runtime per pair and its AUC
+    separating the client logos from the other ones. Recommends the cheapest set of metrics that keeps the AUC of the
+    score (see select_metrics) and writes it as a metric profile that ComparisonClient(..., metric_profile=True) passes
+    to create_study.
+    @param anchors_path: (str) Path of the client anchors.
+    @param images_dir: (str) dir of the labeled images.
+    @param train_ds: (dict) image name -> owned (bool).
+    @param profile_path: (str) if given the profile is stored in this json file.
+    @param tol: (float) max loss of AUC of the score.
+    @param repeat: (int) repeats of the runtime measure.
+    @return: (pd.DataFrame, dict) One row per metric with its auc, cost (seconds per pair), and selected. And the
+    profile with keys 'metrics', 'auc', 'full_auc', 'cost', 'full_cost' (seconds per pair), 'n_owned' and 'n_other'.
+    """
+    metrics_df = labeled_metrics(anchors_path, images_dir, train_ds)
+    costs = metric_costs(anchors_path, [f'{images_dir}/{name}' for name in metrics_df['name']], repeat)
+    selected, selected_auc, full_auc = select_metrics(metrics_df, costs, tol)
+
+    table = pd.DataFrame({'metric': list(STUDY_METRICS),
+                          'auc': [auc(metrics_df[metric], metrics_df['owned']) for metric in STUDY_METRICS],
+                          'cost': [costs[metric] for metric in STUDY_METRICS],
+                          'selected': [metric in selected for metric in STUDY_METRICS]})
+    # The cost of a group is counted once.
+    group_cost = {group: costs[group[0]] for group in METRIC_GROUPS}
+    profile = {'metrics': selected,
+               'auc': selected_auc,
+               'full_auc': full_auc,
+               'cost': sum(cost for group, cost in group_cost.items() if group[0] in selected),
+               'full_cost': sum(group_cost.values()),
+               'n_owned': int(metrics_df['owned'].sum()),
+               'n_other': int((~metrics_df['owned']).sum()),
+               }
+    if profile_path is not None:
+        pathlib.Path(profile_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(profile_path, 'w') as handle:
+            json.dump(profile, handle, indent=2)
+    return table, profile
+
+
+def main(client, store, images_dir=None, tol=AUC_TOL, repeat=3, dry_run=False):
+    """
+    Analyzes the labeled dataset of a client (data/misc/{client}/{store}_train_ds.json) and writes its metric profile.
+    @param images_dir: (str) dir of the labeled images, default the one of utils.create_train_ds
+    @param dry_run: (bool) if True the metric profile is not written
+    @return: (int) exit code
+    """
+    with open(f'data/misc/{client}/{store}_train_ds.json', 'r') as handle:
+        train_ds = json.load(handle)
+    images_dir = images_dir or f'data/scrap/{store}/{client}/images'
+    profile_path = None if dry_run else metric_profile_path(client, store)
+    table, profile = analyze(f'data/anchors/{client}/{store}', images_dir, train_ds, profile_path, tol, repeat)
+    print(table.to_string(index=False))
+    print(json.dumps(profile, indent=2))
+    if profile_path is not None:
+        print(f'metric profile stored at {profile_path}')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cost / benefit of the study metrics on a labeled dataset.')
+    parser.add_argument('client')
+    parser.add_argument('store', choices=['appstore', 'googlePlay'])
+    parser.add_argument('--images-dir', default=None, help='dir of the labeled images')
+    parser.add_argument('--tol', type=float, default=AUC_TOL, help='max loss of AUC of the score')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dry-run', action='store_true', help='do not write the metric profile')
+    args = parser.parse_args()
+
+    sys.exit(main(args.client, args.store, args.images_dir, args.tol, args.repeat, args.dry_run))
@@ -0,0 +1,45 @@
+import numpy as np
+from raw.src.image_processor_modules import knn_distances, ratio_test
+
+
+class OrbIndex:
+
+    def __init__(self, anchors):
+        """
+        ORB descriptors of all the anchors of a client stacked per (th, k), each row tagged with the position of its
+        anchor. The descriptors of a query variant are matched against every anchor with one brute force call, and the
+        result is the same as calling match_descriptors with each anchor: the knn distances of an anchor descriptor
+        do not depend on the other anchors.
+        @param anchors: (list) preprocessed anchors as returned by AnchorCache.load
+        """
+        self.n_anchors = len(anchors)
+        n_variants = len(anchors[0]['des']) if anchors else 0
+        self.des = []
+        self.anchor_ids = []
+        for ii in range(n_variants):
+            des = [anchor['des'][ii] for anchor in anchors]
+            sizes = [0 if ades is None else len(ades) for ades in des]
+            stacked = [ades for ades in des if ades is not None and len(ades)]
+            self.des.append(np.concatenate(stacked) if stacked else np.zeros((0, 32), np.uint8))
+            self.anchor_ids.append(np.repeat(np.arange(self.n_anchors), sizes))
+
+    def match(self, ii, query_des):
+        """
+        Matches the descriptors of a query variant with the ones of every anchor for the same (th, k).
+        @param ii: (int) index of the (th, k) in param_grid
+        @param query_des: (np.array) ORB descriptors of the query variant, None if it has no key points
+        @return: (np.array, np.array) number of matches (int) and mean distance of the matches (NaN without matches) of
+        each anchor, in the order of the anchors.
+        """
+        n_matches = np.zeros(self.n_anchors, dtype=np.int64)
+        distance_mean = np.full(self.n_anchors, np.nan)
+        distances = knn_distances(self.des[ii], query_des)
+        if distances is None or not len(distances):
+            return n_matches, distance_mean
+        good = ratio_test(distances)
+        ids = self.anchor_ids[ii][good]
+        n_matches = np.bincount(ids, minlength=self.n_anchors)
+        sums = np.bincount(ids, weights=distances[good, 0], minlength=self.n_anchors)
+        matched = n_matches > 0
+        distance_mean[matched] = sums[matched] / n_matches[matched]
+        return n_matches, distance_mean
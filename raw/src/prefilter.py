@@ -0,0 +1,241 @@
+import json
+import pathlib
+import argparse
+import cv2
+import numpy as np
+import pandas as pd
+from raw.src.image_processor_modules import crop_img, load_img
+
+
+HASH_SIZE = 8
+HIST_BINS = 4
+# Default bounds, used when there is no calibration for the client. A query is rejected only when both its hash and its
+# histogram distances to the nearest anchor are beyond the bounds.
+BOUNDS = {'hash': 0.4, 'hist': 0.6}
+PREFILTER_SCORE = 0.0
+
+
+def ahash(image):
+    """
+    Average hash: the image is reduced to HASH_SIZE x HASH_SIZE gray pixels, compared with their mean.
+    @param image: (np.array) BGR image
+    @return: (np.array) bool array with HASH_SIZE**2 bits
+    """
+    small = cv2.resize(_gray(image), (HASH_SIZE, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    return (small > small.mean()).ravel()
+
+
+def dhash(image):
+    """
+    Difference hash: sign of the horizontal gradient of the image reduced to (HASH_SIZE + 1) x HASH_SIZE gray pixels.
+    @param image: (np.array) BGR image
+    @return: (np.array) bool array with HASH_SIZE**2 bits
+    """
+    small = cv2.resize(_gray(image), (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return (small[:, 1:] > small[:, :-1]).ravel()
+
+
+def phash(image):
+    """
+    Perceptual hash: lowest frequencies of the DCT of the image reduced to 32x32 gray pixels, compared with their median.
+    @param image: (np.array) BGR image
+    @return: (np.array) bool array with HASH_SIZE**2 bits
+    """
+    small = cv2.resize(_gray(image), (4 * HASH_SIZE, 4 * HASH_SIZE), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(small.astype(np.float32))[:HASH_SIZE, :HASH_SIZE].ravel()
+    return low > np.median(low[1:])
+
+
+def coarse_hist(image):
+    """
+    Color histogram with HIST_BINS bins per channel, normalized to sum 1.
+    @param image: (np.array) BGR image
+    @return: (np.array) float32 histogram with HIST_BINS**3 bins
+    """
+    hist = cv2.calcHist([image], [0, 1, 2], None, [HIST_BINS] * 3, [0, 256] * 3).ravel()
+    return hist / max(hist.sum(), 1)
+
+
+def fingerprint(image):
+    """
+    Cheap features of a logo used by the prefilter. The store border is cropped as in the study.
+    @param image: (np.array) BGR image as loaded by cv2.imread, None if the image could not be loaded.
+    @return: (dict) with keys 'ahash', 'dhash', 'phash' and 'hist'
+    """
+    image = crop_img(image)
+    return {'ahash': ahash(image), 'dhash': dhash(image), 'phash': phash(image), 'hist': coarse_hist(image)}
+
+
+def distances(anchor_fp, query_fp):
+    """
+    Distances between two fingerprints.
+    @return: (dict) 'hash': mean of the normalized Hamming distances of the three hashes, in [0, 1]. 'hist':
+    Bhattacharyya distance of the histograms, in [0, 1].
+    """
+    hamming = [np.count_nonzero(anchor_fp[key] != query_fp[key]) / anchor_fp[key].size
+               for key in ('ahash', 'dhash', 'phash')]
+    hist = cv2.compareHist(anchor_fp['hist'], query_fp['hist'], cv2.HISTCMP_BHATTACHARYYA)
+    return {'hash': float(np.mean(hamming)), 'hist': float(hist)}
+
+
+def prefilter_bounds_path(client, store):
+    return f'data/misc/{client}/{store}_prefilter.json'
+
+
+def _gray(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+
+class Prefilter:
+
+    def __init__(self, anchor_paths, bounds=None):
+        """
+        First stage of the tiered scoring. The anchors fingerprints are computed once, and a query image whose hash and
+        histogram distances to the nearest anchor are both beyond the bounds is rejected without computing its study.
+        @param anchor_paths: (list) paths of the client anchors.
+        @param bounds: (dict) with keys 'hash' and 'hist'. Default is BOUNDS.
+        """
+        self.bounds = BOUNDS | (bounds or {})
+        self.anchor_fps = [fingerprint(load_img(path)) for path in anchor_paths]
+
+    @classmethod
+    def from_anchors(cls, anchors, bounds_path=None):
+        """
+        Creates the prefilter of a set of anchors as returned by AnchorCache.load.
+        @param anchors: (list) preprocessed anchors.
+        @param bounds_path: (str) json file with the calibrated bounds (see calibrate). Default bounds if it does not
+        exist.
+        """
+        bounds = None
+        if bounds_path is not None:
+            try:
+                with open(bounds_path, 'r') as handle:
+                    bounds = json.load(handle)
+            except FileNotFoundError:
+                pass
+        return cls([anchor['path'] for anchor in anchors], bounds)
+
+    def nearest(self, query_img):
+        """
+        @param query_img: (np.array) BGR query image.
+        @return: (dict) smallest 'hash' and 'hist' distances of the query to the anchors.
+        """
+        query_fp = fingerprint(query_img)
+        dists = [distances(anchor_fp, query_fp) for anchor_fp in self.anchor_fps]
+        return {key: min(dist[key] for dist in dists) for key in ('hash', 'hist')}
+
+    def rejects(self, query_img):
+        """
+        @param query_img: (np.array) BGR query image.
+        @return: (bool) True if the query is too far from all the anchors to be a client logo.
+        """
+        nearest = self.nearest(query_img)
+        return nearest['hash'] > self.bounds['hash'] and nearest['hist'] > self.bounds['hist']
+
+
+def calibrate(anchor_paths, images_dir, train_ds, margin=0.05, bounds_path=None):
+    """
+    Calibrates the prefilter bounds with a labeled dataset (see utils.create_train_ds): each bound is the largest
+    distance from an owned logo to its nearest anchor plus a margin, so none of the labeled client logos is rejected.
+    @param anchor_paths: (list) paths of the client anchors.
+    @param images_dir: (str) dir of the labeled images.
+    @param train_ds: (dict) image name -> owned (bool).
+    @param margin: (float) added to the bounds.
+    @param bounds_path: (str) if given the bounds are stored in this json file.
+    @return: (dict) bounds with keys 'hash' and 'hist'
+    """
+    prefilter = Prefilter(anchor_paths)
+    owned_imgs = [load_img(f'{images_dir}/{name}') for name, is_owned in train_ds.items() if is_owned]
+    owned = [prefilter.nearest(img) for img in owned_imgs if img is not None]
+    bounds = {key: min(max([dist[key] for dist in owned], default=BOUNDS[key]) + margin, 1.0)
+              for key in ('hash', 'hist')}
+    if bounds_path is not None:
+        pathlib.Path(bounds_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(bounds_path, 'w') as handle:
+            json.dump(bounds, handle)
+    return bounds
+
+
+def prefilter_report(prefilter, report_path, images_dir):
+    """
+    Accuracy impact of the prefilter on an existing report (reports/{client}/scrapped_images_vs_anchors_{store}.csv).
+    @param prefilter: (Prefilter) prefilter of the client anchors.
+    @param report_path: (str) csv report with columns name, developer, valid and score.
+    @param images_dir: (str) dir of the scrapped images of the report.
+    @return: (pd.DataFrame, dict) The report with columns hash_dist, hist_dist, prefiltered and new_score, and a
+    summary with the number of rows, prefiltered rows, prefiltered rows of a valid developer and the highest and mean
+    full study score of the prefiltered rows.
+    """
+    report = pd.read_csv(report_path)
+    rows = []
+    for name in report['name']:
+        query_img = load_img(f'{images_dir}/{name}')
+        if query_img is None:
+            rows.append({'hash_dist': np.nan, 'hist_dist': np.nan, 'prefiltered': False})
+            continue
+        nearest = prefilter.nearest(query_img)
+        rows.append({'hash_dist': nearest['hash'],
+                     'hist_dist': nearest['hist'],
+                     'prefiltered': prefilter.rejects(query_img)})
+    report = pd.concat([report, pd.DataFrame(rows, index=report.index)], axis=1)
+    report['new_score'] = report['score'].where(~report['prefiltered'], PREFILTER_SCORE)
+
+    prefiltered = report[report['prefiltered']]
+    summary = {
+        'rows': len(report),
+        'prefiltered': len(prefiltered),
+        'valid_prefiltered': int(prefiltered['valid'].astype(bool).sum()),
+        'max_prefiltered_score': float(prefiltered['score'].max()) if len(prefiltered) else np.nan,
+        'mean_prefiltered_score': float(prefiltered['score'].mean()) if len(prefiltered) else np.nan,
+    }
+    return report, summary
+
+
+def main(client, store, images_dir=None, margin=0.05, dry_run=False):
+    """
+    Calibrates the prefilter bounds of a client with its labeled dataset (data/misc/{client}/{store}_train_ds.json)
+    and writes them where ComparisonClient(..., prefilter=True) loads them (see prefilter_bounds_path).
+    @param images_dir: (str) dir of the labeled images, default the one of utils.create_train_ds
+    @param margin: (float) added to the bounds
+    @param dry_run: (bool) if True the bounds are not written
+    @return: (int) exit code
+    """
+    from raw.src.anchor_cache import AnchorCache
+    with open(f'data/misc/{client}/{store}_train_ds.json', 'r') as handle:
+        train_ds = json.load(handle)
+    images_dir = images_dir or f'data/scrap/{store}/{client}/images'
+    anchors_path = f'data/anchors/{client}/{store}'
+    anchor_paths = [f'{anchors_path}/{name}' for name in AnchorCache(anchors_path).anchor_names()]
+    bounds_path = None if dry_run else prefilter_bounds_path(client, store)
+    bounds = calibrate(anchor_paths, images_dir, train_ds, margin, bounds_path)
+
+    prefilter = Prefilter(anchor_paths, bounds)
+    rejected = {True: 0, False: 0}
+    for name, owned in train_ds.items():
+        query_img = load_img(f'{images_dir}/{name}')
+        if query_img is not None and prefilter.rejects(query_img):
+            rejected[bool(owned)] += 1
+    n_owned = sum(bool(owned) for owned in train_ds.values())
+    print(json.dumps(bounds))
+    print(f'rejected {rejected[False]} of {len(train_ds) - n_owned} other logos and {rejected[True]} of {n_owned} '
+          f'client logos')
+    if bounds_path is not None:
+        print(f'prefilter bounds stored at {bounds_path}')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy impact of the prefilter on an existing report.')
+    parser.add_argument('anchors_path', help='data/anchors/{client}/{store}')
+    parser.add_argument('report_path', help='reports/{client}/scrapped_images_vs_anchors_{store}.csv')
+    parser.add_argument('images_dir', help='dir of the scrapped images of the report')
+    parser.add_argument('--bounds', default=None, help='json file with the calibrated bounds')
+    args = parser.parse_args()
+
+    from raw.src.anchor_cache import AnchorCache
+    anchor_names = AnchorCache(args.anchors_path).anchor_names()
+    anchors = [{'path': f'{args.anchors_path}/{name}'} for name in anchor_names]
+    report, summary = prefilter_report(Prefilter.from_anchors(anchors, args.bounds), args.report_path,
+                                       args.images_dir)
+    print(report[['name', 'valid', 'score', 'hash_dist', 'hist_dist', 'prefiltered', 'new_score']])
+    print(summary)
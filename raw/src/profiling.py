@@ -0,0 +1,170 @@
+import os
+import csv
+import json
+import time
+import pathlib
+import cProfile
+import functools
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+# Instrumentation is off by default: span returns a shared no-op object and timed only checks this flag.
+ENABLED = False
+_durations = defaultdict(list)
+_lock = threading.Lock()
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def span(name):
+    """
+    Timing span of a stage: 'with span(name): ...'. Does nothing unless profiling is enabled.
+    @param name: (str) stage name, i.e. 'study.metrics'
+    """
+    return _Span(name) if ENABLED else _NULL_SPAN
+
+
+def timed(name):
+    """
+    Decorator version of span, the whole function call is the span.
+    @param name: (str) stage name
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def record(name, seconds):
+    with _lock:
+        _durations[name].append(seconds)
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    with _lock:
+        _durations.clear()
+
+
+def summary():
+    """
+    @return: (dict) stage -> count, total, mean, p50, p95 and max seconds, stages sorted by total time.
+    """
+    import numpy as np
+    with _lock:
+        durations = {name: np.array(values) for name, values in _durations.items()}
+    stages = {}
+    for name, values in sorted(durations.items(), key=lambda item: -item[1].sum()):
+        stages[name] = {
+            'count': int(len(values)),
+            'total': float(values.sum()),
+            'mean': float(values.mean()),
+            'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)),
+            'max': float(values.max()),
+        }
+    return stages
+
+
+def write_trace(path, meta=None):
+    """
+    Writes the summary of the recorded spans, as csv if path ends with '.csv' and as json otherwise.
+    @param path: (str) trace path
+    @param meta: (dict) run info stored in the json trace
+    """
+    stages = summary()
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as handle:
+            writer = csv.writer(handle)
+            writer.writerow(['stage', 'count', 'total', 'mean', 'p50', 'p95', 'max'])
+            for name, stats in stages.items():
+                writer.writerow([name] + [stats[key] for key in ('count', 'total', 'mean', 'p50', 'p95', 'max')])
+    else:
+        with open(path, 'w') as handle:
+            json.dump({'meta': meta or {}, 'stages': stages}, handle, indent=2)
+
+
+def format_summary(stages=None):
+    stages = summary() if stages is None else stages
+    lines = [f"{'stage':32s} {'count':>7s} {'total s':>9s} {'p50 ms':>9s} {'p95 ms':>9s}"]
+    for name, stats in stages.items():
+        lines.append(f"{name:32s} {stats['count']:7d} {stats['total']:9.3f} {stats['p50'] * 1e3:9.2f} "
+                     f"{stats['p95'] * 1e3:9.2f}")
+    return '\n'.join(lines)
+
+
+@contextmanager
+def profiled(trace_path=None, cprofile_path=None, meta=None):
+    """
+    Enables the instrumentation while the block runs and writes the trace (and a cProfile dump, readable with pstats)
+    at the end, also when the block fails. Only the spans of this process are recorded.
+    @param trace_path: (str) trace path (json or csv). Nothing is enabled if both paths are None.
+    @param cprofile_path: (str) cProfile dump path
+    @param meta: (dict) run info stored in the json trace
+    """
+    if trace_path is None and cprofile_path is None:
+        yield
+        return
+    reset()
+    enable()
+    profiler = cProfile.Profile() if cprofile_path is not None else None
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            pathlib.Path(cprofile_path).parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(cprofile_path)
+        disable()
+        record('run', time.perf_counter() - start)
+        if trace_path is not None:
+            write_trace(trace_path, (meta or {}) | {'pid': os.getpid()})
+            print(format_summary())
@@ -0,0 +1,163 @@
+import os
+import json
+import hashlib
+import pathlib
+import pandas as pd
+
+
+FSYNC_EVERY = 16  # rows
+FIRST_COLUMNS = ('name', 'developer', 'valid', 'score')
+
+
+def read_stream(stream_path):
+    """
+    Reads the rows of a report stream. A line left incomplete by a crash is ignored.
+    @param stream_path: (str) path of the stream, one json row per line.
+    @return: (list) rows of the stream, [] if it does not exist.
+    """
+    rows = []
+    try:
+        with open(stream_path, 'r') as handle:
+            for line in handle:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return rows
+
+
+def write_report(df, report_path):
+    """
+    Writes a report as parquet if report_path ends with '.parquet' (requires pyarrow) or as csv otherwise. The report
+    is written to a temporary file and then renamed, so report_path never holds a partial report.
+    @param df: (pd.DataFrame) report
+    @param report_path: (str) path of the report
+    """
+    pathlib.Path(report_path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = f'{report_path}.{os.getpid()}.tmp'
+    if report_path.endswith('.parquet'):
+        df.to_parquet(tmp_path, index=False)
+    else:
+        df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, report_path)
+
+
+class ReportWriter:
+
+    def __init__(self, report_path, run_id=None, source=None, fsync_every=FSYNC_EVERY):
+        """
+        Streaming sink of the results of a comparison run. Each row is appended to '{report_path}.{run_id}.stream' (one
+        json line per row) as soon as it is produced and flushed, and the stream is fsync'ed every fsync_every rows: a
+        crash of the process loses no row, a crash of the machine at most the rows after the last fsync, and the rows
+        are not kept in memory. Once the run is finished, compact writes the final report (csv or parquet, see
+        write_report) from the stream.
+        The stream is named after the run, so a stream left by a crashed run is resumed only by the same run and never
+        mixed into the report of another one.
+        @param report_path: (str) path of the final report.
+        @param run_id: (str) identifier of the run, i.e. its date. If None the stream is '{report_path}.stream'.
+        @param source: (str) path of the scrap results scored by the run. A stream written for a different content
+        of the scrap results (the run was scraped again) is dropped.
+        @param fsync_every: (int) number of rows between fsyncs of the stream.
+        """
+        self.report_path = report_path
+        self.stream_path = f'{report_path}.{run_id}.stream' if run_id is not None else f'{report_path}.stream'
+        self.source_path = f'{self.stream_path}.source'
+        self.fsync_every = fsync_every
+        self.handle = None
+        self.unsynced = 0
+        if source is not None:
+            self._check_source(source)
+
+    def _check_source(self, source):
+        with open(source, 'rb') as handle:
+            sha1 = hashlib.sha1(handle.read()).hexdigest()
+        try:
+            with open(self.source_path, 'r') as handle:
+                stale = handle.read() != sha1
+        except FileNotFoundError:
+            stale = True
+        if stale:
+            _unlink(self.stream_path)
+            pathlib.Path(self.source_path).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.source_path, 'w') as handle:
+                handle.write(sha1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def written_names(self):
+        """
+        @return: (set) names of the rows already in the stream, i.e. written by an interrupted run. The rows of the
+        images that could not be scored (with an 'error') are not included, so a resumed run scores them again.
+        """
+        return {row.get('name') for row in read_stream(self.stream_path) if row.get('error') is None}
+
+    def write(self, row):
+        """
+        Appends a row to the stream.
+        @param row: (dict) results of a query image.
+        """
+        if self.handle is None:
+            pathlib.Path(self.stream_path).parent.mkdir(parents=True, exist_ok=True)
+            # Terminate a line left incomplete by a crash, so it does not corrupt the next row.
+            incomplete = False
+            if os.path.exists(self.stream_path) and os.path.getsize(self.stream_path) > 0:
+                with open(self.stream_path, 'rb') as handle:
+                    handle.seek(-1, os.SEEK_END)
+                    incomplete = handle.read(1) != b'\n'
+            self.handle = open(self.stream_path, 'a')
+            if incomplete:
+                self.handle.write('\n')
+        self.handle.write(json.dumps(row, default=_to_builtin) + '\n')
+        self.handle.flush()
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        if self.handle is not None and self.unsynced:
+            os.fsync(self.handle.fileno())
+            self.unsynced = 0
+
+    def close(self):
+        if self.handle is not None:
+            self.sync()
+            self.handle.close()
+            self.handle = None
+
+    def compact(self):
+        """
+        Writes the final report from the stream and removes the stream. An image written more than once (an error
+        scored again by a resumed run) keeps its last row, at the position of its first one.
+        @return: (pd.DataFrame) final report, columns name, developer, valid and score first.
+        """
+        self.close()
+        rows = {}
+        for row in read_stream(self.stream_path):
+            rows[row.get('name')] = row
+        df = pd.DataFrame(list(rows.values()))
+        first_columns = [col for col in FIRST_COLUMNS if col in df.columns]
+        df = df[first_columns + [col for col in df.columns if col not in first_columns]]
+        write_report(df, self.report_path)
+        _unlink(self.stream_path)
+        _unlink(self.source_path)
+        return df
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _to_builtin(value):
+    # numpy scalars in the rows
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
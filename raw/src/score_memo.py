@@ -0,0 +1,67 @@
+import os
+import json
+import hashlib
+import pathlib
+
+
+MEMO_DIR = 'data/memo'
+# Bump it whenever a change in the image processing, the metrics or the aggregation changes the scores, so the memoized
+# scores of the previous pipeline are not used anymore.
+PIPELINE_VERSION = 1
+
+
+def anchor_set_sha1(anchors):
+    """
+    Hash of a set of anchors, as returned by AnchorCache.load. It changes when an anchor is added, removed or modified.
+    @param anchors: (list) preprocessed anchors
+    @return: (str) hex digest of the anchor set
+    """
+    sha1 = hashlib.sha1()
+    for anchor in sorted(anchors, key=lambda anchor: anchor['name']):
+        sha1.update(f"{anchor['name']}:{anchor['sha1']}\n".encode())
+    return sha1.hexdigest()
+
+
+class ScoreMemo:
+
+    def __init__(self, anchors, memo_dir=MEMO_DIR, pipeline=None):
+        """
+        On disk memo of the scores of query images, keyed by (query image hash, anchor set hash, pipeline version). The
+        score of a query image only depends on its content and the anchors, so a logo already scored against the same
+        anchors is not processed again. Each entry is a small json file at
+        '{memo_dir}/{pipeline}/{anchor set hash}/{image hash[:2]}/{image hash}.json'.
+        @param anchors: (list) preprocessed anchors, as returned by AnchorCache.load.
+        @param memo_dir: (str) dir where the scores are stored.
+        @param pipeline: (str) pipeline key. Default is 'v{PIPELINE_VERSION}'.
+        """
+        self.pipeline = pipeline if pipeline is not None else f'v{PIPELINE_VERSION}'
+        self.anchor_set = anchor_set_sha1(anchors)
+        self.memo_dir = f'{memo_dir}/{self.pipeline}/{self.anchor_set}'
+
+    def get(self, image_sha1):
+        """
+        @param image_sha1: (str) hex digest of the query image.
+        @return: (dict) memoized result with keys 'score' and 'metrics', None if the image was not scored yet.
+        """
+        try:
+            with open(self._path(image_sha1), 'r') as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, image_sha1, score, metrics):
+        """
+        Stores the result of a query image.
+        @param image_sha1: (str) hex digest of the query image.
+        @param score: (float) score of the query image.
+        @param metrics: (dict) aggregated metrics of the query image (agg_study row without name).
+        """
+        path = self._path(image_sha1)
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as handle:
+            json.dump({'score': score, 'metrics': metrics}, handle)
+        os.replace(tmp_path, path)
+
+    def _path(self, image_sha1):
+        return f'{self.memo_dir}/{image_sha1[:2]}/{image_sha1}.json'
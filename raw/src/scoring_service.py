@@ -0,0 +1,375 @@
+import json
+import math
+import time
+import queue
+import signal
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import cv2
+import numpy as np
+from raw.src import logo_store
+from raw.src.comparisson_client import ComparisonClient
+from raw.src.image_processor_modules import init_worker
+from raw.src.study_processors_modules import SWEEP, SWEEP_TOL, FIDELITY
+
+
+HOST = '127.0.0.1'
+PORT = 8470
+MAX_WORKERS = 2
+BATCH_SIZE = 8  # max query images sent to a worker at once
+BATCH_WAIT = 0.02  # seconds waited for more requests to fill a batch
+REQUEST_TIMEOUT = 300  # seconds
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+LATENCY_WINDOW = 1000  # requests kept for the latency percentiles
+HEALTH_TIMEOUT = 2  # seconds waited for a worker to answer the health check
+
+
+class ScoringService:
+
+    def __init__(self, max_workers=MAX_WORKERS, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT, options=None, warm=()):
+        """
+        Scores query images on demand. The requests are queued and grouped in batches (up to batch_size images, waiting
+        at most batch_wait seconds for more) of the same client and store, and each batch is split across a pool of
+        max_workers processes. Each worker keeps one ComparisonClient per (client, store) with its anchors, ORB index,
+        developers and score memo loaded, so only the first request of a client pays for loading them.
+        @param max_workers: (int) number of worker processes
+        @param batch_size: (int) max query images per batch
+        @param batch_wait: (float) seconds waited for more requests before sending an incomplete batch
+        @param options: (dict) ComparisonClient options (memoize, prefilter, sweep, sweep_tol, fidelity,
+        metric_profile)
+        @param warm: (iterable) (client, store) pairs loaded by every worker at start
+        """
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.options = options or {}
+        self.warm = [tuple(pair) for pair in warm]
+        self.requests = queue.Queue()
+        self.executor = None
+        self.dispatcher = None
+        self.start_time = None
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'scored': 0, 'failed': 0, 'batches': 0, 'batched_images': 0}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.clients = set(self.warm)
+        self.pool_error = None  # set when a worker process dies, the pool can not score anymore
+
+    def start(self):
+        """
+        Starts the worker processes (loading the warm clients) and the batch dispatcher.
+        """
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_service_worker,
+                                            initargs=(self.options, self.warm))
+        # The pool starts its processes on demand, one task per worker starts all of them now.
+        for future in [self.executor.submit(_ping) for _ in range(self.max_workers)]:
+            future.result()
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+        self.start_time = time.monotonic()
+
+    def stop(self):
+        self.requests.put(None)
+        if self.dispatcher is not None:
+            self.dispatcher.join()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def submit(self, client, store, query_info):
+        """
+        Queues a query image.
+        @param client: (str) client name, a key of files/clients.json
+        @param store: (str) 'appstore' or 'googlePlay'
+        @param query_info: (dict) query info with keys 'img_path' and 'developer'
+        @return: (Future) resolved with the row of ComparisonClient.score_query
+        """
+        future = Future()
+        with self.lock:
+            self.stats['requests'] += 1
+            self.clients.add((client, store))
+        self.requests.put((client, store, query_info, future, time.monotonic()))
+        return future
+
+    def _dispatch(self):
+        stopping = False
+        while not stopping:
+            item = self.requests.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.requests.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[:2], []).append(item)
+            for (client, store), items in groups.items():
+                # A batch is split across the workers, so a burst of requests of a client keeps all of them busy.
+                chunk_size = math.ceil(len(items) / min(self.max_workers, len(items)))
+                for start in range(0, len(items), chunk_size):
+                    chunk = items[start:start + chunk_size]
+                    try:
+                        batch_future = self.executor.submit(_score_batch, client, store, [item[2] for item in chunk])
+                    except RuntimeError as E:
+                        # BrokenProcessPool, the requests fail instead of stopping the dispatcher.
+                        batch_future = Future()
+                        batch_future.set_exception(E)
+                    batch_future.add_done_callback(lambda done, chunk=chunk: self._resolve(done, chunk))
+                    with self.lock:
+                        self.stats['batches'] += 1
+                        self.stats['batched_images'] += len(chunk)
+
+    def _resolve(self, batch_future, items):
+        try:
+            rows = batch_future.result()
+        except Exception as E:
+            rows = [E] * len(items)
+        end = time.monotonic()
+        with self.lock:
+            if rows and isinstance(rows[0], BrokenProcessPool):
+                self.pool_error = repr(rows[0])
+            for row, item in zip(rows, items):
+                self.latencies.append(end - item[4])
+                failed = isinstance(row, Exception) or 'error' in row
+                self.stats['failed' if failed else 'scored'] += 1
+        for row, (_, _, _, future, _) in zip(rows, items):
+            if isinstance(row, Exception):
+                future.set_exception(row)
+            else:
+                future.set_result(row)
+
+    def health(self):
+        """
+        @return: (dict) 'status' 'ok', or 'degraded' with the 'reasons' when the worker pool is broken (a worker
+        process died) or the dispatcher thread is not running, the number of workers and the uptime.
+        """
+        reasons = []
+        if self.executor is None:
+            reasons.append('worker pool not running')
+        else:
+            self._ping_pool()
+            with self.lock:
+                pool_error = self.pool_error
+            if pool_error:
+                reasons.append(f'worker pool broken: {pool_error}')
+        if self.dispatcher is None or not self.dispatcher.is_alive():
+            reasons.append('dispatcher not running')
+        health = {'status': 'degraded' if reasons else 'ok', 'workers': self.max_workers,
+                  'uptime': time.monotonic() - self.start_time if self.start_time is not None else None}
+        if reasons:
+            health['reasons'] = reasons
+        return health
+
+    def _ping_pool(self):
+        # A dead worker breaks the pool before any request fails: the ping fails with BrokenProcessPool. A ping not
+        # answered in HEALTH_TIMEOUT seconds means the workers are busy scoring, not broken.
+        try:
+            self.executor.submit(_ping).result(timeout=HEALTH_TIMEOUT)
+        except BrokenProcessPool as E:
+            with self.lock:
+                self.pool_error = self.pool_error or repr(E)
+        except TimeoutError:
+            pass
+
+    def metrics(self):
+        """
+        @return: (dict) request counts, batches, mean batch size, queue size, latency percentiles (seconds, last
+        LATENCY_WINDOW requests) and the clients seen.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            latencies = np.array(self.latencies)
+            clients = sorted(self.clients)
+        stats['mean_batch_size'] = stats['batched_images'] / stats['batches'] if stats['batches'] else None
+        stats['queue_size'] = self.requests.qsize()
+        stats['latency_p50'] = float(np.percentile(latencies, 50)) if len(latencies) else None
+        stats['latency_p95'] = float(np.percentile(latencies, 95)) if len(latencies) else None
+        stats['clients'] = [f'{client}/{store}' for client, store in clients]
+        stats['uptime'] = time.monotonic() - self.start_time
+        return stats
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    """
+    GET /health, GET /metrics and POST /score?client=...&store=...&developer=...[&name=...] with the image bytes as
+    body. The score response is the row of ComparisonClient.score_query (name, developer, valid, score and the
+    aggregated metrics) plus the sha1 of the image. An image that can not be decoded is rejected with 422, and an image
+    that can not be scored gets its row (score NaN and the 'error') with 500.
+    """
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            health = self.server.service.health()
+            self._reply(200 if health['status'] == 'ok' else 503, health)
+        elif path == '/metrics':
+            self._reply(200, self.server.service.metrics())
+        else:
+            self._reply(404, {'error': f'unknown path {path}'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/score':
+            self._reply(404, {'error': f'unknown path {url.path}'})
+            return
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        missing = [key for key in ('client', 'store', 'developer') if not params.get(key)]
+        length = int(self.headers.get('Content-Length') or 0)
+        if missing:
+            self._reply(400, {'error': f'missing parameters: {missing}'})
+            return
+        if length <= 0 or length > MAX_IMAGE_BYTES:
+            self._reply(400 if length <= 0 else 413, {'error': f'image size must be in (0, {MAX_IMAGE_BYTES}] bytes'})
+            return
+
+        content = self.rfile.read(length)
+        if cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR) is None:
+            self._reply(422, {'error': 'the image could not be decoded'})
+            return
+        # Only the images that decode are kept in the logo store, so the memo and the workers find them by their path.
+        sha1 = logo_store.store_object(content)
+        query_info = {'img_path': logo_store.object_path(sha1), 'developer': params['developer']}
+        future = self.server.service.submit(params['client'], params['store'], query_info)
+        try:
+            row = future.result(timeout=REQUEST_TIMEOUT)
+        except Exception as E:
+            self._reply(500, {'error': repr(E)})
+            return
+        row = dict(row) | {'sha1': sha1}
+        if params.get('name'):
+            row['name'] = params['name']
+        self._reply(500 if 'error' in row else 200, row)
+
+    def _reply(self, status, body):
+        content = json.dumps(_json_safe(body)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_server(service, host=HOST, port=PORT):
+    """
+    @param service: (ScoringService) started service
+    @param host: (str) interface to listen on
+    @param port: (int) port, 0 for any free one (see server.server_address)
+    @return: (ThreadingHTTPServer) http server of the service, not serving yet
+    """
+    server = ThreadingHTTPServer((host, port), ScoringHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def serve(host=HOST, port=PORT, service=None):
+    """
+    Runs the scoring service until interrupted (SIGINT or SIGTERM).
+    @param host: (str) interface to listen on, localhost by default
+    @param port: (int) port
+    @param service: (ScoringService) service, a default one if None
+    """
+    service = service if service is not None else ScoringService()
+    service.start()
+    server = create_server(service, host, port)
+    print(f'scoring service at http://{host}:{server.server_address[1]} ({service.max_workers} workers)')
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _json_safe(value):
+    # NaN is not valid json, numpy scalars are not serializable
+    if isinstance(value, dict):
+        return {key: _json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(item) for item in value]
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+_SERVICE_CLIENTS = {}
+_SERVICE_OPTIONS = {}
+
+
+def _init_service_worker(options, warm):
+    init_worker()
+    _SERVICE_OPTIONS.update(options)
+    for client, store in warm:
+        _service_client(client, store)
+
+
+def _service_client(client, store):
+    if (client, store) not in _SERVICE_CLIENTS:
+        # The workers of the service share the anchors and the query images through memory mapped files.
+        compare_obj = ComparisonClient(client, store, save_study=False, **({'mmap': True} | _SERVICE_OPTIONS))
+        compare_obj.load_orb_index()
+        compare_obj.load_client_developers()
+        compare_obj.load_memo()
+        _SERVICE_CLIENTS[(client, store)] = compare_obj
+    return _SERVICE_CLIENTS[(client, store)]
+
+
+def _score_batch(client, store, query_infos):
+    compare_obj = _service_client(client, store)
+    rows = []
+    for query_info in query_infos:
+        try:
+            rows.append(compare_obj.score_query(query_info))
+        except Exception as E:
+            rows.append(compare_obj._failed_result(query_info, E))
+    return rows
+
+
+def _ping():
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local http service that scores logos against warm client anchors.')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--batch-wait', type=float, default=BATCH_WAIT)
+    parser.add_argument('--warm', nargs='*', default=[], metavar='CLIENT:STORE', help='clients loaded at start')
+    parser.add_argument('--no-memoize', action='store_true')
+    parser.add_argument('--prefilter', action='store_true')
+    parser.add_argument('--sweep', default=SWEEP, choices=['exhaustive', 'adaptive'])
+    parser.add_argument('--sweep-tol', type=float, default=SWEEP_TOL)
+    parser.add_argument('--fidelity', default=FIDELITY, choices=['full', 'half', 'quarter', 'pyramid'])
+    parser.add_argument('--metric-profile', action='store_true')
+    args = parser.parse_args()
+
+    options = {'memoize': not args.no_memoize, 'prefilter': args.prefilter, 'sweep': args.sweep,
+               'sweep_tol': args.sweep_tol, 'fidelity': args.fidelity, 'metric_profile': args.metric_profile}
+    service = ScoringService(args.workers, args.batch_size, args.batch_wait, options,
+                             [pair.split(':', 1) for pair in args.warm])
+    serve(args.host, args.port, service)
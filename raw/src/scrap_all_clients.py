@@ -1,20 +1,213 @@
+import os
 import json
-import scrap_stores
+import time
+import pathlib
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from raw.src.profiling import profiled
 
 
-def main():
-    with open('files/clients.json', 'r') as clients_handle:
-        clients_data = json.load(clients_handle)
+STORES = ('appstore', 'googlePlay')
+MAX_WORKERS = 2
+MAX_ATTEMPTS = 3
+RUNS_DIR = 'data/runs'
 
-    client_names = clients_data.keys()
-    for client in client_names:
 
+def job_paths(client, store, date):
+    """
+    Paths used by the scrape + score job of a client in a store, the same ones used by comparisson_client.py.
+    @return: (dict) with keys 'images_dir', 'results_file' and 'report_file'
+    """
+    return {
+        'images_dir': f'data/scrap/{store}/{client}/images/{date}',
+        'results_file': f'data/scrap/{store}/{client}/query_results/{date}.json',
+        'report_file': f'reports/{client}/scrapped_images_vs_anchors_{store}.csv',
+    }
+
+
+def state_path(client, store, date, runs_dir=RUNS_DIR):
+    return f'{runs_dir}/{date}/{client}__{store}.json'
+
+
+def load_state(client, store, date, runs_dir=RUNS_DIR):
+    """
+    State of a job of the run of date. A job goes through the status 'pending' -> 'scraped' -> 'done', or 'failed'.
+    @return: (dict) job state
+    """
+    try:
+        with open(state_path(client, store, date, runs_dir), 'r') as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {'client': client, 'store': store, 'date': date, 'status': 'pending', 'attempts': 0, 'error': None,
+                'scrape_time': None, 'score_time': None, 'n_images': None, 'n_carried': None}
+
+
+def save_state(state, runs_dir=RUNS_DIR):
+    path = state_path(state['client'], state['store'], state['date'], runs_dir)
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(f'{path}.{os.getpid()}.tmp', 'w') as handle:
+        json.dump(state, handle)
+    os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+
+def run_job(client, store, date, runs_dir=RUNS_DIR, options=None, profile_dir=None, cprofile=False, incremental=False):
+    """
+    Scrapes the store for the client and scores the scrapped logos against the client anchors, saving the job state
+    after each stage. A job that was already scraped in the run of date is only scored.
+    @param client: (str) client name, a key of files/clients.json
+    @param store: (str) 'appstore' or 'googlePlay'
+    @param date: (str) date of the run, YYYY-MM-DD
+    @param runs_dir: (str) dir where the job states are stored
+    @param options: (dict) extra ComparisonClient options
+    @param profile_dir: (str) if given the timing trace of the job is written at '{profile_dir}/{client}__{store}.json'
+    @param cprofile: (bool) also dump the cProfile stats of the job at '{profile_dir}/{client}__{store}.prof'
+    @param incremental: (bool) If True the images and results of the previous runs are kept, and only the search
+    results new or changed since the previous run are scored, the other ones are carried forward (see incremental).
+    @return: (dict) final job state
+    """
+    # Imported here, so the paths and states of a run can be read without loading the scrapers and opencv.
+    from raw.src import scrap_stores
+    from raw.src.comparisson_client import ComparisonClient
+    from raw.src.report_writer import ReportWriter
+    from raw.src.incremental import score_incremental, save_index
+    state = load_state(client, store, date, runs_dir)
+    if state['status'] == 'done':
+        return state
+    paths = job_paths(client, store, date)
+    state['attempts'] += 1
+    state['error'] = None
+    trace_path, cprofile_path = None, None
+    if profile_dir is not None:
+        trace_path = f'{profile_dir}/{client}__{store}.json'
+        cprofile_path = f'{profile_dir}/{client}__{store}.prof' if cprofile else None
+    # Each job records its own spans, the jobs run in other processes.
+    with profiled(trace_path, cprofile_path, {'client': client, 'store': store, 'date': date}):
         try:
-            scrap_stores.main(client)
+            if state['status'] != 'scraped':
+                start = time.perf_counter()
+                scrap_stores.main(CLIENT=client,
+                                  STORE=store,
+                                  download_images_dir=paths['images_dir'],
+                                  download_results_file=paths['results_file'],
+                                  clean=not incremental)
+                state['scrape_time'] = time.perf_counter() - start
+                state['status'] = 'scraped'
+                save_state(state, runs_dir)
+
+            start = time.perf_counter()
+            compare_obj = ComparisonClient(client=client, store=store, **(options or {}))
+            scrap_info_json = compare_obj.load_scrap_info_from_client(paths['results_file'])
+            # The results already streamed by an interrupted attempt are kept, only the rest of the images are scored.
+            with ReportWriter(paths['report_file'], run_id=date, source=paths['results_file']) as writer:
+                if incremental:
+                    _, state['n_carried'] = score_incremental(compare_obj, scrap_info_json, writer,
+                                                              paths['results_file'])
+                    save_index(compare_obj, scrap_info_json, writer, paths['results_file'])
+                else:
+                    compare_obj.compare_stream(scrap_info_json, writer)
+                results = writer.compact()
+            state['score_time'] = time.perf_counter() - start
+            state['n_images'] = len(results)
+            state['status'] = 'done'
         except Exception as E:
-            print(E)
-            continue
+            # A job that fails scoring keeps its scrape, a resumed run only scores it again.
+            if state['status'] != 'scraped':
+                state['status'] = 'failed'
+            state['error'] = repr(E)
+    save_state(state, runs_dir)
+    return state
+
+
+def summarize(states, wall_time):
+    """
+    Throughput summary of a run.
+    @param states: (list) final job states
+    @param wall_time: (float) seconds taken by the run
+    @return: (str) summary
+    """
+    done = [state for state in states if state['status'] == 'done']
+    # The rows carried forward by an incremental run are in the report but were not scored again.
+    n_carried = sum(state.get('n_carried') or 0 for state in done)
+    n_images = sum(state['n_images'] or 0 for state in done) - n_carried
+    scrape_times = [state['scrape_time'] for state in done if state['scrape_time'] is not None]
+    score_times = [state['score_time'] for state in done if state['score_time'] is not None]
+    lines = [
+        f'jobs: {len(states)}, done: {len(done)}, not done: {len(states) - len(done)}',
+        f'images scored: {n_images} in {wall_time:.1f}s ({n_images / max(wall_time, 1e-9):.2f} images/s)',
+    ]
+    if n_carried:
+        lines.append(f'images carried forward from the previous run: {n_carried}')
+    if scrape_times:
+        lines.append(f'mean scrape time: {sum(scrape_times) / len(scrape_times):.1f}s, '
+                     f'mean score time: {sum(score_times) / len(score_times):.1f}s')
+    for state in states:
+        if state['status'] != 'done':
+            lines.append(f"  {state['client']} / {state['store']}: {state['status']} "
+                         f"(attempts {state['attempts']}) {state['error']}")
+    return '\n'.join(lines)
+
+
+def main(clients=None, stores=STORES, date=None, max_workers=MAX_WORKERS, max_attempts=MAX_ATTEMPTS,
+         runs_dir=RUNS_DIR, options=None, profile_dir=None, cprofile=False, incremental=False):
+    """
+    Runs the scrape + score job of every (client, store) pair on a pool of max_workers processes. The state of each job
+    is kept at '{runs_dir}/{date}/', so running again with the same date resumes an interrupted run: the jobs done
+    are skipped, the scraped ones are only scored and the failed ones are retried up to max_attempts times.
+    @param clients: (list) client names. Default is all the clients in files/clients.json
+    @param stores: (iterable) stores to scrap
+    @param date: (str) date of the run, YYYY-MM-DD. Default is today.
+    @param max_workers: (int) number of jobs run at the same time
+    @param max_attempts: (int) max attempts of a failed job
+    @param runs_dir: (str) dir where the job states are stored
+    @param options: (dict) extra ComparisonClient options
+    @param profile_dir: (str) dir of the timing traces of the jobs (see run_job), no profiling if None
+    @param cprofile: (bool) also dump the cProfile stats of the jobs
+    @param incremental: (bool) score only the search results new or changed since the previous run (see run_job)
+    @return: (list) final job states
+    """
+    if clients is None:
+        with open('files/clients.json', 'r') as clients_handle:
+            clients = list(json.load(clients_handle).keys())
+    date = date if date is not None else str(datetime.datetime.now().date())
+
+    jobs = [(client, store) for client in clients for store in stores]
+    states = {job: load_state(*job, date, runs_dir) for job in jobs}
+    pending = [job for job in jobs
+               if states[job]['status'] != 'done' and states[job]['attempts'] < max_attempts]
+    print(f'run {date}: {len(jobs)} jobs, {len(jobs) - len(pending)} done or out of attempts, {len(pending)} to run')
+
+    from raw.src.image_processor_modules import init_worker
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker) as executor:
+        futures = {executor.submit(run_job, *job, date, runs_dir, options, profile_dir, cprofile, incremental): job
+                   for job in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                states[job] = future.result()
+            except Exception as E:
+                states[job] = load_state(*job, date, runs_dir) | {'status': 'failed', 'error': repr(E)}
+            print(f"{job[0]} / {job[1]}: {states[job]['status']}")
+    wall_time = time.perf_counter() - start
+
+    ran = [states[job] for job in pending]
+    print(summarize(ran, wall_time))
+    return [states[job] for job in jobs]
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Scrape and score all the clients in files/clients.json.')
+    parser.add_argument('--clients', nargs='*', default=None, help='client names, default all')
+    parser.add_argument('--stores', nargs='*', default=list(STORES))
+    parser.add_argument('--date', default=None, help='run date to resume, YYYY-MM-DD. Default is today')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS)
+    parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS)
+    parser.add_argument('--profile', default=None, metavar='DIR', help='write a timing trace per job in DIR')
+    parser.add_argument('--cprofile', action='store_true', help='with --profile, also dump the cProfile stats')
+    parser.add_argument('--incremental', action='store_true', help='score only the new or changed search results')
+    args = parser.parse_args()
+
+    main(clients=args.clients, stores=args.stores, date=args.date, max_workers=args.workers,
+         max_attempts=args.max_attempts, profile_dir=args.profile, cprofile=args.cprofile,
+         incremental=args.incremental)
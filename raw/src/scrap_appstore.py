@@ -1,24 +1,30 @@
 import re
-import requests
 from bs4 import BeautifulSoup
-from raw.src.utils import download_image, save_query_results
+from raw.src import http_client
+from raw.src.http_cache import HttpCache
+from raw.src.profiling import span
+from raw.src.utils import download_images, summarize_downloads, save_query_results
 
 
 DOWNLOAD_IMAGES = True
 SAVE_RESULTS = True
+USE_HTTP_CACHE = True
 STORE = 'appstore'
+SEARCH_URL = 'https://www.apple.com/us/search/{search_query}?src=globalnav'
 
 
 
-def get_app_urls(url):
+def get_app_urls(url, session=None, timeout=http_client.TIMEOUT, cache=None):
     """
     Given a search query url, get urls from apps and it logos.
     :param url: (str)
+    :param session: (requests.Session) session used for the request
+    :param timeout: (float) seconds to wait for the server
+    :param cache: (HttpCache) http cache for the search page
     :return app_urls: (list) apps url list
     :return img_urls: (list) app images url list
     """
-    response = requests.get(url)
-    html = response.content
+    html = http_client.fetch(url, session, timeout, cache, 'search')
     soup = BeautifulSoup(html, 'html.parser')
 
 
@@ -38,15 +44,28 @@ def get_app_urls(url):
     return app_urls, img_urls
 
 
-def get_app_data(app_url, img_url):
+def get_app_data(app_url, img_url, session=None, timeout=http_client.TIMEOUT, cache=None):
     """
     Gets app data from store.
     :param app_url: (str) store app url
     :param img_url: (str) image url
+    :param session: (requests.Session) session used for the request
+    :param timeout: (float) seconds to wait for the server
+    :param cache: (HttpCache) http cache for the app page
     :return app_data: (dict) dictionary with app features.
     """
-    response = requests.get(app_url)
-    html = response.content
+    html = http_client.fetch(app_url, session, timeout, cache)
+    return parse_app_data(html, app_url, img_url)
+
+
+def parse_app_data(html, app_url, img_url):
+    """
+    Parses the app data from the html of its store page.
+    :param html: (bytes) html of the store app page
+    :param app_url: (str) store app url
+    :param img_url: (str) image url
+    :return app_data: (dict) dictionary with app features, None if the page is not an app page.
+    """
     driver = BeautifulSoup(html, 'html.parser')
 
 
@@ -73,31 +92,63 @@ def get_app_data(app_url, img_url):
     return app_data
 
 
-def main(search_query_0, download_images_dir, download_results_file):
+def main(search_query_0, download_images_dir, download_results_file, search_url=SEARCH_URL,
+         max_workers=http_client.MAX_WORKERS, timeout=http_client.TIMEOUT, retries=http_client.RETRIES,
+         backoff=http_client.BACKOFF, cache=None):
+    """
+    Scraps the appstore search results of a query. The app pages are fetched concurrently (at most max_workers at the
+    same time) through a single connection pool, and the results keep the order of the search.
+    :param search_query_0: (str) search query, i.e. the client name
+    :param download_images_dir: (str) dir where the logos are downloaded
+    :param download_results_file: (str) json file where the apps data is saved
+    :param search_url: (str) search url template with a {search_query} field
+    :param max_workers: (int) max number of concurrent requests
+    :param timeout: (float) seconds to wait for the server on each request
+    :param retries: (int) max number of retries of a failed request
+    :param backoff: (float) backoff factor in seconds between retries
+    :param cache: (HttpCache) http cache for the pages and logos. If None and USE_HTTP_CACHE, the default one is used.
+    """
     search_query = search_query_0.replace(' ', '-')
-    url = f'https://www.apple.com/us/search/{search_query}?src=globalnav'
-    app_urls, img_urls = get_app_urls(url)
+    url = search_url.format(search_query=search_query)
+    session = http_client.create_session(retries=retries, backoff=backoff, pool_size=max_workers)
+    if cache is None and USE_HTTP_CACHE:
+        cache = HttpCache()
+    with span('scrap.search'):
+        app_urls, img_urls = get_app_urls(url, session, timeout, cache)
 
-    apps_data = []
+    pages = [(app_url, img_url) for app_url, img_url in zip(app_urls, img_urls) if img_url != '']
+    with span('scrap.pages'):
+        htmls = http_client.fetch_all([app_url for app_url, _ in pages], session, timeout, max_workers, cache)
 
-    for app_url, img_url in zip(app_urls, img_urls):
+    apps_data = []
+    downloads = []
 
-        if img_url == '':
+    for (app_url, img_url), html in zip(pages, htmls):
+        if html is None:
             continue
-        app_data = get_app_data(app_url, img_url)
+        with span('scrap.parse'):
+            app_data = parse_app_data(html, app_url, img_url)
         if app_data is None:
             continue
         app_name = app_data['app_name']
         if DOWNLOAD_IMAGES:
             image_path = f'{download_images_dir}/{app_name}.png'
-            download_image(img_url, image_path)
-            # download_image(img_url, download_images_dir)
+            downloads.append((img_url, image_path))
         else:
             image_path = None
 
         app_data['img_path'] = image_path
         apps_data.append(app_data)
 
+    if downloads:
+        with span('scrap.downloads'):
+            report = download_images(downloads, session, timeout, max_workers, cache=cache)
+        print(f'{STORE} logos: {summarize_downloads(report)}')
+
+    if cache is not None:
+        cache.save()
+        print(f'{STORE} http cache: {cache.stats}')
+
     if SAVE_RESULTS:
         save_query_results(apps_data, download_results_file, STORE)
 
@@ -1,11 +1,15 @@
 from bs4 import BeautifulSoup
-import requests
-from raw.src.utils import download_image, save_query_results
+from raw.src import http_client
+from raw.src.http_cache import HttpCache
+from raw.src.profiling import span
+from raw.src.utils import download_images, summarize_downloads, save_query_results
 
 
 DOWNLOAD_IMAGES = True
 SAVE_RESULTS = True
+USE_HTTP_CACHE = True
 STORE = 'googlePlay'
+SEARCH_URL = 'https://play.google.com/store/search?q={search_query}&c=apps'
 
 
 def get_principal_app_data(soup, url, download_images_dir):
@@ -23,25 +27,47 @@ def get_principal_app_data(soup, url, download_images_dir):
     principal_img_url = principal_img_el['src'].replace('s52', 's256')
 
     if DOWNLOAD_IMAGES:
-        download_image(principal_img_url, download_images_dir)
+        image_path = f'{download_images_dir}/{principal_app_name}.png'
+    else:
+        image_path = None
 
     principal_app_data = {
         'search_query': url,
         'app_name': principal_app_name,
         'developer': principal_developer,
         'img_url': principal_img_url,
+        'img_path': image_path,
         'app_url': principal_app_url
     }
 
     return principal_app_data
 
 
-def main(search_query_0, download_images_dir, download_results_file):
+def main(search_query_0, download_images_dir, download_results_file, search_url=SEARCH_URL,
+         max_workers=http_client.MAX_WORKERS, timeout=http_client.TIMEOUT, retries=http_client.RETRIES,
+         backoff=http_client.BACKOFF, cache=None):
+    """
+    Scraps the Google Play search results of a query. The logos are downloaded concurrently (at most max_workers at
+    the same time) through a single connection pool.
+    :param search_query_0: (str) search query, i.e. the client name
+    :param download_images_dir: (str) dir where the logos are downloaded
+    :param download_results_file: (str) json file where the apps data is saved
+    :param search_url: (str) search url template with a {search_query} field
+    :param max_workers: (int) max number of concurrent requests
+    :param timeout: (float) seconds to wait for the server on each request
+    :param retries: (int) max number of retries of a failed request
+    :param backoff: (float) backoff factor in seconds between retries
+    :param cache: (HttpCache) http cache for the pages and logos. If None and USE_HTTP_CACHE, the default one is used.
+    """
     search_query = search_query_0.replace(' ', '%20')
-    url = f'https://play.google.com/store/search?q={search_query}&c=apps'
-    response = requests.get(url)
-    html = response.content
-    soup = BeautifulSoup(html, 'html.parser')
+    url = search_url.format(search_query=search_query)
+    session = http_client.create_session(retries=retries, backoff=backoff, pool_size=max_workers)
+    if cache is None and USE_HTTP_CACHE:
+        cache = HttpCache()
+    with span('scrap.search'):
+        html = http_client.fetch(url, session, timeout, cache, 'search')
+    with span('scrap.parse'):
+        soup = BeautifulSoup(html, 'html.parser')
 
     try:
         principal_app_data = get_principal_app_data(soup, url, download_images_dir)
@@ -63,7 +89,6 @@ def main(search_query_0, download_images_dir, download_results_file):
 
         if DOWNLOAD_IMAGES:
             image_path = f'{download_images_dir}/{app_name}.png'
-            download_image(img_url, image_path)
         else:
             image_path = None
 
@@ -80,6 +105,16 @@ def main(search_query_0, download_images_dir, download_results_file):
 
         apps_data.append(app_data)
 
+    downloads = [(app_data['img_url'], app_data['img_path']) for app_data in apps_data if app_data['img_path']]
+    if downloads:
+        with span('scrap.downloads'):
+            report = download_images(downloads, session, timeout, max_workers, cache=cache)
+        print(f'{STORE} logos: {summarize_downloads(report)}')
+
+    if cache is not None:
+        cache.save()
+        print(f'{STORE} http cache: {cache.stats}')
+
     if SAVE_RESULTS:
         save_query_results(apps_data, download_results_file, STORE)
 
@@ -1,34 +1,44 @@
 import argparse
+import datetime
 import os
 from raw.src import utils
 from raw.src import scrap_appstore
 from raw.src import scrap_googlePlay
 
 
-def main(CLIENT, STORE, download_images_dir, download_results_file):
-    if STORE == 'googlePlay':
+def main(CLIENT, STORE, download_images_dir, download_results_file, clean=True):
+    """
+    Scraps the store for the client.
+    :param clean: (bool) If True (default) the images and results of the previous runs of the client are deleted
+    first. The incremental runs keep them, they are compared with the current run.
+    """
+    if clean:
         try:
-            utils.delete_client_img_dir(f'data/scrap/googlePlay/{CLIENT}')
+            utils.delete_client_img_dir(f'data/scrap/{STORE}/{CLIENT}')
         except FileNotFoundError:
             pass
+    if STORE == 'googlePlay':
         scrap_googlePlay.main(CLIENT, download_images_dir, download_results_file)
 
     elif STORE == 'appstore':
-        try:
-            utils.delete_client_img_dir(f'data/scrap/appstore/{CLIENT}')
-        except FileNotFoundError:
-            pass
         scrap_appstore.main(CLIENT, download_images_dir, download_results_file)
 
 
 if __name__ == '__main__':
     args_help = {
         'client': f"one of the following strings: {list(os.listdir('data/anchors/'))}",
+        'store': "'appstore' or 'googlePlay'",
     }
     parser = argparse.ArgumentParser()
     parser.add_argument('client', help=args_help['client'])
+    parser.add_argument('store', help=args_help['store'])
     args = parser.parse_args()
 
     CLIENT = args.client
+    STORE = args.store
+    DATE = str(datetime.datetime.now().date())
 
-    main(CLIENT)
+    main(CLIENT,
+         STORE,
+         download_images_dir=f'data/scrap/{STORE}/{CLIENT}/images/{DATE}',
+         download_results_file=f'data/scrap/{STORE}/{CLIENT}/query_results/{DATE}.json')
@@ -1,15 +1,37 @@
 import os
+import time
+import argparse
 import pandas as pd
 import numpy as np
-from raw.src.image_processor_modules import load_and_process_img
-from raw.src.image_processor_modules import descriptor_matches
-from raw.src.image_processor_modules import other_distances
-from raw.src.image_processor_modules import other_similarities
+from raw.src.anchor_cache import AnchorCache
+from raw.src.metric_engine import compute_metrics
+from raw.src.agg_engine import score_study
+from raw.src.profiling import span, timed
+from raw.src.orb_index import OrbIndex
+from raw.src.image_processor_modules import THRESHOLDS, KERNELS, FIDELITIES, param_grid
+from raw.src.image_processor_modules import load_img, process_img_grid, process_color_grid, downscale_grid
+from raw.src.image_processor_modules import orb_descriptors, color_hist
+from raw.src.image_processor_modules import SIMILARITY_METRICS, DISTANCE_METRICS, ORB_METRICS, COLOR_METRICS
 from raw.src.image_processor_modules import color_similarities
 from raw.src.image_processor_modules import color_distances
 
 
-def create_study(anchors_path, query_img_path, query_img_name):
+SWEEP = 'exhaustive'
+# First pass of the adaptive sweep: every COARSE_STEP-th threshold (and the last one) with all the kernels.
+COARSE_STEP = 4
+SWEEP_TOL = 0.02
+# Working resolution of the image metrics: a key of FIDELITIES, or 'pyramid' to compute the study at PYRAMID_LEVEL and
+# again at full resolution only when its score falls in PYRAMID_BAND (neither a clear impostor nor a clear match).
+FIDELITY = 'full'
+PYRAMID_LEVEL = 'quarter'
+PYRAMID_BAND = (0.55, 0.85)
+# Metric columns of a study, the ones computed when create_study gets no metrics.
+STUDY_METRICS = ORB_METRICS + SIMILARITY_METRICS + DISTANCE_METRICS + COLOR_METRICS
+
+
+@timed('study.create_study')
+def create_study(anchors_path, query_img_path, query_img_name, anchors=None, query_img=None, sweep=SWEEP,
+                 tol=SWEEP_TOL, orb_index=None, fidelity=FIDELITY, metrics=None):
     """
     This function performs a series of image comparison methods using mainly opencv library in order to capture the
     similarities and differences between each pair of images compared. Receives a query image which comes from a scrap
@@ -18,47 +40,329 @@ def create_study(anchors_path, query_img_path, query_img_name):
     @param anchors_path: (str) Path of the client anchors.
     @param query_img_path: (str) Path of the scrap image downloaded from the scrap process
     @param query_img_name: (str) A string used as an image identifier.
+    @param anchors: (list) Preprocessed anchors as returned by AnchorCache.load. If None they are loaded from the
+    anchors cache at anchors_path.
+    @param query_img: (np.array) The query image already decoded. If None it is decoded once from query_img_path.
+    @param sweep: (str) 'exhaustive' (default) compares every (th, k) of the grid. 'adaptive' compares a coarse subset
+    of thresholds first and refines only between thresholds where the metrics change, until the score converges
+    within tol. The thresholds that are not compared are linearly interpolated from their neighbours.
+    @param tol: (float) tolerance of the adaptive sweep, for the metrics change and the score convergence.
+    @param orb_index: (OrbIndex) ORB descriptors of the anchors stacked per (th, k). If None it is built from anchors.
+    @param fidelity: (str) resolution of the similarity and distance metrics: 'full' (default), 'half' or 'quarter' of
+    the cropped image, or 'pyramid'. The images are processed at full resolution and their variants downscaled before
+    the metrics, ORB and the color histograms always use the full resolution ones.
+    @param metrics: (iterable) metric columns computed, a subset of STUDY_METRICS (see metric_profile). The other ones
+    are left out of the study rows. If None all of them are computed.
     @return: (dict) A Dictionary containing all the similarity and distance metrics between query image and each anchor.
     """
-    adir = anchors_path
-    study = []
-    if len([ai for ai in os.listdir(adir) if ai.endswith('.png')]) == 0:
-        raise FileNotFoundError(f'Theres not anchors in the directory: {adir}')
+    return _sweep_study(anchors_path, query_img_path, query_img_name, anchors, query_img, sweep, tol, orb_index,
+                        fidelity, metrics)[0]
+
+
+def _sweep_study(anchors_path, query_img_path, query_img_name, anchors, query_img, sweep, tol, orb_index=None,
+                 fidelity=FIDELITY, metrics=None):
+    """
+    Study of create_study.
+    @return: (list, int, bool) the study rows, the number of (th, k) variants evaluated at the final resolution and
+    if the 'pyramid' fidelity escalated the study to full resolution.
+    """
+    if fidelity not in FIDELITIES and fidelity != 'pyramid':
+        raise ValueError(f"fidelity must be one of {list(FIDELITIES) + ['pyramid']}, not {fidelity!r}")
+    metrics = STUDY_METRICS if metrics is None else tuple(metric for metric in STUDY_METRICS if metric in metrics)
+    if anchors is None:
+        with span('study.load_anchors'):
+            anchors = AnchorCache(anchors_path).load()
+    if orb_index is None:
+        orb_index = OrbIndex(anchors)
+    qimpath = query_img_path
+    assert qimpath.endswith('.png'), "Not a png image format provided"
+    if query_img is None:
+        with span('study.decode'):
+            query_img = load_img(qimpath)
+
+    # All the query variants are derived in memory from the decoded image and shared by every anchor.
+    with span('study.query_grid'):
+        qimgs = process_img_grid(query_img, THRESHOLDS, KERNELS)
+        qdes = {}
+        qorb = {}
+        qhists = [color_hist(qcimg) for qcimg in process_color_grid(query_img, KERNELS)]
+    row_index = {'path': qimpath, 'name': query_img_name}
 
-    for aimname in [ai for ai in os.listdir(adir) if ai.endswith('.png')]:
-        qimpath = query_img_path
-        assert qimpath.endswith('.png'), "Not a png image format provided"
-        aimpath = f'{adir}/{aimname}'
+    def study_at(factor):
+        with span('study.downscale'):
+            metric_imgs = [_scaled_gray(anchor, factor) for anchor in anchors], downscale_grid(qimgs, factor)
+
+        def evaluate(th_indices):
+            return _evaluate_thresholds(anchors, orb_index, qimgs, qdes, qorb, qhists, th_indices, row_index,
+                                        metric_imgs, factor.bit_length() - 1, metrics)
+
+        return _sweep_rows(evaluate, len(anchors), sweep, tol)
+
+    if fidelity == 'pyramid':
+        study, n_variants = study_at(FIDELITIES[PYRAMID_LEVEL])
+        if not PYRAMID_BAND[0] <= _study_score(study) <= PYRAMID_BAND[1]:
+            return study, n_variants, False
+        # Borderline score, the query variants, ORB matches and color histograms are reused at full resolution.
+        return *study_at(FIDELITIES['full']), True
+    return *study_at(FIDELITIES[fidelity]), False
+
+
+def _sweep_rows(evaluate, n_anchors, sweep, tol):
+    """
+    Sweeps the (th, k) grid with evaluate (see _evaluate_thresholds).
+    @return: (list, int) the study rows in the exhaustive order and the number of (th, k) variants evaluated.
+    """
+    n_th = len(THRESHOLDS)
+    if sweep == 'exhaustive':
+        rows = evaluate(range(n_th))
+    elif sweep == 'adaptive':
+        rows = evaluate(sorted(set(range(0, n_th, COARSE_STEP)) | {n_th - 1}))
+        evaluated = sorted(rows)
+        arrays = {ti: _metric_array(rows[ti]) for ti in rows}
+        scale = _metric_scale(arrays)
+        # Coarse intervals are refined where the metrics change, the finer ones where the interpolation failed.
+        refine = [(a, b) for a, b in zip(evaluated[:-1], evaluated[1:])
+                  if b - a > 1 and _metrics_change(arrays, scale, a, b) > tol]
+        score = _study_score(_fill_study(rows, n_anchors))
+        while refine:
+            new_rows = evaluate([(a + b) // 2 for a, b in refine])
+            rows.update(new_rows)
+            arrays.update({ti: _metric_array(new_rows[ti]) for ti in new_rows})
+            scale = _metric_scale(arrays)
+            previous_score, score = score, _study_score(_fill_study(rows, n_anchors))
+            if abs(score - previous_score) <= tol:
+                break
+            refine = [interval
+                      for a, b in refine if _metrics_change(arrays, scale, a, b, (a + b) // 2) > tol
+                      for interval in ((a, (a + b) // 2), ((a + b) // 2, b)) if interval[1] - interval[0] > 1]
+    else:
+        raise ValueError(f"sweep must be 'exhaustive' or 'adaptive', not {sweep!r}")
+
+    return _fill_study(rows, n_anchors), len(rows) * len(KERNELS)
+
+
+def _scaled_gray(anchor, factor):
+    # The downscaled variants of an anchor are computed once and kept with the anchor for the next queries.
+    if factor == 1:
+        return anchor['gray']
+    scaled = anchor.setdefault('scaled_gray', {})
+    if factor not in scaled:
+        scaled[factor] = downscale_grid(anchor['gray'], factor)
+    return scaled[factor]
+
+
+def _evaluate_thresholds(anchors, orb_index, qimgs, qdes, qorb, qhists, th_indices, row_index, metric_imgs,
+                         msssim_skip, metrics):
+    """
+    Compares the query with every anchor for the given thresholds (all the kernels). The ORB descriptors and matches
+    of the query variants are kept in qdes and qorb, the image metrics are computed on metric_imgs (the anchor and
+    query variants at the working resolution). Only the metric columns in metrics are computed.
+    @return: (dict) threshold index -> list of rows, anchors in the outer loop and kernels in the inner one.
+    """
+    nk = len(KERNELS)
+    indices = [ti * nk + kk for ti in th_indices for kk in range(nk)]
+    orb_metrics = [metric for metric in ORB_METRICS if metric in metrics]
+    image_metrics = [metric for metric in SIMILARITY_METRICS + DISTANCE_METRICS if metric in metrics]
+    color_metrics = [metric for metric in COLOR_METRICS if metric in metrics]
+    if orb_metrics:
+        with span('study.orb_descriptors'):
+            for ii in indices:
+                if ii not in qdes:
+                    qdes[ii] = orb_descriptors(qimgs[ii])
+        # Each query variant is matched against all the anchors at once.
+        with span('study.orb_match'):
+            for ii in indices:
+                if ii not in qorb:
+                    qorb[ii] = orb_index.match(ii, qdes[ii])
+    anchor_imgs, query_imgs = metric_imgs
+
+    rows = {ti: [] for ti in th_indices}
+    for aa, anchor in enumerate(anchors):
         owned = np.nan
-        for th in range(90, 230, 10):  # (90, 215, 5):
-            for k in range(3, 9, 2):  # (3, 13, 2):
-                aimg = load_and_process_img(aimpath, 'anchor', th, k)
-                qimg = load_and_process_img(qimpath, 'query', th, k)
-                # Pregunta. No debería ser aimpath en alguna de las dos lineas siguientes?
-                acimg = load_and_process_img(aimpath, 'anchor', th, k, keep_color=True)
-                qcimg = load_and_process_img(qimpath, 'query', th, k, keep_color=True)
-
-                n, m = descriptor_matches(aimg, qimg)
-                similarities = other_similarities(aimg, qimg)
-                distances = other_distances(aimg, qimg)
-                c_similarities = color_similarities(acimg, qcimg)
-                c_distances = color_distances(acimg, qcimg)
-                row = {
-                    'path': qimpath,
-                    'name': query_img_name,
-                    'orb_matches_sim': n,
-                    'orb_mean_dist': m,
-                    'owned': owned,
-                }
-                row = row | similarities
-                row = row | distances
-                row = row | c_similarities
-                row = row | c_distances
+        # The sewar metrics of all the requested variants are computed in one batch.
+        with span('study.metrics'):
+            values = {}
+            if image_metrics:
+                values = compute_metrics(anchor_imgs[aa][indices], query_imgs[indices], metrics=image_metrics,
+                                         msssim_skip=msssim_skip)
+        for jj, ii in enumerate(indices):
+            ti, kk = divmod(ii, nk)
+
+            row = row_index.copy()
+            if orb_metrics:
+                n, m = int(qorb[ii][0][aa]), float(qorb[ii][1][aa])
+                row = row | {metric: value for metric, value in zip(ORB_METRICS, (n, m)) if metric in orb_metrics}
+            row['owned'] = owned
+            similarities = {metric: values[metric][jj] for metric in SIMILARITY_METRICS if metric in values}
+            distances = {metric: values[metric][jj] for metric in DISTANCE_METRICS if metric in values}
+            row = row | similarities
+            row = row | distances
+            if color_metrics:
+                with span('study.color'):
+                    c_similarities = color_similarities(anchor['hist'][kk], qhists[kk])
+                    c_distances = color_distances(anchor['hist'][kk], qhists[kk])
+                row = row | {metric: value for metric, value in (c_similarities | c_distances).items()
+                             if metric in color_metrics}
 
-                study.append(row)
+            rows[ti].append(row)
+    return rows
+
+
+def _fill_study(rows, n_anchors):
+    """
+    Builds the study in the exhaustive order (anchor, th, k) from the rows of the evaluated thresholds. The rows of
+    the thresholds that were not evaluated are linearly interpolated between the nearest evaluated ones.
+    """
+    evaluated = sorted(rows)
+    nk = len(KERNELS)
+    study = []
+    for aa in range(n_anchors):
+        for ti in range(evaluated[0], evaluated[-1] + 1):
+            for kk in range(nk):
+                jj = aa * nk + kk
+                if ti in rows:
+                    study.append(rows[ti][jj])
+                    continue
+                lo = max(t for t in evaluated if t < ti)
+                hi = min(t for t in evaluated if t > ti)
+                w = (ti - lo) / (hi - lo)
+                row_lo, row_hi = rows[lo][jj], rows[hi][jj]
+                study.append({key: (value if isinstance(value, str) else (1 - w) * value + w * row_hi[key])
+                              for key, value in row_lo.items()})
     return study
 
 
+def _metric_array(rows):
+    # Metric columns of the rows of a threshold, one row per (anchor, kernel).
+    columns = [col for col in rows[0] if ('sim' in col) or ('dist' in col)] if rows else []
+    return np.array([[row[col] for col in columns] for row in rows], dtype=np.float64).reshape(len(rows), len(columns))
+
+
+def _metric_scale(arrays):
+    # Largest absolute value of each metric over the evaluated thresholds, NaN if it has no value.
+    return np.fmax.reduce(np.abs(np.concatenate(list(arrays.values()))), axis=0)
+
+
+def _metrics_change(arrays, scale, a, b, mid=None):
+    """
+    Largest mean change of a metric between the thresholds a and b, relative to the largest value of the metric. If
+    mid is given, the largest mean error of the linear interpolation between a and b at mid instead.
+    @param arrays: (dict) threshold index -> metric values of its rows (see _metric_array)
+    @param scale: (np.array) largest absolute value of each metric (see _metric_scale)
+    """
+    # Infinite distances give NaN changes, they are left out.
+    with np.errstate(invalid='ignore'):
+        if mid is None:
+            diff = arrays[a] - arrays[b]
+        else:
+            w = (mid - a) / (b - a)
+            diff = arrays[mid] - ((1 - w) * arrays[a] + w * arrays[b])
+        known = ~np.isnan(diff)
+        counts = known.sum(axis=0)
+        valid = (counts > 0) & (scale > 0)
+        changes = np.where(known, np.abs(diff), 0).sum(axis=0)[valid] / counts[valid] / scale[valid]
+    changes = changes[~np.isnan(changes)]
+    return max(float(changes.max()), 0.0) if len(changes) else 0.0
+
+
+def _study_score(study):
+    return next(iter(score_study(study, processed=False).values()))['score']
+
+
+def sweep_report(anchors_path, query_img_paths, tol=SWEEP_TOL):
+    """
+    Deviation of the adaptive sweep w.r.t the exhaustive one, for a set of query images.
+    @param anchors_path: (str) Path of the client anchors.
+    @param query_img_paths: (list) Paths of the query images.
+    @param tol: (float) tolerance of the adaptive sweep.
+    @return: (pd.DataFrame) One row per query image with the exhaustive and adaptive scores, their absolute deviation,
+    the fraction of the (th, k) grid evaluated by the adaptive sweep and the time of each sweep.
+    """
+    anchors = AnchorCache(anchors_path).load()
+    orb_index = OrbIndex(anchors)
+    rows = []
+    for qimpath in query_img_paths:
+        query_img = load_img(qimpath)
+        row = {'name': qimpath.split('/')[-1]}
+        for sweep in ('exhaustive', 'adaptive'):
+            start = time.perf_counter()
+            study, n_variants, _ = _sweep_study(anchors_path, qimpath, row['name'], anchors, query_img, sweep, tol,
+                                                orb_index)
+            row[f'{sweep}_time'] = time.perf_counter() - start
+            row[f'{sweep}_score'] = _study_score(study)
+            if sweep == 'adaptive':
+                row['evaluated'] = n_variants / len(param_grid(THRESHOLDS, KERNELS))
+        row['deviation'] = abs(row['adaptive_score'] - row['exhaustive_score'])
+        rows.append(row)
+    return pd.DataFrame(rows, columns=['name', 'exhaustive_score', 'adaptive_score', 'deviation', 'evaluated',
+                                       'exhaustive_time', 'adaptive_time'])
+
+
+def fidelity_report(anchors_path, report_path, images_dir, fidelities=('half', 'quarter', 'pyramid'), sweep=SWEEP,
+                    tol=SWEEP_TOL):
+    """
+    Score agreement and speed of the reduced fidelities w.r.t full resolution, on the images of an existing report
+    (reports/{client}/scrapped_images_vs_anchors_{store}.csv).
+    @param anchors_path: (str) Path of the client anchors.
+    @param report_path: (str) csv report with columns name, developer, valid and score.
+    @param images_dir: (str) dir of the scrapped images of the report.
+    @param fidelities: (iterable) fidelities compared with 'full'.
+    @param sweep: (str) sweep of the (th, k) grid.
+    @param tol: (float) tolerance of the adaptive sweep.
+    @return: (pd.DataFrame, pd.DataFrame) One row per image of the report with its valid and report score, and the
+    score and time of each fidelity (columns '{fidelity}_score' and '{fidelity}_time', NaN if the image is missing),
+    and for 'pyramid' if the image was escalated to full resolution (column 'pyramid_escalated').
+    And a summary per fidelity with the mean and max absolute deviation from the full resolution score, the spearman
+    correlation of the scores, if the top scored image is the same, the total time, the speedup and (for 'pyramid')
+    the fraction of images escalated to full resolution.
+    """
+    anchors = AnchorCache(anchors_path).load()
+    orb_index = OrbIndex(anchors)
+    report = pd.read_csv(report_path)
+    fidelities = ['full'] + [fidelity for fidelity in fidelities if fidelity != 'full']
+    rows = []
+    for name, valid, score in zip(report['name'], report['valid'], report['score']):
+        qimpath = f'{images_dir}/{name}'
+        row = {'name': name, 'valid': valid, 'report_score': score}
+        query_img = load_img(qimpath)
+        if query_img is not None:
+            for fidelity in fidelities:
+                start = time.perf_counter()
+                study, _, escalated = _sweep_study(anchors_path, qimpath, name, anchors, query_img, sweep, tol,
+                                                   orb_index, fidelity)
+                row[f'{fidelity}_time'] = time.perf_counter() - start
+                row[f'{fidelity}_score'] = _study_score(study)
+                if fidelity == 'pyramid':
+                    row['pyramid_escalated'] = escalated
+        rows.append(row)
+    columns = ['name', 'valid', 'report_score'] + [f'{fidelity}_{col}' for fidelity in fidelities
+                                                   for col in ('score', 'time')]
+    if 'pyramid' in fidelities:
+        columns.append('pyramid_escalated')
+    results = pd.DataFrame(rows, columns=columns)
+
+    scored = results.dropna(subset=['full_score'])
+    full = scored['full_score']
+    summary = []
+    for fidelity in fidelities:
+        scores = scored[f'{fidelity}_score']
+        deviation = (scores - full).abs()
+        item = {'fidelity': fidelity,
+                'images': len(scored),
+                'mean_deviation': deviation.mean(),
+                'max_deviation': deviation.max(),
+                'spearman': scores.corr(full, method='spearman'),
+                'same_top': bool(len(scored)) and scores.idxmax() == full.idxmax(),
+                'time': scored[f'{fidelity}_time'].sum(),
+                }
+        item['speedup'] = scored['full_time'].sum() / item['time'] if item['time'] else np.nan
+        if fidelity == 'pyramid':
+            item['escalated'] = scored['pyramid_escalated'].astype(float).mean()
+        summary.append(item)
+    return results, pd.DataFrame(summary).set_index('fidelity')
+
+
+@timed('agg.process_study')
 def process_study(study_, output='list'):
     """
     This functions receives the study computed for a set of images using function 'create_study' and performs some
@@ -95,6 +399,7 @@ def process_study(study_, output='list'):
         raise TypeError("output param must be 'list' or 'df'")
 
 
+@timed('agg.agg_study')
 def agg_study(study):
     """
     If there are many anchors to compare with, for each metric the mean is computed. i.e. for a metric m, comparing a
@@ -185,6 +490,7 @@ def process_agg(_, output='list'):
         raise TypeError("output param must be 'list' or 'df'")
 
 
+@timed('agg.collapse_agg')
 def collapse_agg(agg):
     """
     This function takes the aggregate dataframe computed at 'agg_study' function and computes the mean for all of these
@@ -218,4 +524,17 @@ def collapse_agg(agg):
     collapsed = pd.concat([agg_index, collapsed_metrics], axis=1)
     collapsed = collapsed.rename(columns={0: 'score'})
 
-    return collapsed
\ No newline at end of file
+    return collapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Deviation of the adaptive sweep w.r.t the exhaustive one.')
+    parser.add_argument('anchors_path', help='data/anchors/{client}/{store}')
+    parser.add_argument('images_dir', help='dir of the query images')
+    parser.add_argument('--tol', type=float, default=SWEEP_TOL)
+    args = parser.parse_args()
+
+    query_img_paths = sorted(f'{args.images_dir}/{name}' for name in os.listdir(args.images_dir) if name.endswith('.png'))
+    report = sweep_report(args.anchors_path, query_img_paths, args.tol)
+    print(report)
+    print(report[['deviation', 'evaluated', 'exhaustive_time', 'adaptive_time']].describe())
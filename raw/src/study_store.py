@@ -0,0 +1,174 @@
+import os
+import re
+import glob
+import pathlib
+import numpy as np
+import pandas as pd
+
+
+STRING_COLUMNS = ('path', 'name')
+
+
+def encode_study(study):
+    """
+    Converts a study (list of row dicts, as returned by create_study or process_study) to columns: the metrics as
+    float32 arrays and the string columns dictionary encoded (int32 codes plus the unique values).
+    @param study: (list) study rows
+    @return: (dict) array name -> np.array, with the column order in 'columns'
+    """
+    columns = list(study[0].keys()) if study else []
+    arrays = {'columns': np.array(columns)}
+    for col in columns:
+        values = [row.get(col) for row in study]
+        if col in STRING_COLUMNS:
+            uniques, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+            arrays[f'dict:{col}'] = uniques
+            arrays[f'codes:{col}'] = codes.astype(np.int32)
+        else:
+            arrays[f'col:{col}'] = np.array([np.nan if value is None else value for value in values], dtype=np.float32)
+    return arrays
+
+
+def concat_encoded(parts):
+    """
+    Concatenates encoded studies with the same columns, merging the dictionaries of the string columns.
+    @param parts: (list) encoded studies (see encode_study)
+    @return: (dict) encoded study
+    """
+    parts = [part for part in parts if len(part['columns'])]
+    if not parts:
+        return {'columns': np.array([])}
+    arrays = {'columns': parts[0]['columns']}
+    for col in parts[0]['columns']:
+        if col in STRING_COLUMNS:
+            values = np.concatenate([part[f'dict:{col}'][part[f'codes:{col}']] for part in parts])
+            uniques, codes = np.unique(values, return_inverse=True)
+            arrays[f'dict:{col}'] = uniques
+            arrays[f'codes:{col}'] = codes.astype(np.int32)
+        else:
+            arrays[f'col:{col}'] = np.concatenate([part[f'col:{col}'] for part in parts])
+    return arrays
+
+
+def decode_study(arrays):
+    """
+    Inverse of encode_study.
+    @param arrays: (dict) encoded study
+    @return: (pd.DataFrame) study, one row per (query, anchor, th, k)
+    """
+    data = {}
+    for col in arrays['columns']:
+        if col in STRING_COLUMNS:
+            data[col] = arrays[f'dict:{col}'][arrays[f'codes:{col}']].astype(object)
+        else:
+            data[col] = arrays[f'col:{col}'].astype(np.float64)
+    return pd.DataFrame(data, columns=list(arrays['columns']))
+
+
+def save_study(study, path):
+    """
+    Writes a study as a compressed npz file (see encode_study). The file is written to a temporary file and then
+    renamed, so path never holds a partial study.
+    @param study: (list or dict) study rows, or an already encoded study
+    @param path: (str) path of the npz file
+    """
+    arrays = study if isinstance(study, dict) else encode_study(study)
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as handle:
+        np.savez_compressed(handle, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_encoded(path):
+    """
+    @param path: (str) path of a npz file written by save_study
+    @return: (dict) encoded study
+    """
+    with np.load(path) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def load_study(path):
+    """
+    Loads a study written by save_study. The result can be passed to agg_study as it is.
+    @param path: (str) path of the npz file
+    @return: (pd.DataFrame) study
+    """
+    return decode_study(load_encoded(path))
+
+
+def run_study_path(client, store, run_id, misc_dir='data/misc'):
+    return f'{misc_dir}/{client}/studies/{store}_{run_id}.npz'
+
+
+def load_run_study(client, store, run_id, misc_dir='data/misc'):
+    """
+    Loads the study of a comparison run, including the parts written by worker processes and the part files not
+    compacted yet.
+    @param client: (str) client name
+    @param store: (str) 'appstore' or 'googlePlay'
+    @param run_id: (str) run id of the ComparisonClient that computed the study
+    @param misc_dir: (str) misc dir
+    @return: (pd.DataFrame) study of the run
+    """
+    paths = run_study_paths(client, store, run_id, misc_dir)
+    if not paths:
+        raise FileNotFoundError(f'There is no study for the run: {run_study_path(client, store, run_id, misc_dir)}')
+    return pd.concat([load_study(path) for path in paths], ignore_index=True)
+
+
+def run_study_paths(client, store, run_id, misc_dir='data/misc'):
+    """
+    @return: (list) files of the study of a comparison run: its npz file, the ones of the worker processes
+    ('-{pid}.npz') and their part files ('.part{n}.npz').
+    """
+    stem = run_study_path(client, store, run_id, misc_dir)[:-len('.npz')]
+    return sorted(set(glob.glob(f'{stem}.npz') + glob.glob(f'{stem}-*.npz') + glob.glob(f'{stem}.part*.npz')))
+
+
+def compact_run_study(client, store, run_id, misc_dir='data/misc'):
+    """
+    Merges all the files of the study of a comparison run (see run_study_paths) into its npz file. Call it once the
+    run is finished.
+    @return: (str) path of the run study, None if the run has no study
+    """
+    path = run_study_path(client, store, run_id, misc_dir)
+    paths = run_study_paths(client, store, run_id, misc_dir)
+    if paths and paths != [path]:
+        _merge(paths, path)
+    return path if paths else None
+
+
+def _merge(paths, path):
+    save_study(concat_encoded([load_encoded(part_path) for part_path in paths]), path)
+    for part_path in paths:
+        if part_path != path:
+            os.unlink(part_path)
+
+
+class StudyStore:
+
+    def __init__(self, path):
+        """
+        Study of a comparison run. The study of each query image is written to its own part file next to path
+        ('{path stem}.part{n}.npz', float32 metrics) as soon as it is computed, so an append costs the size of the
+        study and not of the whole run. load_run_study reads the parts, compact_run_study merges them into path.
+        @param path: (str) path of the npz file
+        """
+        self.path = path
+        self.stem = path[:-len('.npz')]
+        # A resumed run keeps the parts of the previous attempt.
+        numbers = [int(match.group(1)) for match in (re.search(r'\.part(\d+)\.npz$', part_path)
+                                                      for part_path in glob.glob(f'{self.stem}.part*.npz')) if match]
+        self.n_parts = max(numbers, default=-1) + 1
+
+    def append(self, study):
+        """
+        Saves the rows of a study as a new part of the run study.
+        @param study: (list) study rows
+        """
+        if study:
+            save_study(encode_study(study), f'{self.stem}.part{self.n_parts:06d}.npz')
+            self.n_parts += 1
+
@@ -0,0 +1,98 @@
+import os
+import glob
+import shutil
+import pathlib
+import tempfile
+import numpy as np
+
+
+TENSORS_DIR = 'data/tensors'
+
+
+def save_tensors(path, arrays):
+    """
+    Writes a set of arrays as uncompressed npy files in the dir path, so they can be memory mapped (see
+    load_tensors). The arrays are written to a temporary dir that then replaces path, so a reader never sees a partial
+    set of arrays and the processes that already mapped the previous arrays keep reading them.
+    @param path: (str) dir of the arrays
+    @param arrays: (dict) name -> np.array
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    pathlib.Path(tmp_path).mkdir(parents=True)
+    for name, array in arrays.items():
+        np.save(f'{tmp_path}/{name}.npy', np.asarray(array), allow_pickle=False)
+    old_path = f'{path}.{os.getpid()}.old'
+    try:
+        os.rename(path, old_path)
+    except FileNotFoundError:
+        old_path = None
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Written at the same time by another process, its arrays are the same.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    if old_path is not None:
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+def load_tensors(path):
+    """
+    Maps the arrays written by save_tensors, read only. The pages are shared by all the processes that map the same
+    files, so N workers attached to the same arrays hold them once in memory, and nothing is copied until used.
+    @param path: (str) dir of the arrays
+    @return: (dict) name -> np.memmap, None if path does not exist or is incomplete
+    """
+    try:
+        return {os.path.basename(file_path)[:-len('.npy')]: np.load(file_path, mmap_mode='r', allow_pickle=False)
+                for file_path in glob.glob(f'{path}/*.npy')} or None
+    except (OSError, ValueError):
+        return None
+
+
+def create_run_dir(run_id, tensors_dir=TENSORS_DIR):
+    """
+    Creates the dir where the query images decoded during a run are shared, '{tensors_dir}/runs/{run_id}-{suffix}'.
+    Remove it with remove_run_dir once the processes of the run are done.
+    @param run_id: (str) identifier of the run
+    @param tensors_dir: (str) dir of the tensor store
+    @return: (str) new dir, pass it as tensors_dir to share_query_img and attach_query_img
+    """
+    pathlib.Path(f'{tensors_dir}/runs').mkdir(parents=True, exist_ok=True)
+    return tempfile.mkdtemp(prefix=f'{run_id}-', dir=f'{tensors_dir}/runs')
+
+
+def remove_run_dir(path):
+    # The processes that still map the images keep reading them, the space is freed once they unmap them.
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def query_tensor_path(sha1, tensors_dir=TENSORS_DIR):
+    return f'{tensors_dir}/queries/{sha1[:2]}/{sha1}'
+
+
+def share_query_img(sha1, query_img, tensors_dir=TENSORS_DIR):
+    """
+    Writes a decoded query image once, keyed by the sha1 of its file, so other processes attach to it instead of
+    decoding it again.
+    @param sha1: (str) sha1 of the image file
+    @param query_img: (np.array) decoded image
+    @param tensors_dir: (str) dir of the tensor store
+    @return: (np.memmap) the shared image
+    """
+    path = query_tensor_path(sha1, tensors_dir)
+    tensors = load_tensors(path)
+    if tensors is None:
+        save_tensors(path, {'img': query_img})
+        tensors = load_tensors(path)
+    return tensors['img']
+
+
+def attach_query_img(sha1, tensors_dir=TENSORS_DIR):
+    """
+    @param sha1: (str) sha1 of the image file
+    @param tensors_dir: (str) dir of the tensor store
+    @return: (np.memmap) query image shared with share_query_img, None if it was not shared
+    """
+    tensors = load_tensors(query_tensor_path(sha1, tensors_dir))
+    return tensors['img'] if tensors is not None else None
@@ -4,9 +4,11 @@ import datetime
 import json
 import os
 import shutil
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
-import cv2
+from raw.src import http_client
+from raw.src import logo_store
+from raw.src.profiling import span
 
 
 def scroll_down(driver):
@@ -35,39 +37,78 @@ def scroll_down(driver):
 
 
 
-def download_image(img_url, image_path):
+def download_image(img_url, image_path, session=None, timeout=http_client.TIMEOUT, cache=None):
     """
-    Downloads an image into dir_name, given its url.
-    :param url: (str) image url
-    :param dir_name: (str) client name
-    :param store: (str) App Store or GooglePlay
-    :return: None
+    Downloads an image given its url. The image is kept in the logo store by its content hash (see logo_store) and
+    image_path is a reference to it, so image_path never holds a partial download.
+    :param img_url: (str) image url
+    :param image_path: (str) path where the image is stored
+    :param session: (requests.Session) session used for the request, a new one is created if None
+    :param timeout: (float) seconds to wait for the server
+    :param cache: (HttpCache) if given the image is served from / stored in this cache
+    :return sha1: (str) sha1 hex digest of the image
     """
-    dirs_in_path = image_path.split("/")[:-1]
-    dir_name = "/".join(dirs_in_path)
+    with span('download.fetch'):
+        content = http_client.fetch(img_url, session, timeout, cache, 'image')
+    with span('download.store'):
+        return logo_store.store_image(content, image_path)
 
-    pathlib.Path(f'{dir_name}').mkdir(
-        parents=True,
-        exist_ok=True
-    )
-    img_name = img_url.replace('/', '-')
-    if img_name.endswith('.png'):
-        urllib.request.urlretrieve(img_url, image_path)
-    else:
-        urllib.request.urlretrieve(img_url, image_path)
-
-
-    # with open(f"{download_images_dir}/{url.replace('/', ' ')}.png", 'wb') as handle:
-    #     response = requests.get(url, stream=True)
-    #
-    #     if not response.ok:
-    #         print(response)
-    #
-    #     for block in response.iter_content(1024):
-    #         if not block:
-    #             break
-    #
-    #         handle.write(block)
+
+def download_images(downloads, session=None, timeout=http_client.TIMEOUT, max_workers=http_client.MAX_WORKERS,
+                    overwrite=False, cache=None):
+    """
+    Downloads a list of images concurrently, at most max_workers at the same time, sharing the connections of session.
+    :param downloads: (list) (img_url, image_path) pairs
+    :param session: (requests.Session) session used for the requests, a new one is created if None
+    :param timeout: (float) seconds to wait for the server on each request
+    :param max_workers: (int) max number of concurrent downloads
+    :param overwrite: (bool) if False the images already in disk are not downloaded again
+    :param cache: (HttpCache) if given the images are served from / stored in this cache
+    :return report: (list) one dict per pair, in the same order, with keys 'url', 'path', 'status' ('downloaded',
+    'skipped' or 'failed'), 'latency' (seconds), 'error' and 'sha1' (of the downloaded image).
+    """
+    session = session if session is not None else http_client.create_session(pool_size=max_workers)
+    claimed_paths = set()
+
+    def _download(img_url, image_path):
+        item = {'url': img_url, 'path': image_path, 'status': 'skipped', 'latency': 0.0, 'error': None, 'sha1': None}
+        start = time.perf_counter()
+        try:
+            item['sha1'] = download_image(img_url, image_path, session, timeout, cache)
+            item['status'] = 'downloaded'
+        except Exception as E:
+            print(f"Couldn't download {img_url}: {E}")
+            item['status'] = 'failed'
+            item['error'] = repr(E)
+        item['latency'] = time.perf_counter() - start
+        return item
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for img_url, image_path in downloads:
+            # Two apps with the same name share the image path, only the first one is downloaded.
+            if image_path in claimed_paths or (not overwrite and os.path.exists(image_path)):
+                futures.append({'url': img_url, 'path': image_path, 'status': 'skipped', 'latency': 0.0,
+                                'error': None, 'sha1': None})
+                continue
+            claimed_paths.add(image_path)
+            futures.append(executor.submit(_download, img_url, image_path))
+
+    return [future if isinstance(future, dict) else future.result() for future in futures]
+
+
+def summarize_downloads(report):
+    """
+    One line summary of the report returned by download_images.
+    :param report: (list) download_images report
+    :return: (str) counts per status and latency of the downloads
+    """
+    counts = {status: sum(item['status'] == status for item in report) for status in ('downloaded', 'skipped', 'failed')}
+    latencies = sorted(item['latency'] for item in report if item['status'] != 'skipped')
+    summary = ', '.join(f'{count} {status}' for status, count in counts.items())
+    if latencies:
+        summary += f' | latency max {latencies[-1]:.2f}s, median {latencies[len(latencies) // 2]:.2f}s'
+    return summary
 
 
 def save_query_results(results_dict, file_path, store):
@@ -106,6 +147,8 @@ def create_anchor_dirs():
 
 
 def create_train_ds(client, store, save):
+    # Imported here, opencv is only needed by this interactive tool and not by the scrapers.
+    import cv2
     if save:
         save_dir = f'data/anchors/{client}/{store}/'
         create_anchor_dirs()
@@ -0,0 +1,76 @@
+import json
+import cv2
+import numpy as np
+import pytest
+
+LOGO_SIZE = 256
+N_ANCHORS = 2
+
+
+def make_logo(rng, size=LOGO_SIZE):
+    """
+    App logo like image: a colored background with blocks, circles and a letter inside the 18px store border.
+    """
+    def color():
+        return tuple(int(c) for c in rng.integers(0, 256, 3))
+
+    img = np.full((size, size, 3), 255, np.uint8)
+    cv2.rectangle(img, (18, 18), (size - 18, size - 18), color(), -1)
+    for _ in range(int(rng.integers(1, 4))):
+        x0, y0 = rng.integers(18, size // 2, 2)
+        x1, y1 = rng.integers(size // 2, size - 18, 2)
+        cv2.rectangle(img, (int(x0), int(y0)), (int(x1), int(y1)), color(), -1)
+    center = tuple(int(c) for c in rng.integers(40, size - 40, 2))
+    cv2.circle(img, center, int(rng.integers(10, size // 4)), color(), int(rng.choice([-1, 3, 6])))
+    cv2.putText(img, chr(int(rng.integers(65, 91))), (40, size // 2 + 30), cv2.FONT_HERSHEY_SIMPLEX, 3.0, color(), 6)
+    return img
+
+
+def perturb_logo(img, rng):
+    """
+    Near duplicate of a logo: small rotation, shift and scale, brightness change and noise.
+    """
+    size = img.shape[0]
+    matrix = cv2.getRotationMatrix2D((size / 2, size / 2), float(rng.uniform(-4, 4)), float(rng.uniform(0.95, 1.05)))
+    matrix[:, 2] += rng.uniform(-4, 4, 2)
+    out = cv2.warpAffine(img, matrix, (size, size), borderValue=(255, 255, 255))
+    return np.clip(out * rng.uniform(0.9, 1.1) + rng.normal(0, 4, out.shape), 0, 255).astype(np.uint8)
+
+
+@pytest.fixture
+def logos():
+    """
+    @return: (function) n, seed -> (list, list, list) n logos, a near duplicate of each one and n unrelated logos
+    """
+    def make(n, seed=0):
+        rng = np.random.default_rng(seed)
+        originals = [make_logo(rng) for _ in range(n)]
+        return originals, [perturb_logo(logo, rng) for logo in originals], [make_logo(rng) for _ in range(n)]
+    return make
+
+
+@pytest.fixture
+def acme(tmp_path, monkeypatch):
+    """
+    Workspace of the client 'Acme' on the appstore, the current dir while the test runs: N_ANCHORS anchors at
+    data/anchors/Acme/appstore, its developer 'Acme Inc' in files/clients.json, and query images at
+    queries/copy_{i}.png (near duplicate of anchor i) and queries/other_{i}.png (unrelated logo).
+    @return: (dict) 'root', and the relative paths 'anchor_paths', 'copies' and 'others'
+    """
+    rng = np.random.default_rng(0)
+    (tmp_path / 'data/anchors/Acme/appstore').mkdir(parents=True)
+    (tmp_path / 'queries').mkdir()
+    (tmp_path / 'files').mkdir()
+    paths = {'root': tmp_path, 'anchor_paths': [], 'copies': [], 'others': []}
+    for ii in range(N_ANCHORS):
+        anchor = make_logo(rng)
+        paths['anchor_paths'].append(f'data/anchors/Acme/appstore/anchor_{ii}.png')
+        paths['copies'].append(f'queries/copy_{ii}.png')
+        paths['others'].append(f'queries/other_{ii}.png')
+        cv2.imwrite(str(tmp_path / paths['anchor_paths'][-1]), anchor)
+        cv2.imwrite(str(tmp_path / paths['copies'][-1]), perturb_logo(anchor, rng))
+        cv2.imwrite(str(tmp_path / paths['others'][-1]), make_logo(rng))
+    with open(tmp_path / 'files/clients.json', 'w') as handle:
+        json.dump({'Acme': {'developer': {'appstore': ['Acme Inc'], 'googlePlay': ['Acme Inc']}}}, handle)
+    monkeypatch.chdir(tmp_path)
+    return paths
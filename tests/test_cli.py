@@ -0,0 +1,11 @@
+import pytest
+from raw.src import cli
+
+
+def test_bench_scales_are_the_benchmark_ones(capsys):
+    from raw.src import benchmark
+    assert cli.BENCH_SCALES == tuple(benchmark.SCALES)
+    assert cli.build_parser().parse_args(['bench', '--scales', 'small', 'large']).scales == ['small', 'large']
+    with pytest.raises(SystemExit):
+        cli.build_parser().parse_args(['bench', '--scales', 'huge'])
+    assert "invalid choice: 'huge'" in capsys.readouterr().err
@@ -0,0 +1,18 @@
+import os
+import shutil
+import pytest
+from raw.src.comparisson_client import ComparisonClient
+
+
+def test_same_named_queries_are_scored_apart(acme):
+    query_infos = []
+    for path, query_dir in ((acme['copies'][0], 'queries/a'), (acme['others'][0], 'queries/b')):
+        os.makedirs(query_dir)
+        shutil.copy(path, f'{query_dir}/logo.png')
+        query_infos.append({'img_path': f'{query_dir}/logo.png', 'developer': 'Acme Inc'})
+
+    compare_obj = ComparisonClient('Acme', 'appstore', save_study=False, memoize=False)
+    scores = compare_obj.compare_many(query_infos)['score'].tolist()
+    expected = [compare_obj.compare_query(query_info)['score'] for query_info in query_infos]
+    assert scores == pytest.approx(expected, abs=1e-9)
+    assert scores[0] != pytest.approx(scores[1])
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+from raw.src.http_cache import HttpCache
+
+
+class Response:
+
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+
+class Session:
+
+    def __init__(self, bodies):
+        self.bodies = bodies
+        self.calls = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.calls.append(url)
+        return Response(self.bodies[url], headers={'ETag': f'"{url}"'})
+
+
+def test_save_merges_the_index_of_other_processes(tmp_path):
+    session = Session({'a': b'a' * 10, 'b': b'b' * 10})
+    first, second = HttpCache(str(tmp_path)), HttpCache(str(tmp_path))
+    first.fetch(session, 'a')
+    second.fetch(session, 'b')
+    first.save()
+    second.save()
+
+    with open(tmp_path / 'index.json', 'r') as handle:
+        index = json.load(handle)
+    assert sorted(entry['url'] for entry in index.values()) == ['a', 'b']
+    # A new process serves both from the cache.
+    third = HttpCache(str(tmp_path), ttl={'page': 3600})
+    assert third.fetch(session, 'a') == b'a' * 10 and third.fetch(session, 'b') == b'b' * 10
+    assert session.calls == ['a', 'b']
+
+
+def test_evict_counts_the_body_files_not_in_the_index(tmp_path):
+    session = Session({'a': b'a' * 60, 'b': b'b' * 60})
+    other = HttpCache(str(tmp_path))
+    other.fetch(session, 'a')  # never saved, its body is not in the index of the next cache
+    cache = HttpCache(str(tmp_path), max_size=100)
+    assert cache.index == {}
+    cache.fetch(session, 'b')
+
+    assert cache.size <= 100
+    assert not os.path.exists(other._body_path(next(iter(other.index))))
+    assert cache.fetch(session, 'b') == b'b' * 60
+
+
+def test_save_leaves_out_the_evicted_entries(tmp_path):
+    session = Session({'a': b'a' * 60, 'b': b'b' * 60})
+    first = HttpCache(str(tmp_path))
+    first.fetch(session, 'a')
+    second = HttpCache(str(tmp_path), max_size=100)
+    second.fetch(session, 'b')  # evicts a
+    second.save()
+    first.save()
+
+    with open(tmp_path / 'index.json', 'r') as handle:
+        index = json.load(handle)
+    assert [entry['url'] for entry in index.values()] == ['b']
+
+
+class ConditionalSession(Session):
+
+    def __init__(self, bodies):
+        super().__init__(bodies)
+        self.headers = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.calls.append(url)
+        self.headers.append(headers or {})
+        etag = f'"{hash(self.bodies[url])}"'
+        if (headers or {}).get('If-None-Match') == etag:
+            return Response(b'', status_code=304)
+        return Response(self.bodies[url], headers={'ETag': etag, 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+
+
+def test_expired_responses_are_revalidated_with_their_etag(tmp_path):
+    session = ConditionalSession({'a': b'a' * 10})
+    cache = HttpCache(str(tmp_path), ttl={'page': 0})
+    assert cache.fetch(session, 'a') == b'a' * 10
+    assert cache.fetch(session, 'a') == b'a' * 10
+    assert session.headers[1] == {'If-None-Match': f'"{hash(b"a" * 10)}"',
+                                  'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+    assert cache.stats == {'fresh': 0, 'revalidated': 1, 'downloaded': 1}
+
+    # A changed resource gets a new ETag, its new body replaces the cached one.
+    session.bodies['a'] = b'A' * 10
+    assert cache.fetch(session, 'a') == b'A' * 10
+    cache.save()
+    assert HttpCache(str(tmp_path), ttl={'page': 3600}).fetch(session, 'a') == b'A' * 10
+    assert cache.stats['downloaded'] == 2 and len(session.calls) == 3
+
+
+def test_evict_removes_the_least_recently_used(tmp_path):
+    session = Session({'a': b'a' * 60, 'b': b'b' * 60, 'c': b'c' * 60})
+    cache = HttpCache(str(tmp_path), max_size=150, ttl={'page': 3600})
+    cache.fetch(session, 'a')
+    time.sleep(0.01)
+    cache.fetch(session, 'b')
+    time.sleep(0.01)
+    cache.fetch(session, 'a')  # fresh, a is now used after b
+    time.sleep(0.01)
+    cache.fetch(session, 'c')  # evicts b
+
+    assert sorted(entry['url'] for entry in cache.index.values()) == ['a', 'c']
+    assert cache.size == 120
+    assert cache.fetch(session, 'a') == b'a' * 60 and session.calls == ['a', 'b', 'c']
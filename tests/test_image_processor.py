@@ -0,0 +1,45 @@
+import cv2
+import numpy as np
+import pytest
+from raw.src.image_processor_modules import THRESHOLDS, KERNELS, RATIO, param_grid
+from raw.src.image_processor_modules import process_img, process_img_grid, process_color_grid
+from raw.src.image_processor_modules import orb_descriptors, knn_distances, ratio_test, match_descriptors
+
+
+def test_process_img_grid_matches_process_img(logos):
+    originals, duplicates, _ = logos(2)
+    for image in originals + duplicates:
+        grid = process_img_grid(image, THRESHOLDS, KERNELS)
+        assert grid.shape[0] == len(param_grid(THRESHOLDS, KERNELS))
+        for variant, (th, k) in zip(grid, param_grid(THRESHOLDS, KERNELS)):
+            np.testing.assert_array_equal(variant, process_img(image, 'query', th, k, False))
+
+        for blurred, k in zip(process_color_grid(image, KERNELS), KERNELS):
+            np.testing.assert_array_equal(blurred, process_img(image, 'query', THRESHOLDS[0], k, False, keep_color=True))
+
+
+def test_knn_distances_match_bfmatcher(logos):
+    originals, duplicates, others = logos(2)
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    n_good = 0
+    for anchor, query in zip(originals + originals, duplicates + others):
+        anchor_des = orb_descriptors(cv2.cvtColor(anchor, cv2.COLOR_BGR2GRAY))
+        query_des = orb_descriptors(cv2.cvtColor(query, cv2.COLOR_BGR2GRAY))
+        matches = matcher.knnMatch(anchor_des, query_des, k=2)
+        expected = np.array([[m.distance, n.distance] for m, n in matches])
+        distances = knn_distances(anchor_des, query_des)
+        np.testing.assert_array_equal(distances, expected)
+
+        good = [m.distance for m, n in matches if m.distance < RATIO * n.distance]
+        np.testing.assert_array_equal(distances[ratio_test(distances), 0], good)
+        n_matches, distance_mean = match_descriptors(anchor_des, query_des)
+        assert n_matches == len(good) and distance_mean == pytest.approx(np.mean(good) if good else np.nan, nan_ok=True)
+        n_good += len(good)
+    assert n_good
+
+
+def test_knn_distances_without_enough_descriptors():
+    des = np.zeros((5, 32), np.uint8)
+    assert knn_distances(des, des[:1]) is None and knn_distances(None, des) is None
+    assert knn_distances(des[:0], des).shape == (0, 2)
+    assert match_descriptors(des, des[:1]) == (0, pytest.approx(np.nan, nan_ok=True))
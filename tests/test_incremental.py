@@ -0,0 +1,62 @@
+import os
+import json
+import shutil
+from raw.src.comparisson_client import ComparisonClient
+from raw.src.incremental import score_incremental, save_index
+from raw.src.report_writer import ReportWriter
+from raw.src.scrap_all_clients import job_paths
+
+OPTIONS = {'memoize': False, 'save_study': False}
+
+
+def run(date, apps, scored, options=OPTIONS):
+    """
+    Scores the run of date as run_job(..., incremental=True) does.
+    @param apps: (dict) app url -> (image path, developer) of the search results
+    @param scored: (list) the names of the images scored are appended to it
+    @return: (int, pd.DataFrame) images carried forward and report of the run
+    """
+    paths = job_paths('Acme', 'appstore', date)
+    os.makedirs(paths['images_dir'])
+    query_infos = []
+    for ii, (app_url, (path, developer)) in enumerate(apps.items()):
+        img_path = f"{paths['images_dir']}/app_{ii}.png"
+        shutil.copy(path, img_path)
+        query_infos.append({'img_path': img_path, 'developer': developer, 'app_url': app_url})
+    os.makedirs(os.path.dirname(paths['results_file']), exist_ok=True)
+    with open(paths['results_file'], 'w') as handle:
+        json.dump(query_infos, handle)
+
+    compare_obj = ComparisonClient('Acme', 'appstore', **options)
+    score_query = compare_obj.score_query
+    compare_obj.score_query = lambda query_info: scored.append(query_info['img_path']) or score_query(query_info)
+    with ReportWriter(paths['report_file'], run_id=date, source=paths['results_file']) as writer:
+        _, n_carried = score_incremental(compare_obj, query_infos, writer, paths['results_file'])
+        save_index(compare_obj, query_infos, writer, paths['results_file'])
+        return n_carried, writer.compact().set_index('name')
+
+
+def test_only_new_or_changed_results_are_scored(acme):
+    first_scored, scored = [], []
+    apps = {'a': (acme['copies'][0], 'Acme Inc'), 'b': (acme['others'][0], 'Someone'),
+            'c': (acme['others'][1], 'Someone')}
+    _, first = run('2024-01-01', apps, first_scored)
+    assert len(first_scored) == 3
+
+    # b changed its logo, c its developer and d is new.
+    apps = apps | {'b': (acme['copies'][1], 'Someone'), 'c': (acme['others'][1], 'Acme Inc'),
+                   'd': (acme['others'][0], 'Someone')}
+    n_carried, second = run('2024-01-02', apps, scored)
+    assert n_carried == 1
+    assert sorted(os.path.basename(path) for path in scored) == ['app_1.png', 'app_2.png', 'app_3.png']
+    assert second.loc['app_0.png', 'score'] == first.loc['app_0.png', 'score']
+    assert second.loc['app_2.png', 'valid'] and not first.loc['app_2.png', 'valid']
+    assert len(second) == 4
+
+
+def test_a_run_with_other_options_scores_everything(acme):
+    apps = {'a': (acme['copies'][0], 'Acme Inc')}
+    run('2024-01-01', apps, [])
+    scored = []
+    assert run('2024-01-02', apps, scored, OPTIONS | {'fidelity': 'half'})[0] == 0
+    assert len(scored) == 1
@@ -0,0 +1,61 @@
+import cv2
+import numpy as np
+import pytest
+from raw.src.metric_engine import METRICS, SSIM_WS, compute_metrics, sewar_parity
+
+sewar = pytest.importorskip('sewar')
+
+TOL = 1e-6
+
+
+@pytest.fixture
+def logo_pairs(logos):
+    """
+    @return: (function) size, n -> (np.array, np.array) gray logos and their near duplicates / other logos,
+        (2 * n, size, size)
+    """
+    def pairs(size, n=4):
+        originals, duplicates, others = logos(n)
+        return gray(originals + originals, size), gray(duplicates + others, size)
+    return pairs
+
+
+def gray(imgs, size):
+    return np.stack([cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), (size, size), interpolation=cv2.INTER_AREA)
+                     for img in imgs])
+
+
+@pytest.mark.parametrize('size', [256, 128, 80, 32, SSIM_WS])
+def test_metrics_match_sewar(logo_pairs, size):
+    anchors, queries = logo_pairs(size)
+    max_abs_diff = sewar_parity(anchors, queries)
+    assert max(max_abs_diff.values()) <= TOL, max_abs_diff
+
+
+def test_msssim_small_scales_match_sewar(logo_pairs):
+    # At 80px the two coarsest msssim scales (10px and 5px) are smaller than the 11px window.
+    anchors, queries = logo_pairs(80, n=2)
+    values = compute_metrics(anchors, queries, metrics=('msssim_sim',))['msssim_sim']
+    expected = [abs(sewar.full_ref.msssim(a, q)) for a, q in zip(anchors, queries)]
+    assert not np.isnan(values).any()
+    np.testing.assert_allclose(values, expected, atol=TOL)
+
+
+def test_single_pair_matches_batch(logo_pairs):
+    anchors, queries = logo_pairs(64, n=2)
+    batch = compute_metrics(anchors, queries)
+    for ii, (anchor, query) in enumerate(zip(anchors, queries)):
+        single = compute_metrics(anchor, query)
+        assert single == pytest.approx({metric: batch[metric][ii] for metric in METRICS}, abs=TOL, nan_ok=True)
+
+
+def test_images_smaller_than_the_window_are_nan(logo_pairs):
+    # sewar returns values from partial windows there, the engine does not compare them.
+    anchors, queries = logo_pairs(SSIM_WS - 1, n=1)
+    results = compute_metrics(anchors, queries)
+    assert all(np.isnan(values).all() for values in results.values())
+
+
+def test_different_shapes_are_nan():
+    results = compute_metrics(np.zeros((32, 32), np.uint8), np.zeros((32, 40), np.uint8))
+    assert all(np.isnan(value) for value in results.values())
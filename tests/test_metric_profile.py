@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+from raw.src import metric_profile
+from raw.src.agg_engine import AGG_COLUMNS
+from raw.src.metric_profile import auc, labeled_metrics, select_metrics
+from raw.src.study_processors_modules import STUDY_METRICS
+
+
+def test_auc_of_a_known_ranking():
+    # The owned values rank 2 and 4 of 4: 3 of the 4 (owned, other) pairs are ordered.
+    assert auc([0.1, 0.4, 0.35, 0.8], [False, False, True, True]) == pytest.approx(0.75)
+    assert auc([0.1, 0.2, 0.3, 0.4], [False, False, True, True]) == 1.0
+    assert auc([0.5, 0.5, np.nan], [True, False, True]) == 0.5
+    assert np.isnan(auc([0.1, 0.2], [True, True]))
+
+
+def test_select_metrics_drops_an_expensive_redundant_metric():
+    owned = np.arange(20) % 2 == 0
+    metrics_df = pd.DataFrame({metric: 0.0 for metric in STUDY_METRICS}, index=range(20))
+    metrics_df['owned'] = owned
+    # ssim_sim separates the client logos, vifp_sim is a costly copy of it, the other metrics say nothing.
+    metrics_df['ssim_sim'] = owned.astype(float)
+    metrics_df['vifp_sim'] = owned.astype(float)
+    costs = {metric: 0.5 for metric in STUDY_METRICS} | {'ssim_sim': 1.0, 'vifp_sim': 10.0}
+
+    selected, selected_auc, full_auc = select_metrics(metrics_df, costs, tol=0.0)
+    assert 'vifp_sim' not in selected and 'ssim_sim' in selected
+    assert len(selected) == metric_profile.MIN_METRICS and set(selected) <= set(AGG_COLUMNS)
+    assert selected_auc == full_auc == 1.0
+
+
+def test_labeled_metrics_skips_empty_studies(acme, monkeypatch):
+    create_study = metric_profile.create_study
+
+    def study_of(anchors_path, query_img_path, name, **kwargs):
+        return [] if name == 'other_0.png' else create_study(anchors_path, query_img_path, name, **kwargs)
+
+    monkeypatch.setattr(metric_profile, 'create_study', study_of)
+    train_ds = {'copy_0.png': True, 'other_0.png': False}
+    metrics_df = labeled_metrics('data/anchors/Acme/appstore', 'queries', train_ds)
+    assert metrics_df['name'].tolist() == ['copy_0.png']
@@ -0,0 +1,55 @@
+import os
+import json
+import shutil
+import cv2
+import pytest
+from raw.src import cli
+from raw.src.comparisson_client import ComparisonClient
+from raw.src.prefilter import Prefilter, calibrate, prefilter_bounds_path
+
+
+@pytest.fixture
+def workspace(acme):
+    """
+    The 'Acme' workspace with its queries labeled at the paths of utils.create_train_ds: the near duplicates of the
+    anchors (owned) and the unrelated logos.
+    """
+    images_dir = 'data/scrap/appstore/Acme/images'
+    os.makedirs(images_dir)
+    train_ds = {}
+    for path in acme['copies'] + acme['others']:
+        name = os.path.basename(path)
+        shutil.copy(path, f'{images_dir}/{name}')
+        train_ds[name] = path in acme['copies']
+    os.makedirs('data/misc/Acme')
+    with open('data/misc/Acme/appstore_train_ds.json', 'w') as handle:
+        json.dump(train_ds, handle)
+    return {'anchor_paths': acme['anchor_paths'], 'images_dir': images_dir, 'train_ds': train_ds}
+
+
+def test_calibrated_bounds_never_reject_the_labeled_client_logos(workspace):
+    for margin in (0.0, 0.05):
+        bounds = calibrate(workspace['anchor_paths'], workspace['images_dir'], workspace['train_ds'], margin)
+        prefilter = Prefilter(workspace['anchor_paths'], bounds)
+        for name, owned in workspace['train_ds'].items():
+            if owned:
+                assert not prefilter.rejects(cv2.imread(f"{workspace['images_dir']}/{name}")), name
+
+
+def test_cli_writes_the_bounds_loaded_by_the_scoring(workspace, capsys):
+    assert cli.main(['prefilter', 'Acme', 'appstore']) == 0
+    with open(prefilter_bounds_path('Acme', 'appstore'), 'r') as handle:
+        bounds = json.load(handle)
+    assert bounds == calibrate(workspace['anchor_paths'], workspace['images_dir'], workspace['train_ds'])
+    assert 'of 2 client logos' in capsys.readouterr().out
+
+    compare_obj = ComparisonClient('Acme', 'appstore', save_study=False, prefilter=True)
+    assert compare_obj.load_prefilter().bounds == bounds
+    for name, owned in workspace['train_ds'].items():
+        if owned:
+            assert not compare_obj.is_prefiltered({'img_path': f"{workspace['images_dir']}/{name}"})
+
+
+def test_cli_dry_run_does_not_write_the_bounds(workspace):
+    assert cli.main(['prefilter', 'Acme', 'appstore', '--dry-run']) == 0
+    assert not os.path.exists(prefilter_bounds_path('Acme', 'appstore'))
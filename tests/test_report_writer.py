@@ -0,0 +1,18 @@
+import pandas as pd
+from raw.src.report_writer import ReportWriter
+
+
+def test_compact_keeps_the_last_row_at_the_first_position(tmp_path):
+    report_path = str(tmp_path / 'report.csv')
+    with ReportWriter(report_path, run_id='2024-01-01') as writer:
+        writer.write({'name': 'a.png', 'developer': 'x', 'valid': False, 'score': float('nan'), 'error': 'timeout'})
+        writer.write({'name': 'b.png', 'developer': 'y', 'valid': True, 'score': 0.5})
+    # A resumed run scores again the image that failed.
+    with ReportWriter(report_path, run_id='2024-01-01') as writer:
+        assert writer.written_names() == {'b.png'}
+        writer.write({'name': 'a.png', 'developer': 'x', 'valid': False, 'score': 0.25})
+        df = writer.compact()
+
+    assert df['name'].tolist() == ['a.png', 'b.png'] and df['score'].tolist() == [0.25, 0.5]
+    assert 'error' not in df.columns
+    pd.testing.assert_frame_equal(pd.read_csv(report_path), df)
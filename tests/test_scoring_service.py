@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import signal
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import cv2
+import numpy as np
+import pytest
+from raw.src.comparisson_client import ComparisonClient
+from raw.src.scoring_service import ScoringService, create_server
+
+OPTIONS = {'memoize': False}
+
+
+@pytest.fixture
+def service(acme):
+    service = ScoringService(max_workers=1, batch_wait=0, options=OPTIONS)
+    service.start()
+    server = create_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield service, f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+    service.stop()
+
+
+def request(url, data=None):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=120) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as E:
+        return E.code, json.load(E)
+
+
+def test_score_matches_compare_query(service):
+    _, url = service
+    compare_obj = ComparisonClient('Acme', 'appstore', save_study=False, **OPTIONS)
+    for name, developer in (('copy_0.png', 'Acme Inc'), ('other_0.png', 'Someone')):
+        with open(f'queries/{name}', 'rb') as handle:
+            query = urllib.parse.urlencode({'client': 'Acme', 'store': 'appstore', 'developer': developer, 'name': name})
+            status, row = request(f'{url}/score?{query}', handle.read())
+        expected = compare_obj.compare_query({'img_path': f'queries/{name}', 'developer': developer})
+        assert status == 200
+        assert row['name'] == name and row['valid'] == (developer == 'Acme Inc')
+        assert row['score'] == pytest.approx(expected['score'], abs=1e-9)
+
+    status, metrics = request(f'{url}/metrics')
+    assert status == 200
+    assert metrics['requests'] == 2 and metrics['scored'] == 2 and metrics['failed'] == 0
+    assert metrics['clients'] == ['Acme/appstore']
+
+
+def test_score_rejects_missing_parameters(service):
+    _, url = service
+    status, body = request(f'{url}/score?client=Acme', b'png')
+    assert status == 400 and 'developer' in body['error']
+
+
+def test_failed_images_are_not_200(service):
+    _, url = service
+    query = urllib.parse.urlencode({'client': 'Acme', 'store': 'appstore', 'developer': 'Acme Inc'})
+    status, body = request(f'{url}/score?{query}', b'not an image')
+    assert status == 422 and 'decoded' in body['error']
+    assert not os.path.exists('data/logos')
+
+    # A 1x1 image decodes but can not be scored.
+    status, row = request(f'{url}/score?{query}', cv2.imencode('.png', np.zeros((1, 1, 3), np.uint8))[1].tobytes())
+    assert status == 500 and row['score'] is None and 'error' in row
+
+
+def test_health_is_degraded_when_a_worker_dies(service):
+    service, url = service
+    status, health = request(f'{url}/health')
+    assert status == 200 and health['status'] == 'ok' and health['workers'] == 1
+
+    for pid in list(service.executor._processes):
+        os.kill(pid, signal.SIGKILL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and service.health()['status'] == 'ok':
+        time.sleep(0.05)
+    status, health = request(f'{url}/health')
+    assert status == 503 and health['status'] == 'degraded'
+    assert any('worker pool' in reason for reason in health['reasons'])
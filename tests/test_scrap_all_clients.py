@@ -0,0 +1,69 @@
+import os
+import json
+import shutil
+import pandas as pd
+from raw.src import scrap_stores, scrap_all_clients
+from raw.src.comparisson_client import ComparisonClient
+from raw.src.scrap_all_clients import job_paths, load_state, run_job
+
+DATE = '2024-01-01'
+OPTIONS = {'memoize': False, 'save_study': False}
+
+
+def scrapped(acme):
+    return acme['copies'][:1] + acme['others'][:1]
+
+
+def fake_scrape(acme, calls):
+    """
+    @return: (function) stand-in of scrap_stores.main that downloads two of the 'Acme' queries and counts its calls.
+    """
+    def scrape(CLIENT, STORE, download_images_dir, download_results_file, clean=True):
+        calls.append((CLIENT, STORE))
+        os.makedirs(download_images_dir, exist_ok=True)
+        apps_data = []
+        for path in scrapped(acme):
+            img_path = f'{download_images_dir}/{os.path.basename(path)}'
+            shutil.copy(path, img_path)
+            apps_data.append({'img_path': img_path, 'developer': 'Acme Inc'})
+        os.makedirs(os.path.dirname(download_results_file), exist_ok=True)
+        with open(download_results_file, 'w') as handle:
+            json.dump(apps_data, handle)
+    return scrape
+
+
+def test_an_interrupted_job_resumes_without_scraping_or_scoring_again(acme, monkeypatch):
+    scrapes, scored = [], []
+    monkeypatch.setattr(scrap_stores, 'main', fake_scrape(acme, scrapes))
+    score_query = ComparisonClient.score_query
+    monkeypatch.setattr(ComparisonClient, 'score_query',
+                        lambda self, query_info: scored.append(query_info['img_path']) or score_query(self, query_info))
+    compare_stream = ComparisonClient.compare_stream
+
+    def interrupted_stream(self, query_infos, writer):
+        compare_stream(self, query_infos[:1], writer)
+        raise RuntimeError('interrupted')
+
+    monkeypatch.setattr(ComparisonClient, 'compare_stream', interrupted_stream)
+    state = run_job('Acme', 'appstore', DATE, options=OPTIONS)
+    assert state['status'] == 'scraped' and 'interrupted' in state['error'] and len(scored) == 1
+
+    monkeypatch.setattr(ComparisonClient, 'compare_stream', compare_stream)
+    state = run_job('Acme', 'appstore', DATE, options=OPTIONS)
+    assert state['status'] == 'done' and state['attempts'] == 2 and state['error'] is None
+    assert scrapes == [('Acme', 'appstore')]
+    # The image streamed by the interrupted attempt is not scored again.
+    assert len(scored) == len(set(scored)) == state['n_images'] == len(scrapped(acme))
+    report = pd.read_csv(job_paths('Acme', 'appstore', DATE)['report_file'])
+    assert sorted(report['name']) == sorted(os.path.basename(path) for path in scrapped(acme))
+    assert load_state('Acme', 'appstore', DATE) == state
+
+
+def test_main_skips_the_jobs_done(acme, monkeypatch, capsys):
+    monkeypatch.setattr(scrap_stores, 'main', fake_scrape(acme, []))
+    assert run_job('Acme', 'appstore', DATE, options=OPTIONS)['status'] == 'done'
+    monkeypatch.setattr(scrap_all_clients, 'run_job', None)  # a job run again would fail
+
+    states = scrap_all_clients.main(['Acme'], ['appstore'], DATE, max_workers=1)
+    assert [state['status'] for state in states] == ['done'] and states[0]['attempts'] == 1
+    assert '1 done or out of attempts, 0 to run' in capsys.readouterr().out
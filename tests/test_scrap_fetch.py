@@ -0,0 +1,66 @@
+import socket
+import threading
+import functools
+import http.server
+import pytest
+from raw.src import http_client
+from raw.src.scrap_appstore import get_app_data, parse_app_data
+
+DETAIL_PAGE = '''<html><body>
+<h1 class="product-header__title app-header__title">{name} <span class="badge">{age}+</span></h1>
+<h2 class="product-header__identity app-header__identity"><a class="link">{developer}</a></h2>
+</body></html>'''
+PAGES = {
+    'acme-bank.html': {'name': 'Acme Bank', 'age': 4, 'developer': 'Acme Inc.'},
+    'acme-wallet.html': {'name': 'Acme Wallet 2', 'age': 12, 'developer': 'Other Dev'},
+    'acme-cards.html': {'name': 'Acme Cards', 'age': 17, 'developer': 'Acme Inc.'},
+}
+
+
+@pytest.fixture
+def server(tmp_path):
+    for name, fields in PAGES.items():
+        (tmp_path / name).write_text(DETAIL_PAGE.format(**fields))
+    handler = functools.partial(QuietHandler, directory=str(tmp_path))
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_fetch_all_matches_the_serial_path(server):
+    session = http_client.create_session(retries=0)
+    urls = [f'{server}/{name}' for name in PAGES]
+    htmls = http_client.fetch_all(urls, session, timeout=5, max_workers=3)
+
+    parsed = [parse_app_data(html, url, f'{url}.png') for url, html in zip(urls, htmls)]
+    serial = [get_app_data(url, f'{url}.png', session, timeout=5) for url in urls]
+    assert parsed == serial
+    assert [(app_data['app_name'], app_data['developer']) for app_data in parsed] == \
+        [(fields['name'], fields['developer']) for fields in PAGES.values()]
+    assert [app_data['app_url'] for app_data in parsed] == urls
+
+
+def test_fetch_all_returns_none_for_failed_urls(server):
+    session = http_client.create_session(retries=0)
+    urls = [f'{server}/acme-bank.html', f'{server}/missing.html', f'http://127.0.0.1:{closed_port()}/acme-bank.html',
+            f'{server}/acme-cards.html']
+    htmls = http_client.fetch_all(urls, session, timeout=5, max_workers=4)
+
+    assert htmls[1] is None and htmls[2] is None
+    assert parse_app_data(htmls[0], urls[0], '')['app_name'] == 'Acme Bank'
+    assert parse_app_data(htmls[3], urls[3], '')['app_name'] == 'Acme Cards'
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+from raw.src.study_processors_modules import PYRAMID_BAND, fidelity_report, _metric_array, _metric_scale, _metrics_change
+
+
+def reference_change(rows, a, b, mid=None):
+    # Per column pandas implementation of the adaptive sweep criterion.
+    study_df = pd.DataFrame([row for ti in rows for row in rows[ti]])
+    change = 0.0
+    for col in study_df.columns:
+        if ('sim' in col) or ('dist' in col):
+            scale = study_df[col].abs().max()
+            if mid is None:
+                diff = pd.DataFrame(rows[a])[col] - pd.DataFrame(rows[b])[col]
+            else:
+                w = (mid - a) / (b - a)
+                diff = pd.DataFrame(rows[mid])[col] - ((1 - w) * pd.DataFrame(rows[a])[col]
+                                                       + w * pd.DataFrame(rows[b])[col])
+            if scale > 0 and diff.notna().any():
+                change = max(change, float(np.nanmean(np.abs(diff))) / scale)
+    return change
+
+
+def threshold_rows(rng, n_rows=6):
+    rows = []
+    for _ in range(n_rows):
+        row = {'path': 'anchor.png', 'name': 'query.png', 'owned': np.nan, 'orb_n': float(rng.integers(0, 50)),
+               'ssim_sim': rng.uniform(), 'rmse_dist': rng.uniform(0, 80), 'hist_corr_sim': rng.uniform(),
+               'empty_sim': np.nan}
+        row['sam_dist'] = np.nan if rng.uniform() < 0.3 else rng.uniform(0, 2)
+        rows.append(row)
+    return rows
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_metrics_change_matches_the_per_column_reference(seed):
+    rng = np.random.default_rng(seed)
+    rows = {ti: threshold_rows(rng) for ti in (0, 2, 4, 8)}
+    arrays = {ti: _metric_array(rows[ti]) for ti in rows}
+    scale = _metric_scale(arrays)
+
+    for a, b, mid in ((0, 4, None), (4, 8, None), (0, 4, 2), (0, 8, 4)):
+        assert _metrics_change(arrays, scale, a, b, mid) == pytest.approx(reference_change(rows, a, b, mid))
+
+
+def test_metrics_change_is_zero_without_metric_values():
+    rows = {ti: [{'path': 'a.png', 'ssim_sim': np.nan}] * 2 for ti in (0, 4)}
+    arrays = {ti: _metric_array(rows[ti]) for ti in rows}
+    assert _metrics_change(arrays, _metric_scale(arrays), 0, 4) == 0.0
+
+
+def test_fidelity_report_counts_the_escalated_images(acme):
+    names = [path.split('/')[-1] for path in acme['copies'] + acme['others']]
+    pd.DataFrame({'name': names, 'valid': True, 'score': 0.0}).to_csv('report.csv', index=False)
+    results, summary = fidelity_report('data/anchors/Acme/appstore', 'report.csv', 'queries',
+                                       fidelities=('quarter', 'pyramid'))
+
+    band = results['quarter_score'].between(*PYRAMID_BAND)
+    assert results['pyramid_escalated'].tolist() == band.tolist()
+    escalated = results[band]
+    np.testing.assert_allclose(escalated['pyramid_score'], escalated['full_score'])
+    np.testing.assert_allclose(results[~band]['pyramid_score'], results[~band]['quarter_score'])
+    assert summary.loc['pyramid', 'escalated'] == pytest.approx(band.mean())
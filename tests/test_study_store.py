@@ -0,0 +1,49 @@
+import glob
+import numpy as np
+import pandas as pd
+from raw.src.study_store import StudyStore, compact_run_study, load_run_study, run_study_path
+
+
+def query_study(ii, n_rows=4):
+    return [{'path': f'anchors/a{row % 2}.png', 'name': f'q{ii}.png', 'th': 0.5, 'k': row, 'ssim_sim': ii + row / 10}
+            for row in range(n_rows)]
+
+
+def test_append_writes_one_part_per_study(tmp_path):
+    path = run_study_path('Acme', 'appstore', 'run1', str(tmp_path))
+    store = StudyStore(path)
+    for ii in range(3):
+        store.append(query_study(ii))
+    store.append([])
+
+    assert len(glob.glob(path.replace('.npz', '.part*.npz'))) == 3
+    study = load_run_study('Acme', 'appstore', 'run1', str(tmp_path))
+    assert len(study) == 12 and sorted(study['name'].unique()) == ['q0.png', 'q1.png', 'q2.png']
+
+
+def test_compact_merges_the_parts_of_the_run_and_its_workers(tmp_path):
+    path = run_study_path('Acme', 'appstore', 'run1', str(tmp_path))
+    main, worker = StudyStore(path), StudyStore(path.replace('.npz', '-1234.npz'))
+    main.append(query_study(0))
+    worker.append(query_study(1))
+    worker.append(query_study(2))
+    before = load_run_study('Acme', 'appstore', 'run1', str(tmp_path))
+
+    assert compact_run_study('Acme', 'appstore', 'run1', str(tmp_path)) == path
+    assert glob.glob(f'{tmp_path}/Acme/studies/*') == [path]
+    after = load_run_study('Acme', 'appstore', 'run1', str(tmp_path))
+    key = ['name', 'k']
+    pd.testing.assert_frame_equal(before.sort_values(key, ignore_index=True), after.sort_values(key, ignore_index=True))
+    np.testing.assert_allclose(after.loc[after['name'] == 'q2.png', 'ssim_sim'], [2, 2.1, 2.2, 2.3], rtol=1e-6)
+
+
+def test_resumed_run_keeps_the_previous_parts(tmp_path):
+    path = run_study_path('Acme', 'appstore', 'run1', str(tmp_path))
+    StudyStore(path).append(query_study(0))
+    StudyStore(path).append(query_study(1))
+    assert len(load_run_study('Acme', 'appstore', 'run1', str(tmp_path))) == 8
+
+    compact_run_study('Acme', 'appstore', 'run1', str(tmp_path))
+    StudyStore(path).append(query_study(2))
+    compact_run_study('Acme', 'appstore', 'run1', str(tmp_path))
+    assert len(load_run_study('Acme', 'appstore', 'run1', str(tmp_path))) == 12
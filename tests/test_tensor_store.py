@@ -0,0 +1,36 @@
+import os
+import glob
+import numpy as np
+from raw.src import comparisson_client
+from raw.src.comparisson_client import ComparisonClient
+from raw.src.tensor_store import create_run_dir, remove_run_dir, share_query_img, attach_query_img
+
+
+def test_run_dir_shares_and_removes_the_images(tmp_path):
+    run_dir = create_run_dir('run1', str(tmp_path))
+    img = np.arange(12, dtype=np.uint8).reshape(2, 2, 3)
+    share_query_img('ab' * 20, img, run_dir)
+    np.testing.assert_array_equal(attach_query_img('ab' * 20, run_dir), img)
+    assert create_run_dir('run1', str(tmp_path)) != run_dir
+
+    remove_run_dir(run_dir)
+    assert attach_query_img('ab' * 20, run_dir) is None
+
+
+def test_query_images_are_removed_when_the_run_ends(acme, monkeypatch):
+    shared = []
+
+    def remove(path):
+        shared.extend(glob.glob(f'{path}/queries/*/*'))
+        remove_run_dir(path)
+
+    monkeypatch.setattr(comparisson_client, 'remove_run_dir', remove)
+    query_infos = [{'img_path': path, 'developer': 'Acme Inc'} for path in acme['copies'][:1] + acme['others'][:2]]
+    compare_obj = ComparisonClient('Acme', 'appstore', save_study=False, n_workers=2, memoize=False, prefilter=True)
+    parallel = compare_obj.compare_many(query_infos)['score']
+    serial = ComparisonClient('Acme', 'appstore', save_study=False, memoize=False,
+                              prefilter=True).compare_many(query_infos)['score']
+
+    np.testing.assert_allclose(parallel, serial)
+    assert len(shared) == len(query_infos)
+    assert os.listdir('data/tensors/runs') == [] and compare_obj.query_tensors_dir is None